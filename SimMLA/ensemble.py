@@ -0,0 +1,205 @@
+# © All rights reserved. ECOLE POLYTECHNIQUE FEDERALE DE LAUSANNE, Switzerland,
+# Laboratory of Experimental Biophysics, 2016
+# See the LICENSE.docx file for more details.
+
+import numpy              as np
+from concurrent.futures   import ProcessPoolExecutor
+from itertools            import repeat
+from SimMLA.fields        import EnsembleAccumulator
+
+def runEnsemble(realization, numRealizations, numWorkers = 1, seed = None, chunkSize = 10):
+    '''Averages the irradiance patterns of independent random realizations.
+
+    Every realization receives its own numpy.random.Generator spawned from a
+    common numpy.random.SeedSequence, so the result only depends on the seed
+    and the chunk size, not on the number of workers or on the order in which
+    the chunks are run. Each chunk of realizations is summed in float64 by a
+    single worker and the sums of the chunks are reduced at the end.
+
+    Parameters
+    ----------
+    realization     : function
+        realization(rng) computes one random realization with the generator
+        rng and returns its irradiance as an array, or several irradiance
+        planes as a tuple of arrays. It must be picklable, i.e. a module-level
+        function or a functools.partial of one, when numWorkers > 1.
+    numRealizations : int
+        The number of realizations to average.
+    numWorkers      : int
+        The number of worker processes. Realizations are computed in the
+        calling process if this is 1.
+    seed            : int, numpy.random.SeedSequence or None
+        The seed of the random streams. Fresh entropy is used if None.
+    chunkSize       : int
+        The number of realizations summed by a worker before its sums are
+        returned. It does not depend on numWorkers so that the sums are
+        added in the same order for any number of workers.
+
+    Returns
+    -------
+    avgIrrad : array of float or tuple of arrays of float
+        The average irradiance of every plane returned by realization.
+
+    Examples
+    --------
+    >>> def realization(rng):
+    ...     beam = fields.GSMBeamRealization(amp, beamStd, cohLength, grid, rng = rng)
+    ...     return np.abs(beam(grid.px))**2
+    >>> avgIrrad = runEnsemble(realization, 1000, numWorkers = 64, seed = 42)
+
+    '''
+    if (not isinstance(numRealizations, int)) or (numRealizations <= 0):
+        raise ValueError('numRealizations must be a positive integer.')
+    if (not isinstance(numWorkers, int)) or (numWorkers <= 0):
+        raise ValueError('numWorkers must be a positive integer.')
+
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    seeds  = seed.spawn(numRealizations)
+    chunks = [seeds[start:start + chunkSize] for start in range(0, numRealizations, chunkSize)]
+
+    if numWorkers == 1:
+        chunkSums = map(_sumRealizations, repeat(realization), chunks)
+        sums      = _reduceSums(chunkSums)
+    else:
+        with ProcessPoolExecutor(max_workers = numWorkers) as pool:
+            chunkSums = pool.map(_sumRealizations, repeat(realization), chunks)
+            sums      = _reduceSums(chunkSums)
+
+    avgIrrad = tuple(currSum / numRealizations for currSum in sums)
+
+    if len(avgIrrad) == 1:
+        return avgIrrad[0]
+    return avgIrrad
+
+def _sumRealizations(realization, seeds):
+    '''Computes the running sums of the irradiance over a chunk of realizations.
+
+    '''
+    sums = None
+    for currSeed in seeds:
+        planes = realization(np.random.default_rng(currSeed))
+        if isinstance(planes, np.ndarray):
+            planes = (planes,)
+
+        if sums is None:
+            sums = [np.array(plane, dtype = np.float64) for plane in planes]
+        else:
+            for currSum, plane in zip(sums, planes):
+                currSum += plane
+
+    return sums
+
+def _reduceSums(chunkSums):
+    '''Adds the sums of all the chunks in order.
+
+    '''
+    sums = None
+    for currSums in chunkSums:
+        if sums is None:
+            sums = currSums
+        else:
+            for currSum, chunkSum in zip(sums, currSums):
+                currSum += chunkSum
+
+    return sums
+
+def runUntilConverged(realization, targetError, maxRealizations, numWorkers = 1, seed = None,
+                      chunkSize = 10, minRealizations = 20, errorFunction = None,
+                      plane = 0, mask = None):
+    '''Averages random realizations until a figure of merit has converged.
+
+    Realizations are computed in chunks with the same random streams as
+    runEnsemble, and the running statistics of the chunks are merged in order
+    into an EnsembleAccumulator. The relative standard error is checked after
+    every chunk and no more chunks are started once it is below the target.
+    Chunks that were already running when the target was reached are
+    discarded, so the result only depends on the seed and the chunk size, not
+    on the number of workers.
+
+    Parameters
+    ----------
+    realization     : function
+        realization(rng) returns the irradiance of one realization as an
+        array or a tuple of arrays; see runEnsemble.
+    targetError     : float
+        The relative standard error at which the averaging stops.
+    maxRealizations : int
+        The number of realizations after which the averaging stops even if
+        the target was not reached.
+    numWorkers      : int
+        The number of worker processes.
+    seed            : int, numpy.random.SeedSequence or None
+        The seed of the random streams. Fresh entropy is used if None.
+    chunkSize       : int
+        The number of realizations computed between two checks.
+    minRealizations : int
+        The number of realizations before the first check, which avoids
+        stopping on a poor estimate of the error.
+    errorFunction   : function or None
+        errorFunction(accumulator) returns the relative standard error of the
+        figure of merit. Defaults to the relative standard error of the mean
+        irradiance over mask in the given plane (see
+        EnsembleAccumulator.relativeStandardError).
+    plane           : int
+        The plane of the default figure of merit.
+    mask            : array of bool or None
+        The region of the default figure of merit, e.g. the aperture of the
+        back focal plane.
+
+    Returns
+    -------
+    accumulator : EnsembleAccumulator
+        The statistics of the realizations. accumulator.mean is the average
+        irradiance and accumulator.count the number of realizations used.
+
+    Examples
+    --------
+    >>> inBFP = np.abs(pipeline.coordinates('bfp')) <= bfpDiam / 2
+    >>> acc = runUntilConverged(pipeline, 0.01, 1000, numWorkers = 64,
+    ...                         seed = 42, mask = inBFP)
+
+    '''
+    if (not isinstance(maxRealizations, int)) or (maxRealizations <= 0):
+        raise ValueError('maxRealizations must be a positive integer.')
+    if (not isinstance(numWorkers, int)) or (numWorkers <= 0):
+        raise ValueError('numWorkers must be a positive integer.')
+
+    if errorFunction is None:
+        errorFunction = lambda acc: acc.relativeStandardError(plane, mask)
+
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    seeds  = seed.spawn(maxRealizations)
+    chunks = [seeds[start:start + chunkSize] for start in range(0, maxRealizations, chunkSize)]
+
+    accumulator = EnsembleAccumulator()
+    pool        = ProcessPoolExecutor(max_workers = numWorkers) if numWorkers > 1 else None
+    try:
+        # Up to numWorkers chunks are run between two checks
+        for first in range(0, len(chunks), numWorkers):
+            batch = chunks[first:first + numWorkers]
+            if pool is None:
+                results = map(_accumulateRealizations, repeat(realization), batch)
+            else:
+                results = pool.map(_accumulateRealizations, repeat(realization), batch)
+
+            for chunkAccumulator in results:
+                accumulator.merge(chunkAccumulator)
+                if (accumulator.count >= max(minRealizations, 2)) and (errorFunction(accumulator) <= targetError):
+                    return accumulator
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    return accumulator
+
+def _accumulateRealizations(realization, seeds):
+    '''Computes the running statistics of the irradiance over a chunk of realizations.
+
+    '''
+    accumulator = EnsembleAccumulator()
+    for currSeed in seeds:
+        accumulator.update(realization(np.random.default_rng(currSeed)))
+
+    return accumulator
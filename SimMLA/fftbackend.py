@@ -0,0 +1,266 @@
+# © All rights reserved. ECOLE POLYTECHNIQUE FEDERALE DE LAUSANNE, Switzerland,
+# Laboratory of Experimental Biophysics, 2016
+# See the LICENSE.docx file for more details.
+
+import pickle
+from contextlib import contextmanager
+import numpy     as np
+import scipy.fft
+from numpy.fft   import fftshift, ifftshift
+from SimMLA.instrumentation import fftDetails, instrument
+
+try:
+    import pyfftw
+    import pyfftw.interfaces.scipy_fft
+except ImportError:
+    pyfftw = None
+
+class UnknownBackendException(Exception):
+    pass
+
+class ScipyBackend(object):
+    '''Transforms with scipy.fft (pocketfft), optionally multithreaded.
+
+    '''
+    name = 'scipy'
+
+    def __init__(self, workers = None):
+        '''
+        Parameters
+        ----------
+        workers : int or None
+            The number of threads of every transform. Negative values count
+            from the number of CPUs, e.g. -1 uses all of them.
+
+        '''
+        self.workers = workers
+
+    def fft(self, x, axis = -1, overwrite_x = False):
+        return scipy.fft.fft(x, axis = axis, overwrite_x = overwrite_x, workers = self.workers)
+
+    def ifft(self, x, axis = -1, overwrite_x = False):
+        return scipy.fft.ifft(x, axis = axis, overwrite_x = overwrite_x, workers = self.workers)
+
+    def fft2(self, x, axes = (-2, -1), overwrite_x = False):
+        return scipy.fft.fft2(x, axes = axes, overwrite_x = overwrite_x, workers = self.workers)
+
+    def ifft2(self, x, axes = (-2, -1), overwrite_x = False):
+        return scipy.fft.ifft2(x, axes = axes, overwrite_x = overwrite_x, workers = self.workers)
+
+class NumpyBackend(object):
+    '''Transforms with numpy.fft. overwrite_x is ignored.
+
+    '''
+    name = 'numpy'
+
+    def fft(self, x, axis = -1, overwrite_x = False):
+        return np.fft.fft(x, axis = axis)
+
+    def ifft(self, x, axis = -1, overwrite_x = False):
+        return np.fft.ifft(x, axis = axis)
+
+    def fft2(self, x, axes = (-2, -1), overwrite_x = False):
+        return np.fft.fft2(x, axes = axes)
+
+    def ifft2(self, x, axes = (-2, -1), overwrite_x = False):
+        return np.fft.ifft2(x, axes = axes)
+
+class PyFFTWBackend(object):
+    '''Transforms with FFTW through pyFFTW.
+
+    The plans of every transform are kept in pyFFTW's interface cache, so
+    repeated transforms of the same shape reuse them. Use loadWisdom and
+    saveWisdom to keep the plans between sessions.
+
+    '''
+    name = 'pyfftw'
+
+    def __init__(self, workers = None, plannerEffort = 'FFTW_MEASURE', keepAlive = 60):
+        '''
+        Parameters
+        ----------
+        workers       : int or None
+            The number of threads of every transform.
+        plannerEffort : str
+            The FFTW planner flag, e.g. 'FFTW_ESTIMATE' or 'FFTW_PATIENT'.
+        keepAlive     : float
+            The time in seconds for which unused plans are cached.
+
+        '''
+        if pyfftw is None:
+            raise UnknownBackendException('The pyfftw backend requires the pyFFTW package.')
+
+        self.workers       = workers
+        self.plannerEffort = plannerEffort
+
+        pyfftw.interfaces.cache.enable()
+        pyfftw.interfaces.cache.set_keepalive_time(keepAlive)
+
+    def fft(self, x, axis = -1, overwrite_x = False):
+        return pyfftw.interfaces.scipy_fft.fft(x, axis = axis, overwrite_x = overwrite_x,
+                                               workers = self.workers, planner_effort = self.plannerEffort)
+
+    def ifft(self, x, axis = -1, overwrite_x = False):
+        return pyfftw.interfaces.scipy_fft.ifft(x, axis = axis, overwrite_x = overwrite_x,
+                                                workers = self.workers, planner_effort = self.plannerEffort)
+
+    def fft2(self, x, axes = (-2, -1), overwrite_x = False):
+        return pyfftw.interfaces.scipy_fft.fft2(x, axes = axes, overwrite_x = overwrite_x,
+                                                workers = self.workers, planner_effort = self.plannerEffort)
+
+    def ifft2(self, x, axes = (-2, -1), overwrite_x = False):
+        return pyfftw.interfaces.scipy_fft.ifft2(x, axes = axes, overwrite_x = overwrite_x,
+                                                 workers = self.workers, planner_effort = self.plannerEffort)
+
+BACKENDS = {'scipy'  : ScipyBackend,
+            'numpy'  : NumpyBackend,
+            'pyfftw' : PyFFTWBackend}
+
+_backend = ScipyBackend()
+
+def setBackend(name, **options):
+    '''Selects the library that computes every transform of SimMLA.
+
+    Parameters
+    ----------
+    name    : str
+        'scipy' (default), 'numpy' or 'pyfftw'. See BACKENDS.
+    options :
+        Keyword arguments of the backend, e.g. workers = 8.
+
+    Returns
+    -------
+    backend : object
+        The previous backend, which may be restored with setBackend(backend).
+
+    Examples
+    --------
+    >>> setBackend('scipy', workers = -1)
+    >>> setBackend('pyfftw', workers = 8, plannerEffort = 'FFTW_PATIENT')
+
+    '''
+    global _backend
+
+    previous = _backend
+    if isinstance(name, str):
+        if name not in BACKENDS:
+            raise UnknownBackendException('Unknown backend {0}. Valid backends are {1}.'.format(name, tuple(BACKENDS)))
+        _backend = BACKENDS[name](**options)
+    else:
+        _backend = name
+
+    return previous
+
+def getBackend():
+    '''Returns the current backend.
+
+    '''
+    return _backend
+
+@contextmanager
+def useBackend(name, **options):
+    '''Selects a backend for the duration of a with block.
+
+    Examples
+    --------
+    >>> with useBackend('scipy', workers = 8):
+    ...     uOut = fftPropagate(uIn, grid, 1000)
+
+    '''
+    previous = setBackend(name, **options)
+    try:
+        yield _backend
+    finally:
+        setBackend(previous)
+
+@instrument('fftbackend.fft', details = fftDetails)
+def fft(x, axis = -1, overwrite_x = False):
+    '''1D forward transform with the current backend.
+
+    '''
+    return _backend.fft(x, axis = axis, overwrite_x = overwrite_x)
+
+@instrument('fftbackend.ifft', details = fftDetails)
+def ifft(x, axis = -1, overwrite_x = False):
+    '''1D inverse transform with the current backend.
+
+    '''
+    return _backend.ifft(x, axis = axis, overwrite_x = overwrite_x)
+
+@instrument('fftbackend.fft2', details = fftDetails)
+def fft2(x, axes = (-2, -1), overwrite_x = False):
+    '''2D forward transform with the current backend.
+
+    '''
+    return _backend.fft2(x, axes = axes, overwrite_x = overwrite_x)
+
+@instrument('fftbackend.ifft2', details = fftDetails)
+def ifft2(x, axes = (-2, -1), overwrite_x = False):
+    '''2D inverse transform with the current backend.
+
+    '''
+    return _backend.ifft2(x, axes = axes, overwrite_x = overwrite_x)
+
+def nextFastLength(n, odd = True):
+    '''Returns the smallest length >= n whose transform is fast.
+
+    Fast lengths have no prime factor larger than 7. SimMLA's grids have an
+    odd number of points so that the origin lies on a sample, and odd fast
+    lengths are products of powers of 3, 5 and 7 only.
+
+    Parameters
+    ----------
+    n   : int
+    odd : bool
+        Only return odd lengths.
+
+    Examples
+    --------
+    >>> nextFastLength(20001)
+    21609
+
+    '''
+    if n <= 1:
+        return 1
+
+    primes = (3, 5, 7) if odd else (2, 3, 5, 7)
+    best   = None
+
+    # Enumerate the products of the primes that are just above n
+    def search(product, index):
+        nonlocal best
+        if product >= n:
+            if (best is None) or (product < best):
+                best = product
+            return
+        if index == len(primes):
+            return
+
+        search(product, index + 1)
+        while product < n:
+            product *= primes[index]
+            search(product, index + 1)
+
+    search(1, 0)
+
+    return best
+
+def loadWisdom(fileName):
+    '''Loads FFTW plans saved by saveWisdom.
+
+    '''
+    if pyfftw is None:
+        raise UnknownBackendException('FFTW wisdom requires the pyFFTW package.')
+
+    with open(fileName, 'rb') as file:
+        pyfftw.import_wisdom(pickle.load(file))
+
+def saveWisdom(fileName):
+    '''Saves the FFTW plans of the session.
+
+    '''
+    if pyfftw is None:
+        raise UnknownBackendException('FFTW wisdom requires the pyFFTW package.')
+
+    with open(fileName, 'wb') as file:
+        pickle.dump(pyfftw.export_wisdom(), file)
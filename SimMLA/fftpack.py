@@ -3,12 +3,19 @@
 # See the LICENSE.docx file for more details.
 
 import numpy           as np
-from scipy.fftpack     import fft, fft2, ifft
-from scipy.fftpack     import fftshift, ifftshift
+from collections       import OrderedDict
+from SimMLA.fftbackend import fft, fft2, ifft
+from SimMLA.fftbackend import fftshift, ifftshift
 from scipy.interpolate import interp1d
 from scipy.interpolate import RectBivariateSpline
+from scipy.special     import wofz
+from SimMLA.fields     import GaussianBeam
+from SimMLA.grids      import Grid, ImproperGridSizeException, isEven
+from SimMLA.instrumentation import instrument
+from SimMLA.propagation import BandLimitedPropagator
 
-def fftSubgrid(uIn, grid, clip = True):
+@instrument('fftpack.fftSubgrid')
+def fftSubgrid(uIn, grid, clip = True, batched = False, windowPad = None):
     '''Computes the 1D FFT of individual subgrids.
     
     fftSubgrid computes the 1D fast Fourier transform of a discretized field in
@@ -17,69 +24,485 @@ def fftSubgrid(uIn, grid, clip = True):
         
     Parameters
     ----------
-    uIn  : function
+    uIn       : function or 1D array of complex
         A 1D, real or complex valued function defining an input field
-        distribution.
-    grid : GridArray
+        distribution, or the field already sampled on the grid. The field is
+        sampled only once and shared by all the subgrids.
+    grid      : GridArray
         The grid array for sampling the field.
-    clip : bool
+    clip      : bool
         Should the field be clipped in size to the same extent as the initial
         lens aperture? Setting this to False will sample the transformed field
         across the entire computational grid. Setting it to True sets the field
         outside of the aperture to zero.
+    batched   : bool
+        Transform all the subgrids at once with fftSubgridStack instead of
+        looping over them. This is faster but holds the transforms of all the
+        subgrids in memory at the same time.
+    windowPad : int (odd) or None
+        Only used when batched is True. See fftSubgridStack.
     
     Returns
     -------
-    interpMag   : array of scipy.interpolate.RectBivariateSpline
-    interpPhase : array of scipy.interpolate.RectBivariateSpline
+    interpMag   : array of scipy.interpolate.interp1d
+    interpPhase : array of scipy.interpolate.interp1d
+    
+    Notes
+    -----
+    A GaussianBeam input is always transformed with the closed form of
+    fftSubgridStack, as if batched was True.
+    
     '''
     # Create arrays to hold the interpolations
     interpMag   = []
     interpPhase = []
     
-    for subgridX in range(grid.numSubgrids):
-        # Sample the field at the grid's real locations
-        fieldSample = grid.rect(uIn, subgridX)
+    if batched or isinstance(uIn, GaussianBeam):
+        F, localX, offsets = fftSubgridStack(uIn, grid, clip = clip, windowPad = windowPad)
         
-        # Propagate the field to the MLA
-        # fftPropagate(fieldSample, grid, 200e-3)
+        for currF, offset in zip(F, offsets):
+            newGridX = localX + offset
+            _appendInterpolants(interpMag, interpPhase, newGridX, currF)
+            
+        return interpMag, interpPhase
+    
+    # Sample the field at the grid's real locations once for all subgrids
+    fullSample = grid.sample(uIn)
+    
+    # Scaling factor of the Fourier transform to conserve energy
+    scalingFactor = (grid.physicalSize / (grid.gridSize - 1)) \
+                  / np.sqrt(grid.wavelength * grid.focalLength)
+    
+    for subgridX in range(grid.numSubgrids):
+        # Mask the sampled field outside of the current subgrid
+        fieldSample = grid.rect(fullSample, subgridX)
 
         # Shift the sample to the center of the coordinate system
         shiftX      = int(grid.subgridCenters[subgridX])
         fieldSample = np.roll(fieldSample, -shiftX)
 
-        # Compute the Fourier transform with appropriate scaling to conserve energy
-        scalingFactor = (grid.physicalSize / (grid.gridSize - 1)) \
-                      / np.sqrt(grid.wavelength * grid.focalLength)
-        F             = scalingFactor * fftshift(fft(ifftshift(fieldSample)))
+        # Compute the Fourier transform
+        F = scalingFactor * fftshift(fft(ifftshift(fieldSample)))
         
         # Set the field to zero outside of the extent of a single subgrid
-        F[np.logical_or(grid.x < -np.floor(grid.subgridSize / 2), grid.x > np.floor(grid.subgridSize / 2))] = 0
+        if clip:
+            F[np.logical_or(grid.x < -np.floor(grid.subgridSize / 2), grid.x > np.floor(grid.subgridSize / 2))] = 0
 
         # Shift the grid coordinates back to the original location
         newGridX = grid.pX + (shiftX * grid.physicalSize / grid.gridSize)
 
-        # Find the transform's magnitude and phase for interpolation
-        mag   = np.abs(F)
-        phase = np.angle(F)
-        
-        # Interpolate the transform
-        # kind = 'linear' SHOULD NOT BE USED. This is because it will introduce
-        # artifacts when the phase jumps from zero to +/- pi by interpolating
-        # between the jumps.
-        interpMag.append(interp1d(newGridX,
-                                  mag,
-                                  kind         = 'nearest',
-                                  bounds_error = False,
-                                  fill_value   = 0.0))
-        interpPhase.append(interp1d(newGridX,
-                                    phase,
-                                    kind         = 'nearest',
-                                    bounds_error = False,
-                                    fill_value   = 0.0))           
+        _appendInterpolants(interpMag, interpPhase, newGridX, F)
             
     return interpMag, interpPhase
 
+@instrument('fftpack.fftSubgridStack')
+def fftSubgridStack(uIn, grid, clip = True, windowPad = None):
+    '''Computes the 1D FFTs of all subgrids in a single batched transform.
+    
+    The samples of every subgrid are centered in their own row of a
+    (numSubgrids, N) array, which is then transformed along its rows with one
+    FFT call. By default N is the size of the full zero-padded grid and the
+    result matches fftSubgrid. Setting windowPad transforms only a window
+    around each subgrid, which is much cheaper but samples the focal plane of
+    each lenslet more coarsely.
+    
+    If uIn is a GaussianBeam, the transform of the beam truncated to each
+    subgrid is computed in closed form with the Faddeeva function instead of
+    sampling the beam and computing FFTs.
+    
+    Parameters
+    ----------
+    uIn       : function, 1D array of complex or GaussianBeam
+        A 1D, real or complex valued function defining an input field
+        distribution, or the field already sampled on the grid.
+    grid      : GridArray
+        The grid array for sampling the field.
+    clip      : bool
+        Set the transformed field to zero outside of the extent of a single
+        subgrid. See fftSubgrid.
+    windowPad : int (odd) or None
+        If not None, each subgrid is transformed over a window of
+        windowPad * subgridSize grid locations centered on the subgrid instead
+        of over the full grid.
+        
+    Returns
+    -------
+    F       : 2D array of complex
+        The transforms of the subgrids. Row i belongs to subgrid i.
+    localX  : 1D array of float
+        The focal plane coordinates of the columns of F in physical units,
+        relative to the center of each subgrid.
+    offsets : 1D array of float
+        The offset to add to localX to obtain the coordinates of each row of F
+        on the grid's coordinate system.
+    
+    '''
+    localX     = _subgridFrequencies(grid, windowPad)
+    windowSize = localX.size
+    shifts     = grid.subgridCenters.astype(int)
+    
+    if isinstance(uIn, GaussianBeam):
+        F = _gaussianSubgrids(uIn, grid, localX, clip).astype(grid.complexDtype, copy = False)
+    else:
+        # Sample the field at the grid's real locations once for all subgrids
+        fullSample = grid.sample(uIn)
+        
+        # Copy the samples of each subgrid into the center of its own row
+        sgHalfSize = int(grid.subgridSize // 2)
+        srcInd     = grid.gridSize // 2 + shifts[:, np.newaxis] + np.arange(-sgHalfSize, sgHalfSize + 1)
+        
+        stack = np.zeros((grid.numSubgrids, windowSize), dtype = grid.complexDtype)
+        stack[:, windowSize // 2 - sgHalfSize:windowSize // 2 + sgHalfSize + 1] = fullSample[srcInd]
+        
+        # Compute the Fourier transforms with appropriate scaling to conserve energy
+        scalingFactor = (grid.physicalSize / (grid.gridSize - 1)) \
+                      / np.sqrt(grid.wavelength * grid.focalLength)
+        F             = fftshift(fft(ifftshift(stack, axes = -1), axis = -1, overwrite_x = True), axes = -1)
+        F            *= scalingFactor
+    
+    # Set the field to zero outside of the extent of a single subgrid
+    if clip:
+        F[:, np.logical_not(_subgridAperture(grid, localX))] = 0
+    
+    offsets = shifts * grid.physicalSize / grid.gridSize
+    
+    return F, localX, offsets
+
+def _gaussianSubgrids(beam, grid, localX, clip = True):
+    '''Computes the transforms of a Gaussian beam truncated to each subgrid.
+    
+    Returns
+    -------
+    F : 2D array of complex
+        The transforms in the format of fftSubgridStack. If clip is True,
+        they are only computed inside the extent of a single subgrid and are
+        zero elsewhere.
+    
+    '''
+    scale     = grid.wavelength * grid.focalLength
+    dx        = grid.physicalSize / (grid.gridSize - 1)
+    centers   = grid.subgridCenters.astype(int) * dx
+    halfWidth = (grid.subgridSize // 2 + 0.5) * dx
+    localX    = np.ravel(localX)
+    
+    if clip:
+        columns = np.nonzero(_subgridAperture(grid, localX))[0]
+    else:
+        columns = np.arange(localX.size)
+    
+    F = np.zeros((centers.size, localX.size), dtype = np.complex128)
+    F[:, columns] = truncatedGaussianTransform(beam.alpha, centers, halfWidth, localX[columns] / scale)
+    F *= beam.constant / np.sqrt(scale)
+    
+    return F
+    
+@instrument('fftpack.truncatedGaussianTransform')
+def truncatedGaussianTransform(alpha, centers, halfWidth, freqs):
+    '''Fourier transforms of a Gaussian truncated to windows.
+    
+    Computes
+    
+        integral(exp(alpha * (x + c)**2) * exp(-2j * pi * f * x), x = -h..h)
+        
+    for every window center c and frequency f. The integral is expressed
+    with the Faddeeva function w(z) = exp(-z**2) * erfc(-1j * z), which is
+    only evaluated in the upper half plane where it is bounded, so the
+    result is accurate even where the Gaussian is far from the window.
+    
+    Parameters
+    ----------
+    alpha     : complex
+        The coefficient of x**2 in the exponent of the Gaussian. Its real
+        part must be negative.
+    centers   : 1D array of float
+        The positions c of the window centers relative to the Gaussian's
+        center.
+    halfWidth : float
+        The half width h of the windows.
+    freqs     : 1D array of float
+        The spatial frequencies f at which the transforms are evaluated.
+        
+    Returns
+    -------
+    F : 2D array of complex
+        The transforms with shape (centers.size, freqs.size).
+    
+    '''
+    if np.real(alpha) >= 0:
+        raise ValueError('The real part of alpha must be negative.')
+        
+    c = np.asarray(centers, dtype = np.float64)[:, np.newaxis]
+    f = np.asarray(freqs,   dtype = np.float64)[np.newaxis, :]
+    
+    s  = np.sqrt(-alpha)
+    x0 = -c + 1j * np.pi * f / alpha
+    
+    # exp(s**2 * x0**2) * erf(s * (x - x0)) is split into sign * exp(s**2 * x0**2)
+    # and a remainder proportional to the Gaussian at x, using
+    # erf(z) = sign - exp(-z**2) * w(sign * 1j * z) with sign = +/-1 and
+    # Re(sign * z) >= 0.
+    def edge(x):
+        z    = s * (x - x0)
+        sign = np.where(z.real >= 0, 1, -1)
+        rest = -sign * np.exp(alpha * (x + c)**2 - 2j * np.pi * f * x) * wofz(sign * 1j * z)
+        
+        return sign, rest
+        
+    signLo, restLo = edge(-halfWidth)
+    signHi, restHi = edge(halfWidth)
+    
+    # exp(s**2 * x0**2) including the constant exp(alpha * c**2)
+    full = np.exp(2j * np.pi * f * c + np.pi**2 * f**2 / alpha)
+    
+    return np.sqrt(np.pi) / (2 * s) * ((signHi - signLo) * full + restHi - restLo)
+    
+@instrument('fftpack.fftSubgridDense')
+def fftSubgridDense(uIn, resampler, coherentSum = True):
+    '''Computes the 1D FFT of individual subgrids on a common target grid.
+    
+    fftSubgridDense is equivalent to evaluating the interpolants returned by
+    fftSubgrid at the target coordinates of the resampler and combining their
+    magnitudes and phases, but it returns the complex field directly and
+    reuses the precomputed index map of the resampler instead of building new
+    interpolants for every call.
+    
+    Parameters
+    ----------
+    uIn         : function, 1D array of complex or GaussianBeam
+        A 1D, real or complex valued function defining an input field
+        distribution, or the field already sampled on the grid. The
+        transforms of a GaussianBeam are computed in closed form.
+    resampler   : SubgridResampler
+        The map from the focal planes of the subgrids onto the target grid.
+    coherentSum : bool
+        Return the sum of the fields from all the subgrids. If False, the field
+        of each subgrid is returned in its own row.
+        
+    Returns
+    -------
+    field : 1D or 2D array of complex
+        The field on the target grid.
+    
+    '''
+    F, _, _ = fftSubgridStack(uIn,
+                              resampler.grid,
+                              clip      = resampler.clip,
+                              windowPad = resampler.windowPad)
+    
+    return resampler(F, coherentSum = coherentSum)
+    
+class SubgridResampler(object):
+    '''Maps the transforms of individual subgrids onto a common target grid.
+    
+    The map reproduces nearest-neighbor interpolation with scipy's interp1d and
+    a fill value of zero outside of each subgrid's coordinates. It is computed
+    once and may be applied to any number of transforms produced by
+    fftSubgridStack with the same grid and window.
+    
+    '''
+    @instrument('fftpack.SubgridResampler.build')
+    def __init__(self, grid, targetX, clip = True, windowPad = None):
+        '''Computes the index map from the subgrid transforms to the target.
+        
+        Parameters
+        ----------
+        grid      : GridArray
+            The grid array on which the subgrids are transformed.
+        targetX   : 1D array of float
+            The coordinates of the target grid in physical units. They must be
+            sorted in increasing order.
+        clip      : bool
+            Only map the samples inside the extent of a single subgrid. This
+            is equivalent to clipping the transforms (see fftSubgrid) and
+            makes the map smaller.
+        windowPad : int (odd) or None
+            The window size used to transform the subgrids. See
+            fftSubgridStack.
+            
+        '''
+        targetX = np.asarray(targetX)
+        if np.any(np.diff(targetX) < 0):
+            raise ValueError('targetX must be sorted in increasing order.')
+        
+        self.grid      = grid
+        self.targetX   = targetX
+        self.clip      = clip
+        self.windowPad = windowPad
+        
+        localX  = _subgridFrequencies(grid, windowPad)
+        offsets = grid.subgridCenters.astype(int) * grid.physicalSize / grid.gridSize
+        
+        # Indexes of the first and last transformed samples to map
+        if clip:
+            support = np.nonzero(_subgridAperture(grid, localX))[0]
+            lo, hi  = support[0], support[-1]
+        else:
+            lo, hi  = 0, localX.size - 1
+        
+        self._maps = []
+        for offset in offsets:
+            start, stop, ind = _nearestMap(localX + offset, targetX)
+            
+            # Drop the target points that map outside of the aperture
+            first = np.searchsorted(ind, lo, side = 'left')
+            last  = np.searchsorted(ind, hi, side = 'right')
+            
+            self._maps.append((start + first, start + last, ind[first:last].astype(np.int32)))
+            
+    @instrument('fftpack.SubgridResampler')
+    def __call__(self, F, coherentSum = True):
+        '''Resamples the transforms of the subgrids onto the target grid.
+        
+        Parameters
+        ----------
+        F           : 2D array of complex
+            The transforms of the subgrids as returned by fftSubgridStack.
+        coherentSum : bool
+            Return the sum of the fields from all the subgrids. If False, the
+            field of each subgrid is returned in its own row.
+            
+        Returns
+        -------
+        field : 1D or 2D array of complex
+            The field on the target grid.
+        
+        '''
+        if coherentSum:
+            field = np.zeros(self.targetX.size, dtype = F.dtype)
+            for currF, (start, stop, ind) in zip(F, self._maps):
+                field[start:stop] += currF[ind]
+        else:
+            field = np.zeros((len(self._maps), self.targetX.size), dtype = F.dtype)
+            for currField, currF, (start, stop, ind) in zip(field, F, self._maps):
+                currField[start:stop] = currF[ind]
+                
+        return field
+
+class NearestResampler(object):
+    '''Resamples fields from one grid onto another with nearest neighbors.
+    
+    The result is the same as that of scipy's interp1d with kind = 'nearest'
+    and a fill value of zero, applied to the complex field, but the index map
+    is computed once and reused for every field.
+    
+    '''
+    @instrument('fftpack.NearestResampler.build')
+    def __init__(self, srcX, targetX):
+        '''Computes the index map from the source to the target grid.
+        
+        Parameters
+        ----------
+        srcX    : 1D array of float
+            The coordinates of the source grid, sorted in increasing order.
+        targetX : 1D array of float
+            The coordinates of the target grid, sorted in increasing order.
+            
+        '''
+        self.srcX    = np.ravel(srcX)
+        self.targetX = np.ravel(targetX)
+        
+        self._start, self._stop, self._ind = _nearestMap(self.srcX, self.targetX)
+        
+    @instrument('fftpack.NearestResampler')
+    def __call__(self, field, out = None):
+        '''Resamples a field sampled on the source grid.
+        
+        Parameters
+        ----------
+        field : 1D array of complex
+            The field on the source grid.
+        out   : 1D array of complex or None
+            The array in which the resampled field is written.
+        
+        Returns
+        -------
+        fieldOut : 1D array of complex
+            The field on the target grid.
+            
+        '''
+        if out is None:
+            out = np.zeros(self.targetX.size, dtype = field.dtype)
+        else:
+            out[:self._start] = 0
+            out[self._stop:]  = 0
+        
+        np.take(field, self._ind, out = out[self._start:self._stop])
+        
+        return out
+
+def _nearestMap(srcX, targetX):
+    '''Finds the nearest source samples of sorted target coordinates.
+    
+    Returns
+    -------
+    start, stop : int
+        The target points outside of targetX[start:stop] lie outside of the
+        source coordinates.
+    ind         : 1D array of int
+        The index of the nearest source sample of each point in
+        targetX[start:stop]. Ties go to the left neighbor as in interp1d.
+    
+    '''
+    start = np.searchsorted(targetX, srcX[0],  side = 'left')
+    stop  = np.searchsorted(targetX, srcX[-1], side = 'right')
+    
+    bounds = srcX / 2.0
+    bounds = bounds[1:] + bounds[:-1]
+    ind    = np.searchsorted(bounds, targetX[start:stop], side = 'left')
+    ind    = ind.clip(0, srcX.size - 1)
+    
+    return start, stop, ind
+
+def _subgridFrequencies(grid, windowPad):
+    '''Returns the focal plane coordinates of a transformed subgrid window.
+    
+    '''
+    if windowPad is None:
+        return grid.pX.ravel()
+    
+    if (not isinstance(windowPad, int)) or isEven(windowPad) or (windowPad <= 0):
+        raise ImproperGridSizeException('windowPad parameter is not an odd, positive integer.')
+    
+    windowSize = windowPad * grid.subgridSize
+    dx         = grid.physicalSize / (grid.gridSize - 1)
+    
+    return Grid(windowSize, (windowSize - 1) * dx, grid.wavelength, grid.focalLength, dim = 1).pX
+    
+def _subgridAperture(grid, localX):
+    '''Returns True where the transform of a subgrid lies within a single subgrid.
+    
+    '''
+    # Half a sample of the full grid's transform is added to avoid rounding
+    # issues when comparing with the edge of the subgrid.
+    halfWidth = (np.floor(grid.subgridSize / 2) + 0.5) * grid.wavelength * grid.focalLength / grid.physicalSize
+    
+    return np.abs(localX) <= halfWidth
+    
+@instrument('fftpack.interpolants')
+def _appendInterpolants(interpMag, interpPhase, newGridX, F):
+    '''Appends nearest-neighbor interpolants of a transform's magnitude and phase.
+    
+    '''
+    # Find the transform's magnitude and phase for interpolation
+    mag   = np.abs(F)
+    phase = np.angle(F)
+    
+    # Interpolate the transform
+    # kind = 'linear' SHOULD NOT BE USED. This is because it will introduce
+    # artifacts when the phase jumps from zero to +/- pi by interpolating
+    # between the jumps.
+    interpMag.append(interp1d(newGridX,
+                              mag,
+                              kind         = 'nearest',
+                              bounds_error = False,
+                              fill_value   = 0.0))
+    interpPhase.append(interp1d(newGridX,
+                                phase,
+                                kind         = 'nearest',
+                                bounds_error = False,
+                                fill_value   = 0.0))
+
+@instrument('fftpack.fft2Subgrid')
 def fft2Subgrid(uIn, grid):
     '''Computes the 2D FFT of individual subgrids.
     
@@ -89,9 +512,10 @@ def fft2Subgrid(uIn, grid):
         
     Parameters
     ----------
-    uIn  : function
+    uIn  : function or 2D array of complex
         A 2D, real or complex valued function defining an input field
-        distribution.
+        distribution, or the field already sampled on the grid. The field is
+        sampled only once and shared by all the subgrids.
     grid : GridArray
         The grid array for sampling the field.
     
@@ -104,33 +528,35 @@ def fft2Subgrid(uIn, grid):
     interpMag   = []
     interpPhase = []
     
+    # Sample the field at the grid's real locations once for all subgrids
+    fullSample = grid.sample(uIn)
+    
+    # Scaling factor of the Fourier transform to conserve energy
+    scalingFactor = ((grid.physicalSize / (grid.gridSize - 1)) ** 2) \
+                  / (grid.wavelength * grid.focalLength)
+    
     for subgridX in range(grid.numSubgrids):
         for subgridY in range(grid.numSubgrids):
     
-            # Sample the field at the grid's real locations
-            fieldSample = grid.rect2(uIn, subgridX, subgridY)
+            # Mask the sampled field outside of the current subgrid
+            fieldSample = grid.rect2(fullSample, subgridX, subgridY)
 
             # Shift the sample to the center of the coordinate system
             shiftX, shiftY = int(grid.subgridCenters[subgridX]), int(grid.subgridCenters[subgridY])
             fieldSample    = np.roll(np.roll(fieldSample, -shiftX, axis=1), -shiftY, axis = 0)
 
-            # Compute the Fourier transform with appropriate scaling to conserve energy
-            scalingFactor = ((grid.physicalSize / (grid.gridSize - 1)) ** 2) \
-                          / (grid.wavelength * grid.focalLength)
-            F             = scalingFactor * fftshift(fft2(ifftshift(fieldSample)))
+            # Compute the Fourier transform
+            F = scalingFactor * fftshift(fft2(ifftshift(fieldSample)))
 
             # Shift the grid coordinates back to the original location
-            newGridX = grid.pX + (shiftX * grid.physicalSize / grid.gridSize)
-            newGridY = grid.pY + (shiftY * grid.physicalSize / grid.gridSize)
+            # The grid stores 1D coordinate vectors, as required by RectBivariateSpline
+            xx = grid.pX.ravel() + (shiftX * grid.physicalSize / grid.gridSize)
+            yy = grid.pY.ravel() + (shiftY * grid.physicalSize / grid.gridSize)
 
             # Find the transform's magnitude and phase for interpolation
             mag   = np.abs(F)
             phase = np.angle(F)
 
-            # Reduce the grid to 1D arrays to use more efficient RectBivariateSpline
-            xx = np.sort(np.unique(newGridX))
-            yy = np.sort(np.unique(newGridY))
-
             # Interpolate the transform
             # NOTE: RectBivariateSpline associates X with rows and Y with columns!
             interpMag.append(RectBivariateSpline(yy, xx, mag))
@@ -138,6 +564,260 @@ def fft2Subgrid(uIn, grid):
     
     return interpMag, interpPhase
     
+@instrument('fftpack.fft2SubgridDense')
+def fft2SubgridDense(uIn, resampler, batchSize = None, out = None):
+    '''Computes the 2D FFT of individual subgrids on a common target grid.
+    
+    Each subgrid is transformed over a square window centered on it (see the
+    windowPad argument of SubgridResampler2D), and the transforms are
+    scattered into a single output array with nearest-neighbor sampling.
+    Subgrids are transformed in batches so that the memory use stays close to
+    the size of the output array. Because the complex field is sampled
+    directly, there is no interpolation of the phase across its +/- pi jumps.
+    
+    Parameters
+    ----------
+    uIn       : function, 2D array of complex or GaussianBeam
+        A 2D, real or complex valued function defining an input field
+        distribution, or the field already sampled on the grid. The
+        transforms of a 2D GaussianBeam are computed in closed form.
+    resampler : SubgridResampler2D
+        The map from the focal planes of the subgrids onto the target grid.
+    batchSize : int or None
+        The number of subgrids transformed together. Defaults to the number
+        of windows that fit in about 2**22 complex values.
+    out       : 2D array of complex or None
+        The array in which the field is written. It must have the shape
+        (targetY.size, targetX.size) of the resampler.
+        
+    Returns
+    -------
+    field : 2D array of complex
+        The sum of the fields from all the subgrids on the target grid.
+    
+    '''
+    grid       = resampler.grid
+    windowSize = _subgridFrequencies(grid, resampler.windowPad).size
+    sgHalfSize = grid.subgridSize // 2
+    window     = slice(windowSize // 2 - sgHalfSize, windowSize // 2 + sgHalfSize + 1)
+    
+    if batchSize is None:
+        batchSize = max(1, 2**22 // windowSize**2)
+        
+    shape = (resampler.y.targetX.size, resampler.x.targetX.size)
+    if out is None:
+        out = np.zeros(shape, dtype = grid.complexDtype)
+    elif out.shape != shape:
+        raise ValueError('out has shape {0} but the target grid has shape {1}.'.format(out.shape, shape))
+    else:
+        out[...] = 0
+    
+    if isinstance(uIn, GaussianBeam):
+        return _gaussianSubgridDense2D(uIn, resampler, out)
+    
+    # Sample the field at the grid's real locations once for all subgrids
+    fullSample = grid.sample(uIn)
+    
+    # Scaling factor of the Fourier transform to conserve energy
+    scalingFactor = ((grid.physicalSize / (grid.gridSize - 1)) ** 2) \
+                  / (grid.wavelength * grid.focalLength)
+    
+    subgrids = [(subgridY, subgridX) for subgridY in range(grid.numSubgrids)
+                                     for subgridX in range(grid.numSubgrids)]
+    for start in range(0, len(subgrids), batchSize):
+        batch = subgrids[start:start + batchSize]
+        
+        # Center the samples of each subgrid in its own window
+        stack = np.zeros((len(batch), windowSize, windowSize), dtype = grid.complexDtype)
+        for currWindow, (subgridY, subgridX) in zip(stack, batch):
+            currWindow[window, window] = fullSample[grid.subgridSlice(subgridY), grid.subgridSlice(subgridX)]
+        
+        F  = fftshift(fft2(ifftshift(stack, axes = (-2, -1)), axes = (-2, -1), overwrite_x = True), axes = (-2, -1))
+        F *= scalingFactor
+        
+        # Scatter the transforms onto the target grid
+        for currF, (subgridY, subgridX) in zip(F, batch):
+            startY, stopY, indY = resampler.y._maps[subgridY]
+            startX, stopX, indX = resampler.x._maps[subgridX]
+            
+            out[startY:stopY, startX:stopX] += currF[np.ix_(indY, indX)]
+            
+    return out
+    
+def _gaussianSubgridDense2D(beam, resampler, out):
+    '''Scatters the closed-form transforms of a circular Gaussian beam.
+    
+    The transform of a circular Gaussian truncated to a square subgrid is the
+    product of two 1D transforms, so only one table of 1D transforms per
+    subgrid row and column is computed.
+    
+    '''
+    grid   = resampler.grid
+    localX = _subgridFrequencies(grid, resampler.windowPad)
+    
+    # The beam's constant is applied once to the 2D product
+    table = _gaussianSubgrids(GaussianBeam.fromParameters(beam.q, 1, beam.wavelength), grid, localX,
+                              resampler.x.clip)
+    table = table.astype(grid.complexDtype, copy = False)
+    const = beam.constant
+    
+    for subgridY in range(grid.numSubgrids):
+        startY, stopY, indY = resampler.y._maps[subgridY]
+        rowY = const * table[subgridY, indY]
+        
+        for subgridX in range(grid.numSubgrids):
+            startX, stopX, indX = resampler.x._maps[subgridX]
+            
+            out[startY:stopY, startX:stopX] += np.outer(rowY, table[subgridX, indX])
+            
+    return out
+    
+class SubgridResampler2D(object):
+    '''Maps the 2D transforms of individual subgrids onto a common target grid.
+    
+    Nearest-neighbor sampling is separable, so the map is the pair of 1D
+    SubgridResamplers along x and y.
+    
+    '''
+    def __init__(self, grid, targetX, targetY = None, clip = True, windowPad = None):
+        '''Computes the index maps from the subgrid transforms to the target.
+        
+        Parameters
+        ----------
+        grid      : GridArray
+            The 2D grid array on which the subgrids are transformed.
+        targetX   : 1D array of float
+            The x-coordinates of the target grid in physical units, sorted in
+            increasing order.
+        targetY   : 1D array of float or None
+            The y-coordinates of the target grid. Defaults to targetX.
+        clip      : bool
+            Only map the samples inside the extent of a single subgrid.
+        windowPad : int (odd) or None
+            Each subgrid is transformed over a square window with
+            windowPad * subgridSize grid locations along each side. None uses
+            the full grid, which is only practical for small grids.
+            
+        '''
+        if targetY is None:
+            targetY = targetX
+        
+        self.grid      = grid
+        self.clip      = clip
+        self.windowPad = windowPad
+        
+        self.x = SubgridResampler(grid, np.ravel(targetX), clip = clip, windowPad = windowPad)
+        self.y = SubgridResampler(grid, np.ravel(targetY), clip = clip, windowPad = windowPad)
+
+def fftFullAperture(uIn, grid, clip = True, padFactor = 1):
+    '''Computes the field beyond a pair of microlens arrays with one propagation.
+
+    See FullApertureMLA.
+
+    '''
+    return FullApertureMLA(grid, clip = clip, padFactor = padFactor)(uIn)
+
+class FullApertureMLA(object):
+    '''Models a pair of microlens arrays over the full aperture of a GridArray.
+
+    The field is multiplied by the transmission of the first array, i.e. the
+    apertures of the subgrids and the phase exp(-j * pi * r**2 /
+    (wavelength * focalLength)) about the center of every lenslet, and
+    propagated over one focal length to the second array with the
+    band-limited angular spectrum method. The identical phase of the second
+    array cancels the curvature left by the propagation, so that the field
+    beyond it is the Fourier transform of every lenslet as in fftSubgrid and
+    fftSubgridDense, on the coordinates px of the grid.
+
+    The cost is two FFTs of the full grid whatever the number of lenslets.
+    Unlike fftSubgrid, the light diffracted by a lenslet beyond its own
+    subgrid interferes with that of its neighbors instead of being clipped.
+    Both models agree when the transforms of the lenslets are small compared
+    to the subgrids; the Full Aperture MLA Verification notebook compares
+    them.
+
+    The lenslet phase must be sampled by the grid, i.e. its spacing must be
+    smaller than wavelength * focalLength / (subgrid width).
+
+    '''
+    def __init__(self, grid, clip = True, padFactor = 1):
+        '''Precomputes the transmission of the arrays and the propagation kernel.
+
+        Parameters
+        ----------
+        grid      : GridArray
+            The 1D or 2D grid array of the microlens arrays. Its focal length
+            is the one of the lenslets.
+        clip      : bool
+            Set the field outside of the second array to zero, like the clip
+            argument of fftSubgrid. If False, the field outside of the second
+            array keeps the curvature of the propagation.
+        padFactor : float
+            See propagation.BandLimitedPropagator. The zero padding of the
+            GridArray usually makes further padding unnecessary.
+
+        '''
+        self.grid = grid
+        self.clip = clip
+
+        # The transmission is separable, so only its 1D profile is stored
+        dx       = grid.physicalSize / (grid.gridSize - 1)
+        aperture = np.zeros(grid.gridSize, dtype = bool)
+        localX   = np.zeros(grid.gridSize)
+        for ind in range(grid.numSubgrids):
+            subgrid           = grid.subgridSlice(ind)
+            aperture[subgrid] = True
+            localX[subgrid]   = dx * np.arange(-(grid.subgridSize // 2), grid.subgridSize // 2 + 1)
+
+        phase = np.exp(-1j * np.pi * localX**2 / (grid.wavelength * grid.focalLength))
+
+        self.transmission = np.where(aperture, phase, 0).astype(grid.complexDtype)
+        if clip:
+            self._secondArray = self.transmission
+        else:
+            self._secondArray = np.where(aperture, phase, 1).astype(grid.complexDtype)
+
+        self.propagator = BandLimitedPropagator(grid, grid.focalLength, padFactor = padFactor)
+
+        # The constant phase exp(j * k * f) / sqrt(j)**dim of the propagation
+        # is removed so that the field equals the one of fftSubgrid
+        self._constant = np.exp(-2j * np.pi * grid.focalLength / grid.wavelength) * np.sqrt(1j)**grid.dim
+
+    @instrument('fftpack.FullApertureMLA')
+    def __call__(self, uIn):
+        '''Computes the field beyond the second microlens array.
+
+        Parameters
+        ----------
+        uIn : function or array of complex
+            A real or complex valued function defining the input field
+            distribution, or the field already sampled on the grid.
+
+        Returns
+        -------
+        field : 1D or 2D array of complex
+            The field beyond the second array on the coordinates of the grid.
+
+        '''
+        field = np.array(self.grid.sample(uIn), dtype = self.grid.complexDtype)
+        _applySeparable(field, self.transmission)
+
+        field = self.propagator(field)
+        _applySeparable(field, self._secondArray)
+
+        field *= self._constant
+
+        return field
+
+def _applySeparable(field, profile):
+    '''Multiplies a 1D or 2D field in place by a separable transmission given by its 1D profile.
+
+    '''
+    field *= profile
+    if field.ndim == 2:
+        field *= profile[:, np.newaxis]
+
+@instrument('fftpack.fftPropagate')
 def fftPropagate(field, grid, propDistance):
     '''Propagates a sampled 1D field along the optical axis.
     
@@ -147,28 +827,163 @@ def fftPropagate(field, grid, propDistance):
     recomibining the propagated spectral components. The angular spectrum is
     computed using a FFT.
     
+    The propagation kernels are cached in kernelCache, so repeated calls with
+    the same grid and distance only compute the two FFTs.
+    
     Parameters
     ----------
     field        : 1D array of complex
         The sampled field to propagate.
     grid         : Grid
         The grid on which the sampled field lies.
-    propDistance : float
+    propDistance : float or sequence of float
         The distance to propagate the field in the same physical units as the
-        grid.
+        grid. A sequence of distances is chained into a single propagation.
+        
+    Returns
+    -------
+    fieldProp : 1D array of complex or GaussianBeam
+        The propagated field. A GaussianBeam is propagated analytically and
+        the propagated GaussianBeam is returned.
     
     '''
-    scalingFactor = (grid.physicalSize / (grid.gridSize - 1))
-    F             = scalingFactor * fftshift(fft(ifftshift(field)))
+    if isinstance(field, GaussianBeam):
+        return field.propagate(float(np.sum(propDistance)))
+    
+    return Propagator(grid, propDistance)(field)
+    
+class Propagator(object):
+    '''Propagates sampled 1D fields on a fixed grid over a fixed distance.
+    
+    The propagation kernel is stored in FFT-native ordering. Because a
+    circular shift commutes with the multiplication by the kernel, the
+    propagated field is simply ifft(kernel * fft(field)) and no fftshift or
+    ifftshift calls are needed.
+    
+    '''
+    def __init__(self, grid, propDistance, cache = True):
+        '''Prepares the propagation kernel.
+        
+        Parameters
+        ----------
+        grid         : Grid
+            The grid on which the sampled fields lie.
+        propDistance : float or sequence of float
+            The distance to propagate the fields. A sequence of distances is
+            chained into one kernel.
+        cache        : bool
+            Get the kernel from kernelCache instead of computing it.
+            
+        '''
+        self.grid         = grid
+        self.propDistance = float(np.sum(propDistance))
+        
+        if cache:
+            self.kernel = kernelCache.get(grid, self.propDistance)
+        else:
+            self.kernel = propagationKernel(grid, self.propDistance)
+            
+    @instrument('fftpack.Propagator')
+    def __call__(self, field):
+        '''Propagates a sampled field.
+        
+        Parameters
+        ----------
+        field : 1D array of complex or GaussianBeam
+            The sampled field to propagate.
+            
+        Returns
+        -------
+        fieldProp : 1D array of complex or GaussianBeam
+            The propagated field. GaussianBeams are propagated analytically.
+            
+        '''
+        if isinstance(field, GaussianBeam):
+            return field.propagate(self.propDistance)
+        
+        spectrum  = fft(field)
+        spectrum *= self.kernel
+        
+        return ifft(spectrum, overwrite_x = True)
+        
+@instrument('fftpack.propagationKernel')
+def propagationKernel(grid, propDistance):
+    '''Computes the angular spectrum propagation kernel in FFT-native ordering.
     
+    Parameters
+    ----------
+    grid         : Grid
+        The grid on which the sampled field lies.
+    propDistance : float
+        The distance to propagate the field.
+        
+    Returns
+    -------
+    kernel : 1D array of complex
+        The transfer function exp(j * kz * L) ordered like the output of fft.
+        It is computed in double precision and returned with the precision of
+        the grid.
+    
+    '''
     # Compute the z-component of the wavevector
     # Adding 0j ensures that numpy.sqrt returns complex numbers
-    kz = 2 * np.pi * np.sqrt(1 - (grid.pfX * grid.wavelength)**2 + 0j) / grid.wavelength
-    kz.imag=np.zeros(np.shape(kz)) 
-    # Propagate the field's spectral components
-    Fprop = F * np.exp(1j * kz * propDistance)
+    kz = 2 * np.pi * np.sqrt(1 - (ifftshift(grid.pfX) * grid.wavelength)**2 + 0j) / grid.wavelength
+    kz.imag = np.zeros(np.shape(kz))
+    
+    return np.exp(1j * kz * propDistance).astype(grid.complexDtype, copy = False)
     
-    # Recombine the spectral components
-    fieldProp = fftshift(ifft(ifftshift(Fprop))) / scalingFactor
+class KernelCache(object):
+    '''A least-recently used cache of propagation kernels with a memory bound.
     
-    return fieldProp
+    Kernels are keyed on the grid geometry (size, physical size and
+    wavelength), the grid's precision and the propagation distance.
+    
+    '''
+    def __init__(self, maxBytes = 512 * 2**20):
+        '''Creates an empty cache.
+        
+        Parameters
+        ----------
+        maxBytes : int
+            The maximum memory held by the cached kernels. The least recently
+            used kernels are discarded first when it is exceeded.
+            
+        '''
+        self.maxBytes = maxBytes
+        self.nbytes   = 0
+        self._kernels = OrderedDict()
+        
+    def __len__(self):
+        return len(self._kernels)
+        
+    def get(self, grid, propDistance):
+        '''Returns the kernel for the grid and distance, computing it if needed.
+        
+        '''
+        key = (grid.gridSize, grid.physicalSize, grid.wavelength, grid.precision, propDistance)
+        
+        if key in self._kernels:
+            self._kernels.move_to_end(key)
+            return self._kernels[key]
+        
+        kernel = propagationKernel(grid, propDistance)
+        kernel.setflags(write = False)
+        
+        if kernel.nbytes <= self.maxBytes:
+            self._kernels[key] = kernel
+            self.nbytes       += kernel.nbytes
+            
+            while self.nbytes > self.maxBytes:
+                _, oldKernel = self._kernels.popitem(last = False)
+                self.nbytes -= oldKernel.nbytes
+            
+        return kernel
+        
+    def clear(self):
+        '''Discards all the cached kernels.
+        
+        '''
+        self._kernels.clear()
+        self.nbytes = 0
+        
+kernelCache = KernelCache()
@@ -3,21 +3,61 @@
 # See the LICENSE.docx file for more details.
 
 import numpy as np
-from numpy.fft import fft, fftshift, ifft, ifftshift
+from SimMLA.fftbackend import fft, fftshift, ifft, ifftshift
+from SimMLA.instrumentation import instrument
+from SimMLA.precision  import complexType, realType
 
 def GaussianBeamWaistProfile(amplitude, beamStd):
-    '''
+    '''Returns the profile of a Gaussian beam at its waist.
+    
     Returns
     -------        
-    profile : numpy vectorized function
-        A function describing the 1D beam profile.
+    profile : function
+        profile(x, out = None, dtype = None) evaluates the 1D beam profile at
+        the array of coordinates x. The result is written into out if it is
+        given; otherwise a new array of type dtype (default float64) is
+        returned.
         
     '''
-    profile = lambda x: amplitude * np.exp(-x**2 / 2 / beamStd**2)
-    profile = np.vectorize(profile)
+    @instrument('fields.GaussianBeamWaistProfile')
+    def profile(x, out = None, dtype = None):
+        out = _output(np.shape(x), out, dtype, np.float64)
+        
+        # amplitude * exp(-x**2 / 2 / beamStd**2) without temporary arrays
+        np.square(x, out = out)
+        np.negative(out, out = out)
+        out /= 2 * beamStd**2
+        np.exp(out, out = out)
+        out *= amplitude
+        
+        return out
     
     return profile
     
+def GaussianBeamWaistProfile2D(amplitude, beamStd):
+    '''Returns the profile of a circular Gaussian beam at its waist.
+    
+    The profile is separable and is evaluated on x and y separately before
+    the two factors are broadcast against each other. Passing a row vector
+    of x coordinates and a column vector of y coordinates (for example the
+    coordinates of a 2D Grid) therefore only evaluates the exponential on the
+    1D coordinate vectors.
+    
+    Returns
+    -------
+    profile : function
+        profile(x, y, out = None, dtype = None) evaluates the 2D beam profile
+        at the broadcastable arrays of coordinates x and y.
+    
+    '''
+    profileX = GaussianBeamWaistProfile(amplitude, beamStd)
+    profileY = GaussianBeamWaistProfile(1, beamStd)
+    
+    def profile(x, y, out = None, dtype = None):
+        return _separable(profileX, profileY, x, y, out, dtype, np.float64)
+        
+    return profile
+    
 def GaussianBeamDefocused(amplitude, beamStd, wavelength, position):
     '''Returns the field from a Gaussian beam in an arbitrary plane.
     
@@ -31,6 +71,38 @@ def GaussianBeamDefocused(amplitude, beamStd, wavelength, position):
     wavelength : float
     position   : float
         The axial position of the observation plane relative to the waist.
+        
+    Returns
+    -------
+    profile : function
+        profile(x, out = None, dtype = None) evaluates the 1D field at the
+        array of coordinates x. The result is written into out if it is given;
+        otherwise a new array of type dtype (default complex128) is returned.
+    
+    '''
+    return _defocusedProfile(amplitude, beamStd, wavelength, position, dim = 1)
+    
+def GaussianBeamDefocused2D(amplitude, beamStd, wavelength, position):
+    '''Returns the field from a circular Gaussian beam in an arbitrary plane.
+    
+    The parameters are the same as those of GaussianBeamDefocused. The
+    returned function profile(x, y, out = None, dtype = None) is separable
+    and is evaluated like that of GaussianBeamWaistProfile2D.
+    
+    '''
+    profileX = _defocusedProfile(amplitude, beamStd, wavelength, position, dim = 2)
+    profileY = _defocusedProfile(1, beamStd, wavelength, position, dim = 0)
+    
+    def profile(x, y, out = None, dtype = None):
+        return _separable(profileX, profileY, x, y, out, dtype, np.complex128)
+        
+    return profile
+    
+def _defocusedProfile(amplitude, beamStd, wavelength, position, dim):
+    '''Returns a 1D factor of the field of a defocused Gaussian beam.
+    
+    The amplitude and the constant phase are set for a beam of dimension dim.
+    dim = 0 returns the factor without them.
     
     '''
     # Compute the beam's waist from the standard deviation
@@ -43,12 +115,68 @@ def GaussianBeamDefocused(amplitude, beamStd, wavelength, position):
     beamRoc   = _roc(position, waist, wavelength)
     gouyPhase = _gouyPhase(position, waist, wavelength)
     
-    profile = lambda x: amplitude * np.sqrt(waist / beamRad) \
-                      * np.exp(-x**2 / beamRad**2)  \
-                      * np.exp(1j * wavenumber * position \
-                             + 1j * wavenumber * x**2 / 2 / beamRoc \
-                             - 1j * gouyPhase)
+    # The wavefront is flat at the waist, where _roc returns zero
+    curvature = 0 if beamRoc == 0 else 1 / beamRoc
+    
+    # field = constant * exp(exponent * x**2)
+    exponent = -1 / beamRad**2 + 1j * wavenumber * curvature / 2
+    if dim == 0:
+        constant = 1
+    else:
+        constant = amplitude * (waist / beamRad)**(dim / 2) \
+                 * np.exp(1j * wavenumber * position - 1j * gouyPhase)
+    
+    @instrument('fields.GaussianBeamDefocused')
+    def profile(x, out = None, dtype = None):
+        out = _output(np.shape(x), out, dtype, np.complex128)
+        
+        np.square(x, out = out)
+        out *= exponent
+        np.exp(out, out = out)
+        out *= constant
+        
+        return out
+    
     return profile
+    
+def _separable(profileX, profileY, x, y, out, dtype, defaultDtype):
+    '''Evaluates a separable 2D profile as the product of two 1D profiles.
+    
+    '''
+    if dtype is None:
+        dtype = _policyDtype(defaultDtype) if out is None else out.dtype
+    
+    fieldX = profileX(x, dtype = dtype)
+    fieldY = profileY(y, dtype = dtype)
+    
+    out = _output(np.broadcast_shapes(np.shape(x), np.shape(y)), out, dtype, dtype)
+    
+    return np.multiply(fieldX, fieldY, out = out)
+    
+def _output(shape, out, dtype, defaultDtype):
+    '''Returns the array in which a field is evaluated.
+    
+    A new array is created if out is None. dtype is ignored if out is given.
+    If both are None, the array has the current precision (see
+    SimMLA.precision) and the kind, real or complex, of defaultDtype.
+    
+    '''
+    if out is None:
+        return np.empty(shape, dtype = _policyDtype(defaultDtype) if dtype is None else dtype)
+    
+    if out.shape != tuple(shape):
+        raise ValueError('out has shape {0} but the field has shape {1}.'.format(out.shape, tuple(shape)))
+    
+    return out
+    
+def _policyDtype(defaultDtype):
+    '''Returns the dtype of the current precision with the kind of defaultDtype.
+    
+    '''
+    if np.dtype(defaultDtype).kind == 'c':
+        return complexType()
+    
+    return realType()
 
 def _wz(position, waist, wavelength):
     '''Computes the beam's radius at an arbitrary axial position.
@@ -84,14 +212,178 @@ def _gouyPhase(position, waist, wavelength):
     gouyPhase = np.arctan(position / zR)
     return gouyPhase
 
+class GaussianBeam(object):
+    '''A coherent Gaussian beam that is propagated analytically.
+    
+    The beam is described by its complex beam parameter q and a complex
+    constant, such that its field along each transverse dimension is
+    
+        u(x) = constant * exp(1j * k * x**2 / (2 * q))
+        
+    with q = z - 1j * zR a distance z after the waist. Free space, thin lenses
+    and the Fourier transforms by lenses map Gaussian beams onto Gaussian
+    beams, so these operations only update q and the constant (ABCD law)
+    instead of transforming sampled fields. The paraxial approximation is
+    assumed.
+    
+    A GaussianBeam is also a field function: beam(x) (or beam(x, y) in 2D)
+    samples it. In 1D the samples equal those of GaussianBeamDefocused up to
+    a constant (Gouy) phase, so both give the same irradiance. Any routine
+    that does not recognize a GaussianBeam falls back to the sampled field,
+    whereas fftPropagate, fftSubgridStack, fftSubgridDense and
+    fft2SubgridDense use the closed forms.
+    
+    '''
+    def __init__(self, amplitude, beamStd, wavelength, position = 0, dim = 1):
+        '''Creates a beam with the irradiance of GaussianBeamDefocused.
+        
+        The constant is amplitude * (q0 / q)**(dim / 2) * exp(1j * k * z),
+        where q0 = -1j * zR is the beam parameter at the waist, like the
+        constant of propagate. A 1D beam therefore has half the Gouy phase of
+        GaussianBeamDefocused, which uses the Gouy phase of a 2D beam in 1D;
+        the two fields differ by a constant phase.
+        
+        Parameters
+        ----------
+        amplitude  : float
+            The amplitude of the beam at its waist.
+        beamStd    : float
+            The standard deviation of the beam's waist.
+        wavelength : float
+        position   : float
+            The axial position of the observation plane relative to the waist.
+        dim        : int
+            1 for a 1D beam, 2 for a circular 2D beam.
+            
+        '''
+        waist = np.sqrt(2) * beamStd
+        zR    = np.pi * waist**2 / wavelength
+        
+        self.wavelength = wavelength
+        self.dim        = dim
+        self.q          = complex(position, -zR)
+        self.constant   = complex(amplitude * (complex(0, -zR) / self.q)**(dim / 2)
+                                  * np.exp(1j * 2 * np.pi / wavelength * position))
+    
+    @classmethod
+    def fromParameters(cls, q, constant, wavelength, dim = 1):
+        '''Creates a beam from its complex beam parameter and constant.
+        
+        '''
+        beam            = cls.__new__(cls)
+        beam.wavelength = wavelength
+        beam.dim        = dim
+        beam.q          = complex(q)
+        beam.constant   = complex(constant)
+        
+        return beam
+        
+    @instrument('fields.GaussianBeam')
+    def __call__(self, x, y = None, out = None, dtype = None):
+        '''Samples the field at the coordinates x (and y for 2D beams).
+        
+        The arguments and result are those of the functions returned by
+        GaussianBeamDefocused and GaussianBeamDefocused2D.
+        
+        '''
+        if self.dim == 1:
+            return self._profile(x, out, dtype, self.constant)
+        
+        profileX = lambda x, out = None, dtype = None: self._profile(x, out, dtype, self.constant)
+        profileY = lambda y, out = None, dtype = None: self._profile(y, out, dtype, 1)
+        
+        return _separable(profileX, profileY, x, y, out, dtype, np.complex128)
+        
+    def _profile(self, x, out, dtype, constant):
+        '''Evaluates constant * exp(alpha * x**2) without temporary arrays.
+        
+        '''
+        out = _output(np.shape(x), out, dtype, np.complex128)
+        
+        np.square(x, out = out)
+        out *= self.alpha
+        np.exp(out, out = out)
+        out *= constant
+        
+        return out
+        
+    @property
+    def wavenumber(self):
+        return 2 * np.pi / self.wavelength
+        
+    @property
+    def alpha(self):
+        '''The coefficient of x**2 in the exponent of the field.
+        
+        '''
+        return 1j * self.wavenumber / (2 * self.q)
+        
+    @property
+    def radius(self):
+        '''The 1/e**2 radius of the irradiance.
+        
+        '''
+        return np.sqrt(-1 / self.alpha.real)
+        
+    def propagate(self, propDistance):
+        '''Returns the beam after propagating a distance in free space.
+        
+        '''
+        q = self.q + propDistance
+        
+        # Amplitude, Gouy phase and propagation phase
+        constant = self.constant * (self.q / q)**(self.dim / 2) * np.exp(1j * self.wavenumber * propDistance)
+        
+        return GaussianBeam.fromParameters(q, constant, self.wavelength, self.dim)
+        
+    def lens(self, focalLength):
+        '''Returns the beam just after a thin lens.
+        
+        '''
+        q = 1 / (1 / self.q - 1 / focalLength)
+        
+        return GaussianBeam.fromParameters(q, self.constant, self.wavelength, self.dim)
+        
+    def fourierTransform(self, focalLength):
+        '''Returns the Fourier transform of the beam by a lens.
+        
+        The transform is scaled like the ones of fftSubgrid and of the
+        publication's collimating lens, i.e. the field in the focal plane is
+        integral(u(x) * exp(-2j * pi * x * X / (wavelength * f)) dx) / sqrt(wavelength * f)
+        along each dimension.
+        
+        '''
+        scale = self.wavelength * focalLength
+        alpha = self.alpha
+        
+        newAlpha = np.pi**2 / (alpha * scale**2)
+        constant = self.constant * (np.pi / (-alpha) / scale)**(self.dim / 2)
+        
+        return GaussianBeam.fromParameters(1j * self.wavenumber / (2 * newAlpha), constant,
+                                           self.wavelength, self.dim)
+        
+    def __eq__(self, other):
+        return type(self) is type(other) and self._parameters() == other._parameters()
+        
+    def __ne__(self, other):
+        return not self == other
+        
+    def __hash__(self):
+        return hash(self._parameters())
+        
+    def _parameters(self):
+        return (self.q, self.constant, self.wavelength, self.dim)
+    
 def GaussianWithDiffuser(amplitude,
                          beamStd,
                          physicalSize,
-                         powerScat  = 0.01,
-                         wavelength = 0.642,
-                         fc         = 50000,
-                         grainSize  = 40,
-                         beamSize   = 100):
+                         powerScat       = 0.01,
+                         wavelength      = 0.642,
+                         fc              = 50000,
+                         grainSize       = 40,
+                         beamSize        = 100,
+                         rng             = None,
+                         numRealizations = None):
     '''A Gaussian beam passing through a telescope and rotating diffuser.
     
     Parameters
@@ -108,6 +400,12 @@ def GaussianWithDiffuser(amplitude,
     fc        : float
         The focal length of the collimating lens that collects the light coming
         from the diffuser.
+    rng       : numpy.random.Generator or None
+        The source of random numbers for the diffuser. numpy's global random
+        state is used if None.
+    numRealizations : int or None
+        If not None, the returned function computes this many independent
+        realizations at once and returns them as the rows of a 2D array.
         
     ''' 
     
@@ -117,67 +415,135 @@ def GaussianWithDiffuser(amplitude,
     srcCenters = np.arange(-numSources * grainSize / 2, numSources * (grainSize / 2) + grainSize, grainSize)
 
     # Return the deterministic field and scattered plane waves
-    return lambda x: _applyDiffuser(x, amplitude, beamStd, srcAmp, srcCenters, powerScat, wavelength, fc)
+    return lambda x, out = None, dtype = None: _applyDiffuser(x, amplitude, beamStd, srcAmp, srcCenters,
+                                                              powerScat, wavelength, fc,
+                                                              rng, numRealizations, out, dtype)
     
-def _applyDiffuser(x, amplitude, beamStd, srcAmp, srcCenters, powerScat, wavelength, fc):
+@instrument('fields.GaussianWithDiffuser')
+def _applyDiffuser(x, amplitude, beamStd, srcAmp, srcCenters, powerScat, wavelength, fc,
+                   rng = None, numRealizations = None, out = None, dtype = None):
     '''Computes the random plane waves coming from the diffuser.
     
     '''
-    # Compute the plane waves' phases and directions
-    planewaves = np.zeros(x.size)
-    for ctr in range(int(srcCenters.size)):
-        randomPhase = np.exp(1j * ((np.random.rand(1) * 2 * np.pi) - np.pi))
-        planewaves  = planewaves + srcAmp * np.exp(1j * 2 * np.pi *srcCenters[ctr] * x / wavelength / fc) * randomPhase
+    rng = _getRNG(rng)
+    
+    # Draw the random phases of the plane waves, one row per realization
+    numRows     = 1 if numRealizations is None else numRealizations
+    randomPhase = np.exp(1j * ((rng.random((numRows, srcCenters.size)) * 2 * np.pi) - np.pi))
+    
+    # Superpose the plane waves of all the sources
+    planewaves = _planeWaveSum(srcAmp * randomPhase, srcCenters / wavelength / fc, x)
+        
+    if numRealizations is None:
+        planewaves = planewaves[0]
         
     # Compute the carrier beam, i.e. the deterministic Gaussian
     newCarrierAmp = amplitude * np.sqrt(1 - powerScat)
     carrierBeam   = GaussianBeamWaistProfile(newCarrierAmp, beamStd)
     
-    return carrierBeam(x) + planewaves
+    out = _output(planewaves.shape, out, dtype, np.complex128)
     
-def GSMBeamRealization(amplitude, beamStd, cohLength, grid):
+    return np.add(carrierBeam(x), planewaves, out = out)
+    
+@instrument('fields._planeWaveSum')
+def _planeWaveSum(coeffs, freqs, x, maxBlockSize = 2**20):
+    '''Sums plane waves with complex coefficients.
+    
+    The plane waves are computed as an outer product of their spatial
+    frequencies with blocks of the coordinates, and all the realizations are
+    summed with one matrix product per block. maxBlockSize bounds the number
+    of elements in the temporary array of plane waves.
+    
+    Parameters
+    ----------
+    coeffs : 2D array of complex
+        The coefficients of the plane waves with shape
+        (numRealizations, numWaves).
+    freqs  : 1D array of float
+        The spatial frequencies of the plane waves.
+    x      : 1D array of float
+        The coordinates at which the plane waves are summed.
+        
+    Returns
+    -------
+    field : 2D array of complex
+        The sums with shape (numRealizations, x.size).
+    
+    '''
+    field     = np.empty((coeffs.shape[0], x.size), dtype = np.complex128)
+    blockSize = max(1, maxBlockSize // max(1, freqs.size))
+    
+    for start in range(0, x.size, blockSize):
+        stop  = min(start + blockSize, x.size)
+        waves = np.exp(1j * 2 * np.pi * np.outer(freqs, x[start:stop]))
+        
+        field[:, start:stop] = np.dot(coeffs, waves)
+        
+    return field
+    
+def GSMBeamRealization(amplitude, beamStd, cohLength, grid, rng = None):
     '''Returns a single realization of the partially coherent GSM beam.
     
+    A new random phase screen is drawn from rng every time the returned
+    function is called. numpy's global random state is used if rng is None.
+    The field has the precision of the grid unless another dtype is given.
+    
+    The phase screens have sigma_f = 2.5 * cohLength and
+    sigma_r = sqrt(4 * pi * sigma_f**4 / cohLength**2). The coherence length
+    of the field follows from these and the grid (see screenCoherenceLength)
+    and is much shorter than cohLength on grids in um; GSMModes.fromRealization
+    returns the coherent modes of the beam.
+    
     '''
     # The spatial frequency grid spacing is required for normalizing the random
     # array of the phase screen.
     
-    return lambda x: _applyMask(x, amplitude, beamStd, cohLength, grid.pfX)
+    return lambda x, out = None, dtype = None: _applyMask(x, amplitude, beamStd, cohLength, grid.pfX,
+                                                          rng, out, dtype or grid.complexDtype)
         
-def _applyMask(x, amplitude, beamStd, cohLength, pfX):
+@instrument('fields.GSMBeamRealization')
+def _applyMask(x, amplitude, beamStd, cohLength, pfX, rng = None, out = None, dtype = None):
     '''Computes the random phase mask at the grid locations.
     
     '''
-    dx      = x[1] - x[0] # Assumes uniform spacing between samples
-    dpfX    = pfX[1] - pfX[0]
+    out = _output(np.shape(x), out, dtype, np.complex128)
     
-    # Define phase screen parameters
-    sigma_f = 2.5 * cohLength
-    sigma_r = np.sqrt(4 * np.pi * sigma_f**4 / cohLength**2)
+    sigma_f, sigma_r = _gsmScreen(cohLength)
 
-    # Convolve phase screen functions
-    F = ifftshift(np.exp(-np.pi**2 * sigma_f**2 * pfX**2));
-    R = np.random.randn(x.size) + 1.0j * np.random.randn(x.size)
-    
-    # From Voelz, "Computational Fourier Optics: A MATLAB Tutorial", Chap. 9
-    phaseScreen = 2 * np.pi * fftshift(ifft(F*R)) * sigma_r / (dx * np.sqrt(dpfX))
+    phaseScreen = _phaseScreens(x, sigma_f, sigma_r, pfX, 1, rng, np.finfo(out.dtype).dtype)[0]
     
     # Sample the field
     fieldFunc = GaussianBeamWaistProfile(amplitude, beamStd)
-    field = fieldFunc(x) * np.exp(1.0j * np.real(phaseScreen))
+    np.exp(1.0j * phaseScreen, out = out)
+    out *= fieldFunc(x, dtype = phaseScreen.dtype)
     
-    return field
+    return out
+    
+def _gsmScreen(cohLength):
+    '''Returns the parameters sigma_f and sigma_r of the phase screens of GSMBeamRealization.
+    
+    '''
+    sigma_f = 2.5 * cohLength
+    sigma_r = np.sqrt(4 * np.pi * sigma_f**4 / cohLength**2)
+    
+    return sigma_f, sigma_r
     
-def diffuserMask(sigma_f, sigma_r, grid):
+def diffuserMask(sigma_f, sigma_r, grid, rng = None):
     '''Returns a single realization of the partially coherent GSM beam.
     
+    A new random phase screen is drawn from rng every time the returned
+    function is called. numpy's global random state is used if rng is None.
+    The field has the precision of the grid unless another dtype is given.
+    
     '''
     # The spatial frequency grid spacing is required for normalizing the random
     # array of the phase screen.
     
-    return lambda x: _applyDiffuserMask(x, sigma_f, sigma_r, grid.pfX)
+    return lambda x, out = None, dtype = None: _applyDiffuserMask(x, sigma_f, sigma_r, grid.pfX,
+                                                                  rng, out, dtype or grid.complexDtype)
         
-def _applyDiffuserMask(x, sigma_f, sigma_r, pfX):
+@instrument('fields.diffuserMask')
+def _applyDiffuserMask(x, sigma_f, sigma_r, pfX, rng = None, out = None, dtype = None):
     '''Computes the random phase mask at the grid locations.
     
     Notes
@@ -187,17 +553,601 @@ def _applyDiffuserMask(x, sigma_f, sigma_r, pfX):
     Opt. Express 14, 6986-6992 (2006)
     
     '''
-    dx      = x[1] - x[0] # Assumes uniform spacing between samples
-    dpfX    = pfX[1] - pfX[0]
-
+    out = _output(np.shape(x), out, dtype, np.complex128)
+    
+    phaseScreen = _phaseScreens(x, sigma_f, sigma_r, pfX, 1, rng, np.finfo(out.dtype).dtype)[0]
+    
+    # Sample the field
+    return np.exp(1.0j * phaseScreen, out = out)
+    
+@instrument('fields.diffuserMasks')
+def diffuserMasks(numMasks, sigma_f, sigma_r, grid, rng = None, dtype = None):
+    '''Returns a batch of independent realizations of the diffuser's mask.
+    
+    Parameters
+    ----------
+    numMasks : int
+        The number of realizations.
+    sigma_f  : float
+        The correlation length of the diffuser.
+    sigma_r  : float
+        The strength of the random phase.
+    grid     : Grid
+        The 1D grid on which the masks are sampled.
+    rng      : numpy.random.Generator or None
+        The source of random numbers. numpy's global random state is used if
+        None.
+    dtype    : numpy.complex64, numpy.complex128 or None
+        The precision of the masks. Defaults to the precision of the grid.
+        
+    Returns
+    -------
+    masks : 2D array of complex
+        The masks with shape (numMasks, grid.gridSize). The masks are drawn
+        from the same distribution as those of diffuserMask.
+    
+    '''
+    realDtype = np.finfo(dtype or grid.complexDtype).dtype
+    
+    return np.exp(1.0j * phaseScreens(numMasks, sigma_f, sigma_r, grid, rng = rng, dtype = realDtype))
+    
+def phaseScreens(numScreens, sigma_f, sigma_r, grid, rng = None, dtype = None):
+    '''Returns a batch of independent random phase screens.
+    
+    The Gaussian filter of the screens is computed once and all the screens
+    are generated with a single batched inverse FFT.
+    
+    Parameters
+    ----------
+    numScreens : int
+        The number of phase screens.
+    sigma_f    : float
+        The correlation length of the screens.
+    sigma_r    : float
+        The strength of the random phase.
+    grid       : Grid
+        The 1D grid on which the screens are sampled.
+    rng        : numpy.random.Generator or None
+        The source of random numbers. numpy's global random state is used if
+        None.
+    dtype      : numpy.float32, numpy.float64 or None
+        The precision of the screens and of the FFT that generates them.
+        Defaults to the precision of the grid.
+        
+    Returns
+    -------
+    screens : 2D array of float
+        The phase of the screens in radians with shape
+        (numScreens, grid.gridSize).
+    
+    '''
+    return _phaseScreens(grid.px, sigma_f, sigma_r, grid.pfX, numScreens, rng, dtype or grid.realDtype)
+    
+def screenCoherenceLength(sigma_f, sigma_r, grid):
+    '''Returns the coherence length of the field behind random phase screens.
+    
+    The phase of the screens of phaseScreens is Gaussian with a variance
+    var and a correlation rho(dx) that follow from the filter of the screens
+    on the grid. The degree of coherence of exp(1j * phase) is
+    exp(-var * (1 - rho(dx))), which is approximated by the Gaussian
+    exp(-dx**2 / (2 * cohLength**2)) with the same curvature at dx = 0. This
+    is the cohLength of GSMModes. The approximation is accurate when var is
+    large, so that the coherence vanishes at lags much smaller than sigma_f;
+    otherwise a fraction exp(-var) of the power remains coherent.
+    
+    The variance depends on the units of the grid, so the same sigma_f and
+    sigma_r give different coherence lengths in um and in m.
+    
+    Parameters
+    ----------
+    sigma_f : float
+        The correlation length of the screens.
+    sigma_r : float
+        The strength of the random phase.
+    grid    : Grid
+        The 1D grid on which the screens are sampled.
+        
+    Returns
+    -------
+    cohLength : float
+        The standard deviation of the Gaussian degree of coherence. It is
+        infinite if the screens are uniform on the grid.
+    
+    '''
+    pfX  = np.ravel(grid.pfX)
+    dx   = grid.px[1] - grid.px[0]
+    dpfX = pfX[1] - pfX[0]
+    
+    # The real part of the filtered complex noise of _phaseScreens
+    power    = np.exp(-2 * np.pi**2 * sigma_f**2 * pfX**2)
+    variance = (2 * np.pi * sigma_r / (dx * np.sqrt(dpfX)))**2 * np.sum(power) / pfX.size**2
+    
+    # 1 - rho(dx) = 2 * pi**2 * meanSquareFreq * dx**2 for small dx
+    meanSquareFreq = np.sum(power * pfX**2) / np.sum(power)
+    if meanSquareFreq == 0:
+        return np.inf
+    
+    return 1 / (2 * np.pi * np.sqrt(variance * meanSquareFreq))
+    
+@instrument('fields.phaseScreens')
+def _phaseScreens(x, sigma_f, sigma_r, pfX, numScreens, rng = None, dtype = np.float64):
+    '''Computes random phase screens at the grid locations.
+    
+    Notes
+    -----
+    Partially coherent beam simulation from Xifeng Xiao and David Voelz,
+    "Wave optics simulation approach for partial spatially coherent beams."
+    Opt. Express 14, 6986-6992 (2006)
+    
+    '''
+    rng = _getRNG(rng)
+    
+    # Scalars are cast to dtype to keep the precision of the screens
+    realType = np.dtype(dtype).type
+    dx       = realType(x[1] - x[0]) # Assumes uniform spacing between samples
+    dpfX     = realType(pfX[1] - pfX[0])
+    sigma_r  = realType(sigma_r)
+    
     # Convolve phase screen functions
-    F = ifftshift(np.exp(-np.pi**2 * sigma_f**2 * pfX**2));
-    R = np.random.randn(x.size) + 1.0j * np.random.randn(x.size)
+    shape = (numScreens, x.size)
+    F = ifftshift(np.exp(-np.pi**2 * sigma_f**2 * pfX**2)).astype(dtype)
+    R = rng.standard_normal(shape).astype(dtype) + 1.0j * rng.standard_normal(shape).astype(dtype)
     
     # From Voelz, "Computational Fourier Optics: A MATLAB Tutorial", Chap. 9
-    phaseScreen = 2 * np.pi * fftshift(ifft(F*R)) * sigma_r / (dx * np.sqrt(dpfX))
+    phaseScreen = 2 * np.pi * fftshift(ifft(F*R, axis = -1, overwrite_x = True), axes = -1) * sigma_r / (dx * np.sqrt(dpfX))
     
-    # Sample the field
-    mask = np.exp(1.0j * np.real(phaseScreen))
+    return np.real(phaseScreen)
+
+class RotatingDiffuser(object):
+    '''Successive, correlated realizations of a rotating diffuser's mask.
+
+    A diffuser rotating at rotationSpeed moves across the beam by
+    2 * pi * radius * rotationSpeed * exposureTime during one exposure. One
+    long phase screen covering the track of all the realizations is
+    synthesized once, with the statistics of diffuserMask, and realization i
+    is a read-only view of it shifted by i steps. Realizations therefore cost
+    nothing, and successive ones are correlated like those of a real
+    diffuser. A track longer than the circumference of the diffuser wraps
+    around it.
+
+    Examples
+    --------
+    >>> diffuser = RotatingDiffuser(sigma_f, sigma_r, collGrid, 2e4, 10, 1e-3, 100)
+    >>> beam     = GaussianBeamDefocused(fieldAmp, beamStd, wavelength, dR)(collGrid.px)
+    >>> for mask in diffuser:
+    ...     field = beam * mask
+
+    '''
+    def __init__(self, sigma_f, sigma_r, grid, radius, rotationSpeed, exposureTime, numRealizations,
+                 rng = None, dtype = None):
+        '''Synthesizes the phase screen of the diffuser's track.
+
+        Parameters
+        ----------
+        sigma_f         : float
+            The correlation length of the diffuser.
+        sigma_r         : float
+            The strength of the random phase.
+        grid            : Grid
+            The 1D grid on which the masks are sampled.
+        radius          : float
+            The distance of the beam from the axis of rotation, in the same
+            units as the grid.
+        rotationSpeed   : float
+            The rotation speed in revolutions per unit of time.
+        exposureTime    : float
+            The time between two realizations, e.g. the exposure time of a
+            camera, or a fraction of it to average several realizations per
+            exposure.
+        numRealizations : int
+            The number of realizations.
+        rng             : numpy.random.Generator or None
+            The source of random numbers. numpy's global random state is used
+            if None.
+        dtype           : numpy.complex64, numpy.complex128 or None
+            The precision of the masks. Defaults to the precision of the grid.
+
+        '''
+        dtype = np.dtype(dtype or grid.complexDtype)
+        dx    = grid.physicalSize / (grid.gridSize - 1)
+
+        self.gridSize        = grid.gridSize
+        self.numRealizations = numRealizations
+
+        # The shift between realizations is rounded to whole samples
+        self.stepSize = int(np.round(2 * np.pi * radius * rotationSpeed * exposureTime / dx))
+        self.step     = self.stepSize * dx
+
+        # The screens have an odd number of samples like the grids
+        trackSize = (numRealizations - 1) * self.stepSize + grid.gridSize
+        period    = 2 * int(np.round(np.pi * radius / dx)) + 1
+        size      = min(trackSize + 1 - trackSize % 2, period)
+
+        x     = dx * np.arange(-(size // 2), size // 2 + 1)
+        pfX   = np.arange(-(size // 2), size // 2 + 1) / ((size - 1) * dx)
+        phase = _phaseScreens(x, sigma_f, sigma_r, pfX, 1, rng, np.finfo(dtype).dtype)[0]
+
+        # The start of the track is appended to its end when it wraps around
+        self.period = size if trackSize > size else None
+        if self.period is not None:
+            phase = np.concatenate((phase, np.resize(phase, grid.gridSize - 1)))
+
+        self.phase = phase
+        self.masks = np.exp(1.0j * phase).astype(dtype, copy = False)
+
+        self.phase.setflags(write = False)
+        self.masks.setflags(write = False)
+
+    def __len__(self):
+        return self.numRealizations
+
+    def __getitem__(self, index):
+        '''Returns the mask of realization index as a view of the track.
+
+        '''
+        start = self._offset(index)
+
+        return self.masks[start:start + self.gridSize]
+
+    def __iter__(self):
+        for index in range(self.numRealizations):
+            yield self[index]
+
+    def phaseScreen(self, index):
+        '''Returns the phase screen of realization index as a view of the track.
+
+        '''
+        start = self._offset(index)
+
+        return self.phase[start:start + self.gridSize]
+
+    def _offset(self, index):
+        if not -self.numRealizations <= index < self.numRealizations:
+            raise IndexError('The diffuser has {0} realizations.'.format(self.numRealizations))
+
+        offset = (index % self.numRealizations) * self.stepSize
+
+        return offset if self.period is None else offset % self.period
+
+class GSMModes(object):
+    '''The coherent modes of a 1D Gaussian Schell-model beam.
+    
+    The cross-spectral density of a GSM beam,
+    
+        W(x1, x2) = conj(u(x1)) * u(x2) * exp(-(x2 - x1)**2 / (2 * cohLength**2)),
+        
+    where u is a coherent Gaussian beam, is the weighted sum of the
+    irradiances of mutually incoherent Hermite-Gaussian modes whose weights
+    decrease geometrically. Propagating the few modes that carry most of the
+    power and summing their irradiances gives the average irradiance of the
+    beam without the noise of averaging random realizations.
+    
+    The weights are included in the sampled modes, so the average irradiance
+    is simply the sum of abs(mode)**2 over the modes.
+    
+    cohLength is the standard deviation of the Gaussian degree of coherence,
+    exp(-dx**2 / (2 * cohLength**2)). It is not the cohLength parameter of
+    GSMBeamRealization, which sets the parameters of random phase screens
+    whose coherence also depends on the grid; fromRealization and
+    fromScreen compute the modes of the beams of GSMBeamRealization and of
+    diffuserMask.
+    
+    Notes
+    -----
+    F. Gori, "Collett-Wolf sources and multimode lasers," Opt. Commun. 34,
+    301-305 (1980); E. Wolf, "New theory of partial coherence in the
+    space-frequency domain," J. Opt. Soc. Am. 72, 343-351 (1982).
     
-    return mask
\ No newline at end of file
+    '''
+    def __init__(self, amplitude, beamStd, cohLength, wavelength = None, position = 0, tol = 1e-3,
+                 maxModes = None):
+        '''Computes the weights of the modes and the number of modes to keep.
+        
+        Parameters
+        ----------
+        amplitude  : float
+            The amplitude of the coherent beam at its waist.
+        beamStd    : float
+            The standard deviation of the coherent beam's waist, as in
+            GaussianBeamDefocused.
+        cohLength  : float
+            The standard deviation of the beam's Gaussian degree of
+            coherence.
+        wavelength : float or None
+            Only required when position is not zero.
+        position   : float
+            The axial position of the plane in which the coherence is
+            imposed, e.g. by a diffuser, relative to the coherent beam's
+            waist. The modes then carry the curvature of the beam.
+        tol        : float
+            The largest fraction of the beam's power in the discarded modes.
+        maxModes   : int or None
+            The largest number of modes to keep, whatever tol.
+            
+        '''
+        if (position != 0) and (wavelength is None):
+            raise ValueError('The wavelength is required to compute the modes of a defocused beam.')
+        
+        # u(x) = constant * exp(alpha * x**2); alpha does not depend on the wavelength at the waist
+        beam = GaussianBeam(amplitude, beamStd, 1.0 if wavelength is None else wavelength, position)
+        
+        self.amplitude  = amplitude
+        self.beamStd    = beamStd
+        self.cohLength  = cohLength
+        self.wavelength = wavelength
+        self.position   = position
+        self.constant   = beam.constant
+        self.curvature  = beam.alpha.imag
+        
+        # The parameters of the real GSM kernel
+        a = -beam.alpha.real
+        b = 1 / (2 * cohLength**2)
+        c = np.sqrt(a**2 + 2 * a * b)
+        
+        self.c     = c
+        self.ratio = b / (a + b + c)
+        
+        if self.ratio == 0:
+            numModes = 1
+        else:
+            numModes = max(1, int(np.ceil(np.log(tol) / np.log(self.ratio))))
+        if maxModes is not None:
+            numModes = min(numModes, maxModes)
+            
+        self.numModes = numModes
+        self.weights  = np.abs(self.constant)**2 * np.sqrt(np.pi / (a + b + c)) * self.ratio**np.arange(numModes)
+        
+    @classmethod
+    def fromScreen(cls, amplitude, beamStd, sigma_f, sigma_r, grid, position = 0, tol = 1e-3, maxModes = None):
+        '''Returns the modes of a beam behind the phase screens of diffuserMask.
+        
+        Parameters
+        ----------
+        amplitude, beamStd, position, tol, maxModes
+            See __init__. position is the axial position of the screens.
+        sigma_f, sigma_r : float
+            The parameters of the screens.
+        grid             : Grid
+            The 1D grid on which the screens are sampled.
+        
+        '''
+        return cls(amplitude, beamStd, screenCoherenceLength(sigma_f, sigma_r, grid), grid.wavelength,
+                   position = position, tol = tol, maxModes = maxModes)
+        
+    @classmethod
+    def fromRealization(cls, amplitude, beamStd, cohLength, grid, tol = 1e-3, maxModes = None):
+        '''Returns the modes of the beam of GSMBeamRealization.
+        
+        The parameters are those of GSMBeamRealization and __init__.
+        
+        '''
+        sigma_f, sigma_r = _gsmScreen(cohLength)
+        
+        return cls.fromScreen(amplitude, beamStd, sigma_f, sigma_r, grid, tol = tol, maxModes = maxModes)
+        
+    def __len__(self):
+        return self.numModes
+        
+    @property
+    def truncationError(self):
+        '''Return the fraction of the beam's power in the discarded modes.
+        
+        '''
+        return self.ratio**self.numModes
+        
+    @instrument('fields.GSMModes')
+    def __call__(self, x, out = None, dtype = None):
+        '''Samples the weighted modes at the 1D array of coordinates x.
+        
+        Returns
+        -------
+        modes : 2D array of complex
+            The modes with shape (numModes, x.size). The result is written into
+            out if it is given; otherwise a new array of type dtype (default
+            complex128) is returned.
+            
+        '''
+        x   = np.ravel(x)
+        out = _output((self.numModes, x.size), out, dtype, np.complex128)
+        
+        # Hermite functions from their three-term recurrence, which stays
+        # accurate for high orders unlike the Hermite polynomials
+        u     = np.sqrt(2 * self.c) * x
+        prev  = np.zeros_like(u)
+        curr  = (2 * self.c / np.pi)**0.25 * np.exp(-self.c * x**2)
+        phase = self.constant / np.abs(self.constant) * np.exp(1j * self.curvature * x**2)
+        
+        for n in range(self.numModes):
+            np.multiply(np.sqrt(self.weights[n]) * phase, curr, out = out[n])
+            prev, curr = curr, np.sqrt(2 / (n + 1)) * u * curr - np.sqrt(n / (n + 1)) * prev
+            
+        return out
+        
+    def irradiance(self, system, x, dtype = None):
+        '''Returns the average irradiance after an optical system.
+        
+        Parameters
+        ----------
+        system : function
+            system(field) returns the field after the system for one mode
+            sampled at x, e.g. lambda u: fftPropagate(u, grid, L). It may also
+            return a tuple of fields in several planes.
+        x      : 1D array of float
+            The coordinates at which the modes are sampled.
+        dtype  : numpy.dtype or None
+            The precision of the modes. See __call__.
+            
+        Returns
+        -------
+        irrad : array of float or tuple of arrays of float
+            The sum of the irradiances of the modes in each plane, in double
+            precision.
+        
+        '''
+        irrad = None
+        for mode in self(x, dtype = dtype):
+            fields = system(mode)
+            planes = fields if isinstance(fields, tuple) else (fields,)
+            
+            if irrad is None:
+                irrad = [np.zeros(np.shape(plane)) for plane in planes]
+            for total, plane in zip(irrad, planes):
+                total += np.abs(plane)**2
+                
+        return tuple(irrad) if isinstance(fields, tuple) else irrad[0]
+        
+def _getRNG(rng):
+    '''Returns the random number generator to use, defaulting to numpy's global one.
+    
+    '''
+    if rng is None:
+        return np.random
+    
+    return rng
+    
+class EnsembleAccumulator(object):
+    '''Running mean and variance of the irradiance of random realizations.
+    
+    The statistics are updated one realization at a time with Welford's
+    algorithm and are stored in float64, so the memory use is a few arrays
+    the size of each plane regardless of the number of realizations.
+    Accumulators of independent realizations, for example from different
+    worker processes, are combined with merge.
+    
+    Examples
+    --------
+    >>> acc = EnsembleAccumulator()
+    >>> for _ in range(1000):
+    ...     acc.update(np.abs(beam(grid.px))**2)
+    ...     if acc.count > 10 and acc.relativeStandardError(mask = inBFP) < 0.01:
+    ...         break
+    >>> avgIrrad = acc.mean
+    
+    '''
+    def __init__(self):
+        self.count  = 0
+        self._means = None
+        self._m2s   = None
+        
+    def update(self, planes):
+        '''Adds one realization.
+        
+        Parameters
+        ----------
+        planes : array or tuple of arrays
+            The irradiance of the realization in one or more planes.
+            
+        '''
+        planes = _asPlanes(planes)
+        if self._means is None:
+            self._means = [np.zeros(np.shape(plane)) for plane in planes]
+            self._m2s   = [np.zeros(np.shape(plane)) for plane in planes]
+            
+        self.count += 1
+        n = self.count
+        for plane, mean, m2 in zip(planes, self._means, self._m2s):
+            # delta = x - mean; mean += delta / n; m2 += delta**2 * (n - 1) / n
+            delta  = np.subtract(plane, mean, dtype = np.float64)
+            delta /= n
+            mean  += delta
+            np.square(delta, out = delta)
+            delta *= n * (n - 1)
+            m2    += delta
+            
+        return self
+        
+    def merge(self, other):
+        '''Adds the realizations of another accumulator to this one.
+        
+        '''
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.count  = other.count
+            self._means = [mean.copy() for mean in other._means]
+            self._m2s   = [m2.copy() for m2 in other._m2s]
+            return self
+            
+        nA, nB = self.count, other.count
+        n      = nA + nB
+        for mean, m2, otherMean, otherM2 in zip(self._means, self._m2s, other._means, other._m2s):
+            # Chan et al.'s pairwise update
+            delta  = otherMean - mean
+            mean  += delta * (nB / n)
+            m2    += otherM2
+            np.square(delta, out = delta)
+            delta *= nA * nB / n
+            m2    += delta
+            
+        self.count = n
+        
+        return self
+        
+    @property
+    def mean(self):
+        '''The mean irradiance, as an array or a tuple of arrays.
+        
+        '''
+        return _fromPlanes(self._means)
+        
+    def variance(self, ddof = 1):
+        '''Returns the variance of the irradiance of the realizations.
+        
+        '''
+        if self.count <= ddof:
+            raise ValueError('At least {0} realizations are needed.'.format(ddof + 1))
+            
+        return _fromPlanes([m2 / (self.count - ddof) for m2 in self._m2s])
+        
+    def standardError(self):
+        '''Returns the standard error of the mean irradiance.
+        
+        '''
+        return _fromPlanes([np.sqrt(m2 / (self.count - 1) / self.count) for m2 in self._m2sChecked()])
+        
+    def relativeStandardError(self, plane = 0, mask = None):
+        '''Returns the relative standard error of the mean irradiance in a region.
+        
+        This is the root mean square of the standard error of the mean over
+        the region, divided by the mean irradiance in the region. It measures
+        how much speckle noise is left in the average, for example in the
+        flat field inside the objective's back focal plane.
+        
+        Parameters
+        ----------
+        plane : int
+            The index of the plane.
+        mask  : array of bool or None
+            The region of the plane. The whole plane is used if None.
+            
+        '''
+        mean = self._means[plane]
+        m2   = self._m2sChecked()[plane]
+        if mask is not None:
+            mean, m2 = mean[mask], m2[mask]
+            
+        return np.sqrt(np.mean(m2) / (self.count - 1) / self.count) / np.mean(mean)
+        
+    def _m2sChecked(self):
+        if self.count < 2:
+            raise ValueError('At least 2 realizations are needed.')
+            
+        return self._m2s
+        
+def _asPlanes(planes):
+    '''Wraps a single irradiance array into a tuple of planes.
+    
+    '''
+    if isinstance(planes, np.ndarray):
+        return (planes,)
+        
+    return planes
+    
+def _fromPlanes(planes):
+    '''Returns a single plane as an array and several planes as a tuple.
+    
+    '''
+    if len(planes) == 1:
+        return planes[0]
+        
+    return tuple(planes)
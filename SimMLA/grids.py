@@ -3,11 +3,20 @@
 # See the LICENSE.docx file for more details.
 
 import numpy as np
+from SimMLA.instrumentation import instrument
+from SimMLA.precision import checkPrecision, complexType, getPrecision, realType
 
 # Function definitions
 def isEven(x):
     return (x % 2 == 0)
     
+@instrument('grids.Grid.coordinates', details = lambda name, compute: {'coordinates' : name})
+def _computeCoords(name, compute):
+    '''Computes the coordinate array name of a grid when it is not cached.
+    
+    '''
+    return compute()
+    
 # Class definitions
 class ImproperDimensionException(Exception):
     pass    
@@ -16,7 +25,7 @@ class ImproperGridSizeException(Exception):
     pass
 
 class Grid(object):
-    def __init__(self, gridSize, physicalSize, wavelength, focalLength, dim = 2):
+    def __init__(self, gridSize, physicalSize, wavelength, focalLength, dim = 2, precision = None):
         '''Establishes a square grid for sampling an electromagnetic field.
         
         The grid is square with an odd number of grid locations along one
@@ -40,6 +49,11 @@ class Grid(object):
             the Fourier transform.
         dim          : int
             The dimension of the grid (can be 1 or 2).
+        precision    : str or None
+            'double' or 'single'. The precision of the fields, kernels and
+            transforms computed on the grid. Coordinates are always stored in
+            double precision. Defaults to the current precision (see
+            SimMLA.precision.setPrecision).
             
         '''
         if (not isinstance(gridSize, int)) or isEven(gridSize) or (gridSize <= 0):
@@ -49,14 +63,22 @@ class Grid(object):
         self.physicalSize = physicalSize
         self.wavelength   = wavelength
         self.focalLength  = focalLength
+        self.dim          = dim
+        self.precision    = precision or getPrecision()
+        checkPrecision(self.precision)
         
         coords = np.arange(-np.floor(gridSize / 2), (np.floor(gridSize / 2)) + 1)
+        coords.setflags(write = False)
         
-        # Create the grid
+        # Create the grid. Only the 1D coordinate vectors are stored; 2D grids
+        # expose them as a row (x) and a column (y) that broadcast against
+        # each other like the output of numpy.ogrid.
         if dim == 2:
-            self.x, self.y = np.meshgrid(coords, coords)
+            self._x = coords[np.newaxis, :]
+            self._y = coords[:, np.newaxis]
         elif dim == 1:
-            self.x = coords
+            self._x = coords
+            self._y = None
         else:
             raise ImproperDimensionException('dim must be an integer equal to 1 or 2.')
         
@@ -64,34 +86,78 @@ class Grid(object):
         self._gridToPhys         = self.physicalSize / (self.gridSize - 1)
         self._gridToFTGrid       = 1 / self.gridSize
         self._gridToPhysFTGrid   = 1 / self.physicalSize
+        
+        # Read-only coordinate arrays computed on first access
+        self._coordCache = {}
+    
+    @property
+    def shape(self):
+        '''Return the shape of a field sampled on the grid.
+        
+        '''
+        return (self.gridSize,) * self.dim
+    
+    @property
+    def realDtype(self):
+        '''Return the dtype of real fields sampled on the grid.
+        
+        '''
+        return realType(self.precision)
+    
+    @property
+    def complexDtype(self):
+        '''Return the dtype of complex fields sampled on the grid.
+        
+        '''
+        return complexType(self.precision)
+    
+    @property
+    def x(self):
+        '''Return the x-grid in units of grid locations.
+        
+        The x-grid of a 2D grid is a single row that broadcasts against the
+        y-grid.
+        '''
+        return self._x
+    
+    @property
+    def y(self):
+        '''Return the y-grid in units of grid locations.
+        
+        The y-grid of a 2D grid is a single column that broadcasts against the
+        x-grid.
+        '''
+        if self._y is None:
+            raise AttributeError('1D grids have no y-grid.')
+        return self._y
     
     @property
     def px(self):
         '''Return the x-grid in physical units.
         
         '''
-        return self.x * self._gridToPhys
+        return self._coords('px', lambda: self.x * self._gridToPhys)
     
     @property
     def py(self):
         '''Return the y-grid in physical units.
         
         '''
-        return self.y * self._gridToPhys
+        return self._coords('py', lambda: self.y * self._gridToPhys)
     
     @property
     def X(self):
         '''Return the X-grid of the Fourier transform.
         
         '''
-        return self.x * self._gridToFTGrid
+        return self._coords('X', lambda: self.x * self._gridToFTGrid)
     
     @property
     def Y(self):
         '''Return the Y-grid of the Fourier transform.
         
         '''
-        return self.y * self._gridToFTGrid
+        return self._coords('Y', lambda: self.y * self._gridToFTGrid)
     
     @property
     def pX(self):
@@ -99,7 +165,7 @@ class Grid(object):
         
         Units are wavelength * (focal length) / (physical size).
         '''
-        return self.x * self.wavelength * self.focalLength * self._gridToPhysFTGrid
+        return self._coords('pX', lambda: self.x * self.wavelength * self.focalLength * self._gridToPhysFTGrid)
     
     @property
     def pY(self):
@@ -107,7 +173,7 @@ class Grid(object):
         
         Units are wavelength * (focal length) / (physical size).
         '''
-        return self.y * self.wavelength * self.focalLength * self._gridToPhysFTGrid
+        return self._coords('pY', lambda: self.y * self.wavelength * self.focalLength * self._gridToPhysFTGrid)
         
     @property
     def pfX(self):
@@ -115,7 +181,7 @@ class Grid(object):
         
         This is spatial frequency fx = x' / (wavelength * focalLength).
         '''
-        return self.x * self._gridToPhysFTGrid
+        return self._coords('pfX', lambda: self.x * self._gridToPhysFTGrid)
     
     @property
     def pfY(self):
@@ -123,7 +189,56 @@ class Grid(object):
         
         This is spatial frequency fy = y' / (wavelength * focalLength).
         '''
-        return self.y * self._gridToPhysFTGrid
+        return self._coords('pfY', lambda: self.y * self._gridToPhysFTGrid)
+    
+    def _coords(self, name, compute):
+        '''Returns a cached, read-only coordinate array.
+        
+        The wavelength and focal length are part of the cache key so that the
+        Fourier transform grids follow changes to them.
+        '''
+        key = (name, self.wavelength, self.focalLength)
+        
+        if key not in self._coordCache:
+            coords = _computeCoords(name, compute)
+            coords.setflags(write = False)
+            self._coordCache[key] = coords
+            
+        return self._coordCache[key]
+    
+    @instrument('grids.Grid.sample')
+    def sample(self, fieldIn):
+        '''Samples an input field once over the full grid.
+        
+        Parameters
+        ----------
+        fieldIn : function or array of complex
+            A real or complex valued function defining an input field
+            distribution, or the field already sampled on this grid. 1D grids
+            call the function as fieldIn(px); 2D grids as fieldIn(px, py).
+            
+        Returns
+        -------
+        fieldSample : array of complex
+            The input field sampled at every grid location.
+            
+        '''
+        if not callable(fieldIn):
+            fieldSample = np.asarray(fieldIn)
+            if fieldSample.shape != self.shape:
+                raise ImproperGridSizeException('The sampled field does not match the shape of the grid.')
+            return fieldSample
+        
+        if self.dim == 2:
+            fieldSample = fieldIn(self.px, self.py)
+        else:
+            fieldSample = fieldIn(self.px)
+        
+        # Fields that are constant along an axis are expanded to the full grid
+        if np.shape(fieldSample) != self.shape:
+            fieldSample = np.broadcast_to(fieldSample, self.shape).copy()
+            
+        return fieldSample
         
 class GridArray(Grid):
     '''An array of grids on a fixed coordinate system.
@@ -132,7 +247,8 @@ class GridArray(Grid):
     by managing the placement of the subgrids on a fixed coordinate system.
     
     '''
-    def __init__(self, numSubgrids, subgridSize, physicalSize, wavelength, focalLength, dim = 2, zeroPad = 3):
+    def __init__(self, numSubgrids, subgridSize, physicalSize, wavelength, focalLength, dim = 2, zeroPad = 3,
+                 precision = None):
         '''Builds an array of grids all lying on a common coordinate system.
         
         Parameters
@@ -155,6 +271,8 @@ class GridArray(Grid):
             to 1 mm and zeropad was to 5, the actual simulation grid will be 5
             times larger and the physical size will be 5 mm, with 2 mm worth of
             zeros on both sides of the subgrid.
+        precision    : str or None
+            'double' or 'single'. See Grid.
        
         ''' 
         if (not isinstance(numSubgrids, int)) or isEven(numSubgrids) or (numSubgrids <= 0):
@@ -168,20 +286,26 @@ class GridArray(Grid):
         
         # Build the common coordinate system
         gridSize = zeroPad * numSubgrids * subgridSize
-        super(GridArray, self).__init__(gridSize, zeroPad * physicalSize, wavelength, focalLength, dim = dim)
+        super(GridArray, self).__init__(gridSize, zeroPad * physicalSize, wavelength, focalLength, dim = dim,
+                                        precision = precision)
         
         # Set the centers of the subgrids. They will only exist in the
         # non-zeropadded regions
         self.subgridCenters = subgridSize * np.arange(-np.floor(numSubgrids / 2), np.floor(numSubgrids / 2) + 1)
-        self.subgridx, self.subgridy = np.meshgrid(self.subgridCenters, self.subgridCenters)
+        self.subgridx       = self.subgridCenters[np.newaxis, :]
+        self.subgridy       = self.subgridCenters[:, np.newaxis]
         
+    @instrument('grids.GridArray.rect')
     def rect(self, fieldIn, xInd):
         '''Samples an input 1D field on the given subgrid.
         
         Parameters
         ----------
-        fieldIn : function
-            A 2D, real or complex valued function defining an input field distribution.
+        fieldIn : function or 1D array of complex
+            A 1D, real or complex valued function defining an input field
+            distribution, or the field already sampled on the grid (see
+            Grid.sample). Passing the sampled field avoids re-evaluating the
+            function for every subgrid.
         xInd    : int
             x-index (column) of the subgrid.
         
@@ -191,25 +315,28 @@ class GridArray(Grid):
             The input field on the given subgrid.
             
         '''
-        xCenter = self.subgridCenters[xInd]
-        
         # Sample the field onto the grid
-        fieldSample = fieldIn(self.px)
+        fieldSample = self.sample(fieldIn)
+        
+        # Keep only the samples of the specified subgrid
+        subgrid = self.subgridSlice(xInd)
         
-        # Create a mask centered on the specified subgrid
-        sgHalfSize = np.floor(self.subgridSize / 2)
-        mask       = np.logical_and(self.x >= (xCenter - sgHalfSize), (self.x <= xCenter + sgHalfSize))
+        masked          = np.zeros(self.shape, dtype = np.result_type(fieldSample, int))
+        masked[subgrid] = fieldSample[subgrid]
 
         # Return the sampled and masked field
-        return fieldSample * mask.astype(int)
+        return masked
     
+    @instrument('grids.GridArray.rect2')
     def rect2(self, fieldIn, xInd, yInd):
         '''Samples an input 2D field at the given subgrid.
         
         Parameters
         ----------
-        fieldIn : function
-            A 2D, real or complex valued function defining an input field distribution.
+        fieldIn : function or 2D array of complex
+            A 2D, real or complex valued function defining an input field
+            distribution, or the field already sampled on the grid (see
+            Grid.sample).
         xInd    : int
             x-index (column) of the subgrid.
         yInd    : int
@@ -221,16 +348,34 @@ class GridArray(Grid):
             The input field at the given subgrid.
             
         '''
-        xCenter, yCenter = self.subgridCenters[xInd], self.subgridCenters[yInd]
-        
         # Sample the field onto the grid
-        fieldSample = fieldIn(self.px, self.py)
+        fieldSample = self.sample(fieldIn)
+        
+        # Keep only the samples of the specified subgrid
+        subgrid = (self.subgridSlice(yInd), self.subgridSlice(xInd))
         
-        # Create a mask centered on the specified subgrid
-        sgHalfSize = np.floor(self.subgridSize / 2)
-        maskX      = np.logical_and(self.x >= (xCenter - sgHalfSize), (self.x <= xCenter + sgHalfSize))
-        maskY      = np.logical_and(self.y >= (yCenter - sgHalfSize), (self.y <= yCenter + sgHalfSize))
-        mask       = np.logical_and(maskX, maskY)
+        masked          = np.zeros(self.shape, dtype = np.result_type(fieldSample, int))
+        masked[subgrid] = fieldSample[subgrid]
 
         # Return the sampled and masked field
-        return fieldSample * mask.astype(int)
\ No newline at end of file
+        return masked
+    
+    def subgridSlice(self, ind):
+        '''Returns the slice of grid locations covered by a subgrid along one axis.
+        
+        Parameters
+        ----------
+        ind : int
+            Index of the subgrid along the axis.
+            
+        Returns
+        -------
+        subgrid : slice
+            The grid locations of the subgrid, e.g. field[subgrid] is a view of
+            the samples of a 1D field inside the subgrid.
+            
+        '''
+        center     = int(self.subgridCenters[ind]) + self.gridSize // 2
+        sgHalfSize = self.subgridSize // 2
+        
+        return slice(center - sgHalfSize, center + sgHalfSize + 1)
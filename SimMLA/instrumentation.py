@@ -0,0 +1,307 @@
+# © All rights reserved. ECOLE POLYTECHNIQUE FEDERALE DE LAUSANNE, Switzerland,
+# Laboratory of Experimental Biophysics, 2016
+# See the LICENSE.docx file for more details.
+
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+from collections import namedtuple
+from contextlib  import contextmanager
+import numpy as np
+
+# One instrumented call. start and duration are in seconds, outputBytes is the
+# size of the arrays returned by the call and peakBytes the peak memory
+# allocated during the call (None unless memory is traced).
+Event = namedtuple('Event', ['name', 'start', 'duration', 'depth', 'thread', 'outputBytes', 'peakBytes',
+                             'details'])
+
+class Collector(object):
+    '''Records the instrumented calls of SimMLA while it is the current collector.
+
+    Examples
+    --------
+    >>> with useCollector(Collector(traceMemory = True)) as collector:
+    ...     pipeline(rng)
+    >>> print(collector.summary())
+    >>> collector.saveChromeTrace('realization.json')
+
+    '''
+    def __init__(self, traceMemory = False):
+        '''
+        Parameters
+        ----------
+        traceMemory : bool
+            Record the peak memory allocated by every call with tracemalloc.
+            This slows down the calls that allocate many small objects.
+
+        '''
+        self.traceMemory = traceMemory
+        self.events      = []
+        self._origin     = time.perf_counter()
+        self._local      = threading.local()
+        self._tracing    = False
+
+    def __len__(self):
+        return len(self.events)
+
+    def call(self, name, function, args, kwargs, details = None):
+        '''Calls function(*args, **kwargs) and records an Event.
+
+        '''
+        stack = self._stack()
+        frame = None
+        if self._traceMemory():
+            # Keep the parent's peak so far before the reset discards it
+            current, peak = tracemalloc.get_traced_memory()
+            if stack and stack[-1] is not None:
+                stack[-1][1] = max(stack[-1][1], peak)
+            frame = [current, 0]
+            tracemalloc.reset_peak()
+        stack.append(frame)
+
+        start = time.perf_counter()
+        try:
+            result = function(*args, **kwargs)
+        finally:
+            duration = time.perf_counter() - start
+            stack.pop()
+
+        peakBytes = None
+        if frame is not None:
+            # The peaks of nested calls and the peaks of this call before
+            # them are kept in frame[1], since every call resets the peak of
+            # tracemalloc
+            peak      = max(tracemalloc.get_traced_memory()[1], frame[1])
+            peakBytes = peak - frame[0]
+            if stack and stack[-1] is not None:
+                stack[-1][1] = max(stack[-1][1], peak)
+
+        self.events.append(Event(name, start - self._origin, duration, len(stack), threading.get_ident(),
+                                 _nbytes(result), peakBytes,
+                                 details(*args, **kwargs) if details is not None else None))
+
+        return result
+
+    def merge(self, other):
+        '''Appends the events of another collector, e.g. one of a worker process.
+
+        '''
+        self.events.extend(other.events)
+
+    def clear(self):
+        '''Discards all the events.
+
+        '''
+        self.events = []
+
+    def stop(self):
+        '''Stops tracemalloc if this collector started it.
+
+        tracemalloc slows down every allocation, so useCollector stops it
+        when the collector is no longer current.
+
+        '''
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+
+    def statistics(self):
+        '''Returns the statistics of every instrumented function.
+
+        Returns
+        -------
+        statistics : dict
+            For every name, the number of calls, the total, mean and maximum
+            wall time in seconds, the total size of the outputs and the
+            largest peak memory in bytes, and the distinct FFT lengths.
+
+        '''
+        statistics = {}
+        for event in self.events:
+            stats = statistics.setdefault(event.name, {'calls' : 0, 'total' : 0.0, 'max' : 0.0, 'outputBytes' : 0,
+                                                       'peakBytes' : None, 'fftLengths' : set()})
+            stats['calls']       += 1
+            stats['total']       += event.duration
+            stats['max']          = max(stats['max'], event.duration)
+            stats['outputBytes'] += event.outputBytes
+            if event.peakBytes is not None:
+                stats['peakBytes'] = max(stats['peakBytes'] or 0, event.peakBytes)
+            if event.details and 'length' in event.details:
+                stats['fftLengths'].add(event.details['length'])
+
+        for stats in statistics.values():
+            stats['mean'] = stats['total'] / stats['calls']
+
+        return statistics
+
+    def summary(self):
+        '''Returns a table of the statistics, sorted by decreasing total time.
+
+        Nested calls are included in the time of their callers, so the times
+        do not add up to the duration of the run.
+
+        '''
+        row   = '{0:<40} {1:>8} {2:>12} {3:>12} {4:>12} {5:>12} {6:>12}  {7}'
+        lines = [row.format('function', 'calls', 'total (s)', 'mean (ms)', 'max (ms)', 'output (MiB)',
+                            'peak (MiB)', 'FFT lengths')]
+
+        statistics = self.statistics()
+        for name in sorted(statistics, key = lambda name: -statistics[name]['total']):
+            stats = statistics[name]
+            peak  = '' if stats['peakBytes'] is None else '{0:.1f}'.format(stats['peakBytes'] / 2**20)
+            lines.append(row.format(name, stats['calls'], '{0:.3f}'.format(stats['total']),
+                                    '{0:.3f}'.format(1e3 * stats['mean']), '{0:.3f}'.format(1e3 * stats['max']),
+                                    '{0:.1f}'.format(stats['outputBytes'] / 2**20), peak,
+                                    ' '.join(str(length) for length in sorted(stats['fftLengths'], key = str))))
+
+        return '\n'.join(lines)
+
+    def chromeTrace(self):
+        '''Returns the events in the Chrome trace event format.
+
+        The trace may be opened in chrome://tracing or https://ui.perfetto.dev.
+
+        '''
+        pid    = os.getpid()
+        events = []
+        for event in self.events:
+            args = {'outputBytes' : event.outputBytes}
+            if event.peakBytes is not None:
+                args['peakBytes'] = event.peakBytes
+            if event.details:
+                args.update(event.details)
+
+            events.append({'name' : event.name, 'ph' : 'X', 'pid' : pid, 'tid' : event.thread,
+                           'ts'   : 1e6 * event.start, 'dur' : 1e6 * event.duration, 'args' : args})
+
+        return {'traceEvents' : events, 'displayTimeUnit' : 'ms'}
+
+    def saveChromeTrace(self, fileName):
+        '''Saves the events in the Chrome trace event format.
+
+        '''
+        with open(fileName, 'w') as file:
+            json.dump(self.chromeTrace(), file)
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _traceMemory(self):
+        if not self.traceMemory:
+            return False
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracing = True
+        return True
+
+    def __getstate__(self):
+        # Thread-local storage cannot be pickled; it is rebuilt on unpickling
+        state = self.__dict__.copy()
+        del state['_local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+_collector = None
+
+def setCollector(collector):
+    '''Sets the collector that records the instrumented calls.
+
+    Instrumentation is disabled when the collector is None (the default).
+    An instrumented function then only checks the current collector before
+    calling the original function.
+
+    Returns
+    -------
+    previous : Collector or None
+        The previous collector.
+
+    '''
+    global _collector
+
+    previous, _collector = _collector, collector
+
+    return previous
+
+def getCollector():
+    '''Returns the current collector, or None if instrumentation is disabled.
+
+    '''
+    return _collector
+
+@contextmanager
+def useCollector(collector = None):
+    '''Records the instrumented calls for the duration of a with block.
+
+    Parameters
+    ----------
+    collector : Collector or None
+        Defaults to a new Collector.
+
+    '''
+    collector = Collector() if collector is None else collector
+    previous  = setCollector(collector)
+    try:
+        yield collector
+    finally:
+        setCollector(previous)
+        collector.stop()
+
+def instrument(name = None, details = None):
+    '''Decorates a function whose calls are recorded by the current collector.
+
+    Parameters
+    ----------
+    name    : str or None
+        The name of the events. Defaults to the function's qualified name.
+    details : function or None
+        details(*args, **kwargs) returns a dict of additional information
+        about a call, e.g. {'length' : 20001} for the length of an FFT. It is
+        only evaluated when instrumentation is enabled.
+
+    '''
+    def decorator(function):
+        eventName = name or function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            collector = _collector
+            if collector is None:
+                return function(*args, **kwargs)
+
+            return collector.call(eventName, function, args, kwargs, details)
+
+        return wrapper
+
+    return decorator
+
+def fftDetails(x, axis = -1, axes = None, **kwargs):
+    '''Returns the length and batch size of an FFT of x.
+
+    '''
+    shape   = np.shape(x)
+    axes    = (axis,) if axes is None else axes
+    lengths = [shape[ax] for ax in axes]
+    batch   = int(np.prod(shape)) // max(int(np.prod(lengths)), 1)
+
+    # 2D transforms are described by their shape, e.g. '3213x3213'
+    length = lengths[0] if len(lengths) == 1 else 'x'.join(str(length) for length in lengths)
+
+    return {'length' : length, 'batch' : batch}
+
+def _nbytes(result):
+    '''Returns the size of the arrays in a result, including those in tuples and lists.
+
+    '''
+    if isinstance(result, np.ndarray):
+        return result.nbytes
+    if isinstance(result, (tuple, list)):
+        return sum(item.nbytes for item in result if isinstance(item, np.ndarray))
+    return 0
@@ -0,0 +1,308 @@
+# © All rights reserved. ECOLE POLYTECHNIQUE FEDERALE DE LAUSANNE, Switzerland,
+# Laboratory of Experimental Biophysics, 2016
+# See the LICENSE.docx file for more details.
+
+import os
+import shutil
+import tempfile
+import numpy as np
+from SimMLA.fftbackend import fft, ifft, fftshift, ifftshift
+from SimMLA.instrumentation import instrument
+
+# The default size of the tiles held in memory, in bytes
+TILE_BYTES = 64 * 2**20
+
+class ScratchSpace(object):
+    '''A temporary directory of memory-mapped field planes.
+
+    A 2D GridArray of 21 x 21 lenslets with three times zero padding quickly
+    exceeds the memory of a workstation. Its planes are instead backed by
+    numpy.memmap files in a ScratchSpace, and the routines of this module
+    only hold one tile of rows or columns in memory at a time.
+    fftpack.fft2SubgridDense also works on these planes, since it copies one
+    window per lenslet from its input and scatters the transforms into out.
+
+    The directory and all its planes are deleted by close, which is called
+    when a with block exits.
+
+    Examples
+    --------
+    >>> beam = fields.GaussianBeamDefocused2D(fieldAmp, beamStd, wavelength, dR)
+    >>> with ScratchSpace('/scratch') as scratch:
+    ...     field = samplePlane(beam, mlaGrid, scratch.gridPlane(mlaGrid))
+    ...     field = fftPropagateTiled(field, mlaGrid, L1, out = field)
+    ...     resampler = simfft.SubgridResampler2D(mlaGrid, outputGrid.px, windowPad = 3)
+    ...     lenslets  = simfft.fft2SubgridDense(field, resampler, out = scratch.gridPlane(outputGrid))
+    ...     np.save('lenslets.npy', irradianceTiled(lenslets, out = scratch.plane(lenslets.shape, np.float64)))
+
+    '''
+    def __init__(self, directory = None):
+        '''
+        Parameters
+        ----------
+        directory : str or None
+            The parent of the temporary directory, preferably on a fast local
+            disk. Defaults to the system's temporary directory.
+
+        '''
+        self.directory = tempfile.mkdtemp(prefix = 'simmla-', dir = directory)
+        self.planes    = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def plane(self, shape, dtype):
+        '''Returns a new memory-mapped plane filled with zeros.
+
+        Parameters
+        ----------
+        shape : tuple of int
+        dtype : numpy dtype
+
+        Returns
+        -------
+        plane : numpy.memmap
+            The plane, backed by a file in the scratch directory.
+
+        '''
+        fileName = os.path.join(self.directory, 'plane{0}.dat'.format(len(self.planes)))
+        plane    = np.memmap(fileName, dtype = dtype, mode = 'w+', shape = tuple(shape))
+        self.planes.append(plane)
+
+        return plane
+
+    def gridPlane(self, grid):
+        '''Returns a new plane for a complex field sampled on a grid.
+
+        '''
+        return self.plane(grid.shape, grid.complexDtype)
+
+    def close(self):
+        '''Deletes the planes and the scratch directory.
+
+        The planes must not be used after close.
+
+        '''
+        self.planes = []
+
+        shutil.rmtree(self.directory, ignore_errors = True)
+
+def tiles(size, lineBytes, tileBytes = TILE_BYTES):
+    '''Splits size lines into tiles of about tileBytes bytes.
+
+    Parameters
+    ----------
+    size      : int
+        The number of rows or columns of a plane.
+    lineBytes : int
+        The size of one row or column in bytes.
+    tileBytes : int
+        The largest size of a tile in bytes. A tile holds at least one line.
+
+    Returns
+    -------
+    tiles : list of slice
+
+    '''
+    step = max(1, int(tileBytes // max(lineBytes, 1)))
+
+    return [slice(start, min(start + step, size)) for start in range(0, size, step)]
+
+@instrument('outofcore.samplePlane')
+def samplePlane(fieldIn, grid, out, tileBytes = TILE_BYTES):
+    '''Samples a 2D field function onto a plane, one tile of rows at a time.
+
+    Parameters
+    ----------
+    fieldIn   : function
+        A real or complex valued function fieldIn(px, py) that broadcasts
+        its coordinates, e.g. fields.GaussianBeamDefocused2D.
+    grid      : Grid
+        The 2D grid of the plane.
+    out       : 2D array of complex
+        The plane in which the field is written, e.g. ScratchSpace.gridPlane.
+    tileBytes : int
+
+    Returns
+    -------
+    out : 2D array of complex
+
+    '''
+    for rows in tiles(grid.gridSize, grid.gridSize * out.itemsize, tileBytes):
+        out[rows] = fieldIn(grid.px, grid.py[rows])
+
+    return out
+
+@instrument('outofcore.fft2Tiled')
+def fft2Tiled(plane, out = None, inverse = False, centered = False, scale = 1, tileBytes = TILE_BYTES):
+    '''Computes the 2D FFT of a plane as two passes of 1D FFTs over tiles.
+
+    Parameters
+    ----------
+    plane     : 2D array of complex
+        The plane to transform. It may be a numpy.memmap.
+    out       : 2D array of complex or None
+        The plane in which the transform is written. It may be plane itself.
+        Defaults to a new array in memory.
+    inverse   : bool
+        Compute the inverse transform.
+    centered  : bool
+        Compute fftshift(fft2(ifftshift(plane))), i.e. the transform of a
+        field centered on the grid like in fft2Subgrid.
+    scale     : complex
+        The factor that multiplies the transform, e.g. the scaling factor of
+        a lens Fourier transform.
+    tileBytes : int
+        The size of the tiles held in memory.
+
+    Returns
+    -------
+    out : 2D array of complex
+
+    '''
+    transform = ifft if inverse else fft
+    if out is None:
+        out = np.empty(plane.shape, dtype = np.result_type(plane.dtype, np.complex64))
+
+    numRows, numCols = plane.shape
+
+    # Shifts along one axis commute with the transforms along the other one
+    for rows in tiles(numRows, numCols * out.itemsize, tileBytes):
+        tile = np.array(plane[rows])
+        if centered:
+            tile = ifftshift(tile, axes = -1)
+        tile = transform(tile, axis = -1, overwrite_x = True)
+        out[rows] = fftshift(tile, axes = -1) if centered else tile
+
+    for cols in tiles(numCols, numRows * out.itemsize, tileBytes):
+        tile = np.array(out[:, cols])
+        if centered:
+            tile = ifftshift(tile, axes = 0)
+        tile = transform(tile, axis = 0, overwrite_x = True)
+        if scale != 1:
+            tile *= scale
+        out[:, cols] = fftshift(tile, axes = 0) if centered else tile
+
+    return out
+
+def fftPropagateTiled(plane, grid, propDistance, out = None, tileBytes = TILE_BYTES):
+    '''Propagates a 2D plane along the optical axis with tiled FFTs.
+
+    See TiledPropagator.
+
+    '''
+    return TiledPropagator(grid, propDistance, tileBytes = tileBytes)(plane, out = out)
+
+class TiledPropagator(object):
+    '''Propagates 2D planes with the angular spectrum method over tiles.
+
+    The kernel exp(j * kz * L) is the 2D counterpart of the one of
+    fftpack.propagationKernel, with the same spatial frequencies and the same
+    treatment of the evanescent waves. It is never stored in full; every
+    tile of columns computes its part from the 1D frequency vectors. The 2D
+    transforms are computed as 1D transforms along the rows and then along
+    the columns, so the propagation takes three passes over the plane: the
+    forward transforms along the rows, the forward transforms, kernel and
+    inverse transforms along the columns, and the inverse transforms along
+    the rows.
+
+    '''
+    def __init__(self, grid, propDistance, tileBytes = TILE_BYTES):
+        '''
+        Parameters
+        ----------
+        grid         : Grid
+            The 2D grid of the planes.
+        propDistance : float or sequence of float
+            The distance to propagate the planes. A sequence of distances is
+            chained into one propagation.
+        tileBytes    : int
+            The size of the tiles held in memory.
+
+        '''
+        self.grid         = grid
+        self.propDistance = float(np.sum(propDistance))
+        self.tileBytes    = tileBytes
+
+        # Spatial frequencies in FFT-native ordering
+        self._fx = ifftshift(np.ravel(grid.pfX))
+        self._fy = ifftshift(np.ravel(grid.pfY))
+
+    def kernel(self, cols):
+        '''Returns the columns cols of the propagation kernel.
+
+        '''
+        fSquared = self._fx[np.newaxis, cols]**2 + self._fy[:, np.newaxis]**2
+
+        # Evanescent waves are passed unchanged, like in propagationKernel
+        kz = 2 * np.pi * np.sqrt(np.maximum(1 - fSquared * self.grid.wavelength**2, 0)) / self.grid.wavelength
+
+        return np.exp(1j * kz * self.propDistance).astype(self.grid.complexDtype, copy = False)
+
+    @instrument('outofcore.TiledPropagator')
+    def __call__(self, plane, out = None):
+        '''Propagates a plane.
+
+        Parameters
+        ----------
+        plane : 2D array of complex
+            The field sampled on the grid. It may be a numpy.memmap.
+        out   : 2D array of complex or None
+            The plane in which the propagated field is written. It may be
+            plane itself. Defaults to a new array in memory.
+
+        Returns
+        -------
+        out : 2D array of complex
+
+        '''
+        if out is None:
+            out = np.empty(plane.shape, dtype = self.grid.complexDtype)
+
+        numRows, numCols = plane.shape
+
+        for rows in tiles(numRows, numCols * out.itemsize, self.tileBytes):
+            out[rows] = fft(np.asarray(plane[rows]), axis = -1)
+
+        for cols in tiles(numCols, numRows * out.itemsize, self.tileBytes):
+            tile  = fft(np.array(out[:, cols]), axis = 0, overwrite_x = True)
+            tile *= self.kernel(cols)
+            out[:, cols] = ifft(tile, axis = 0, overwrite_x = True)
+
+        for rows in tiles(numRows, numCols * out.itemsize, self.tileBytes):
+            out[rows] = ifft(np.array(out[rows]), axis = -1, overwrite_x = True)
+
+        return out
+
+@instrument('outofcore.irradianceTiled')
+def irradianceTiled(plane, out = None, scale = 1, tileBytes = TILE_BYTES):
+    '''Computes scale * abs(plane)**2 one tile of rows at a time.
+
+    Parameters
+    ----------
+    plane     : 2D array of complex
+    out       : 2D array of float or None
+        Defaults to a new array in memory.
+    scale     : float
+        E.g. 1000 / Z0 for mW.
+    tileBytes : int
+
+    Returns
+    -------
+    out : 2D array of float
+
+    '''
+    if out is None:
+        out = np.empty(plane.shape, dtype = plane.real.dtype)
+
+    numRows, numCols = plane.shape
+    for rows in tiles(numRows, numCols * plane.itemsize, tileBytes):
+        tile  = np.abs(plane[rows])
+        tile *= tile
+        tile *= scale
+        out[rows] = tile
+
+    return out
@@ -0,0 +1,479 @@
+# © All rights reserved. ECOLE POLYTECHNIQUE FEDERALE DE LAUSANNE, Switzerland,
+# Laboratory of Experimental Biophysics, 2016
+# See the LICENSE.docx file for more details.
+
+import numpy             as np
+from SimMLA.fftbackend   import fft, fftshift, ifftshift
+import SimMLA.fftpack    as simfft
+import SimMLA.fields     as fields
+from SimMLA.propagation  import ScaledPropagator
+
+class ImproperTapException(Exception):
+    pass
+
+class IlluminationPipeline(object):
+    '''The 1D illumination path of a flat-field epi-illumination setup.
+
+    The pipeline models the chain of the publication's simulations:
+
+    0. 'focus'    : the source sampled at the diffuser and propagated a
+                    distance -dR to the focus of the telescope
+    1. 'mla'      : the Fourier transform by the collimating lens, propagated
+                    a distance L1 to the first microlens array
+    2. 'lenslets' : the field just beyond the second microlens array
+                    (fftSubgridDense, or fftpack.FullApertureMLA)
+    3. 'bfp'      : the field propagated a distance L2 to the objective's back
+                    focal plane and truncated by its aperture
+    4. 'sample'   : the Fourier transform by the objective
+
+    All the grids, propagation kernels and index maps are computed once when
+    the pipeline is created. Only the irradiance of the planes listed in taps
+    is computed, and the chain stops after the last of them.
+
+    Sources that return a fields.GaussianBeam (see GaussianSource) are
+    propagated in closed form until the field behind the microlens arrays.
+
+    '''
+    TAPS = ('focus', 'mla', 'lenslets', 'bfp', 'sample')
+
+    def __init__(self, source, collGrid, mlaGrid, outputGrid, dR, L1, L2, bfpDiam,
+                 taps            = ('sample',),
+                 windowPad       = None,
+                 irradianceScale = 1,
+                 bfpGrid         = None,
+                 fullAperture    = False):
+        '''Builds the plan of the simulation.
+
+        Parameters
+        ----------
+        source          : function
+            source(grid, rng) returns one realization of the field at the
+            diffuser sampled on grid.px, drawing any random numbers from the
+            numpy.random.Generator rng (see DiffusedGaussianSource), or a
+            fields.GaussianBeam (see GaussianSource).
+        collGrid        : Grid
+            The 1D grid at the diffuser. Its focal length is the one of the
+            collimating lens.
+        mlaGrid         : GridArray
+            The 1D grid array of the microlens arrays. Its focal length is the
+            one of the lenslets.
+        outputGrid      : Grid
+            The 1D grid behind the second microlens array. Its focal length is
+            the one of the objective.
+        dR              : float
+            The distance of the diffuser from the focus of the telescope.
+        L1              : float
+            The distance between the collimating lens' focal plane and the
+            first microlens array.
+        L2              : float
+            The distance between the second microlens array and the
+            objective's back focal plane.
+        bfpDiam         : float
+            The diameter of the objective's back focal plane.
+        taps            : sequence of str
+            The planes whose irradiance is returned by each realization, in
+            the order in which they are returned. See TAPS.
+        windowPad       : int (odd) or None
+            The window used to transform the lenslets. See fftSubgridStack.
+        irradianceScale : float
+            The irradiance is scale * abs(field)**2, e.g. 1000 / Z0 for mW.
+        bfpGrid         : Grid or None
+            The 1D grid of the back focal plane. Its focal length is the one
+            of the objective. If given, the field is propagated from
+            outputGrid to bfpGrid with the Fresnel integral (see
+            propagation.ScaledPropagator), so outputGrid only needs to span
+            the microlens arrays instead of being zero padded for the
+            propagation over L2. Defaults to outputGrid, which uses the angular
+            spectrum method.
+        fullAperture    : bool
+            Model the microlens arrays with one propagation over the full
+            mlaGrid (see fftpack.FullApertureMLA) instead of transforming
+            every lenslet. The cost no longer grows with the number of
+            lenslets, and the light diffracted into the neighboring lenslets
+            is kept. windowPad is then ignored.
+
+        '''
+        for tap in taps:
+            if tap not in self.TAPS:
+                raise ImproperTapException('Unknown tap {0}. Valid taps are {1}.'.format(tap, self.TAPS))
+
+        self.source          = source
+        self.collGrid        = collGrid
+        self.mlaGrid         = mlaGrid
+        self.outputGrid      = outputGrid
+        self.dR              = dR
+        self.L1              = L1
+        self.L2              = L2
+        self.bfpDiam         = bfpDiam
+        self.taps            = tuple(taps)
+        self.windowPad       = windowPad
+        self.irradianceScale = irradianceScale
+        self.bfpGrid         = outputGrid if bfpGrid is None else bfpGrid
+        self.fullAperture    = fullAperture
+
+        # Propagation kernels
+        self._toFocus = simfft.Propagator(collGrid,   -dR)
+        self._toMLA   = simfft.Propagator(mlaGrid,    L1)
+        if bfpGrid is None:
+            self._toBFP = simfft.Propagator(outputGrid, L2)
+        else:
+            self._toBFP = ScaledPropagator(outputGrid, bfpGrid, L2)
+
+        # Scaling factors of the Fourier transforms by the lenses
+        self._collScaling = collGrid.physicalSize / (collGrid.gridSize - 1) \
+                          / np.sqrt(collGrid.wavelength * collGrid.focalLength)
+        self._objScaling  = self.bfpGrid.physicalSize / (self.bfpGrid.gridSize - 1) \
+                          / np.sqrt(self.bfpGrid.wavelength * self.bfpGrid.focalLength)
+
+        # Index maps between the grids
+        self._collToMLA = simfft.NearestResampler(collGrid.pX, mlaGrid.px)
+        if fullAperture:
+            self._fullAperture = simfft.FullApertureMLA(mlaGrid)
+            self._lenslets     = simfft.NearestResampler(mlaGrid.px, outputGrid.px)
+        else:
+            self._lenslets     = simfft.SubgridResampler(mlaGrid, outputGrid.px, windowPad = windowPad)
+
+        # The region outside of the objective's aperture
+        self._outsideBFP = np.logical_or(self.bfpGrid.px < -bfpDiam / 2, self.bfpGrid.px > bfpDiam / 2)
+
+        # Buffers reused by every realization
+        self._mlaBuffer   = np.empty(mlaGrid.gridSize, dtype = mlaGrid.complexDtype)
+        self._irradBuffer = {tap : np.empty(self.coordinates(tap).size, dtype = self._grid(tap).realDtype)
+                             for tap in self.taps}
+
+        self._stages = (self._focus, self._mla, self._lensletsStage, self._bfp, self._sample)
+
+    def __call__(self, rng = None):
+        '''Computes one realization; see realization.
+
+        This makes a pipeline usable with ensemble.runEnsemble.
+
+        '''
+        return self.realization(rng)
+
+    def coordinates(self, tap):
+        '''Returns the physical coordinates of a tap's plane.
+
+        '''
+        if tap == 'sample':
+            return self.bfpGrid.pX
+
+        return self._grid(tap).px
+
+    def _grid(self, tap):
+        '''Returns the grid of a tap's plane.
+
+        '''
+        grids = {'focus'    : self.collGrid,
+                 'mla'      : self.mlaGrid,
+                 'lenslets' : self.outputGrid,
+                 'bfp'      : self.bfpGrid,
+                 'sample'   : self.bfpGrid}
+
+        return grids[tap]
+
+    def realization(self, rng = None):
+        '''Computes the irradiance in the tapped planes for one realization.
+
+        Parameters
+        ----------
+        rng : numpy.random.Generator or None
+            The source of random numbers for the source. numpy's global random
+            state is used if None.
+
+        Returns
+        -------
+        irrad : tuple of 1D arrays of float
+            The irradiance in each plane listed in taps. The arrays are reused
+            by the next call, so copy them to keep them.
+
+        '''
+        irrad = {}
+        for tap, field in self.stages(rng = rng):
+            if tap in self.taps:
+                irrad[tap] = self.irradiance(tap, field)
+
+        return tuple(irrad[tap] for tap in self.taps)
+
+    def modeIrradiance(self, modes):
+        '''Computes the average irradiance in the tapped planes from coherent modes.
+
+        Each mode is propagated through the chain in place of a realization
+        of the source, and the irradiances of the modes are summed. This is a
+        deterministic alternative to averaging random realizations for
+        partially coherent sources with a known mode expansion.
+
+        Parameters
+        ----------
+        modes : fields.GSMModes
+            The modes of the field at the diffuser, e.g.
+            GSMModes.fromScreen(amplitude, beamStd, sigma_f, sigma_r, collGrid,
+            position = dR) for a DiffusedGaussianSource.
+
+        Returns
+        -------
+        irrad : tuple of 1D arrays of float
+            The irradiance in each plane listed in taps, in double precision.
+
+        '''
+        irrad = {tap : np.zeros(self.coordinates(tap).size) for tap in self.taps}
+
+        for mode in modes(self.collGrid.px, dtype = self.collGrid.complexDtype):
+            # The first stage samples the source, so the mode enters just after it
+            field = self._toFocus(mode)
+            if 'focus' in irrad:
+                irrad['focus'] += self.irradiance('focus', field)
+
+            for tap, field in self.stages(field = field, start = 1):
+                if tap in irrad:
+                    irrad[tap] += self.irradiance(tap, field)
+
+        return tuple(irrad[tap] for tap in self.taps)
+
+    def stages(self, field = None, rng = None, start = 0, stop = None):
+        '''Generates the field in each plane of the chain.
+
+        Parameters
+        ----------
+        field : 1D array of complex or None
+            The field in the plane of stage start - 1. It is ignored when
+            start is 0, since the first stage samples the source.
+        rng   : numpy.random.Generator or None
+            The source of random numbers for the source.
+        start : int
+            The index in TAPS of the first stage to compute.
+        stop  : int or None
+            The index in TAPS of the stage following the last one to compute.
+            Defaults to the stage following the last tap.
+
+        Yields
+        ------
+        tap   : str
+            The name of the plane.
+        field : 1D array of complex
+            The field in this plane.
+
+        '''
+        if stop is None:
+            stop = self.lastStage() + 1
+
+        for stage in range(start, stop):
+            field = self._stages[stage](field, rng)
+
+            yield self.TAPS[stage], field
+
+    def irradiance(self, tap, field):
+        '''Computes scale * abs(field)**2 in the buffer of a tap.
+
+        The buffer is reused by the next call, so copy the result to keep it.
+        A GaussianBeam is first sampled on the coordinates of the tap.
+
+        '''
+        out = self._irradBuffer[tap]
+
+        if isinstance(field, fields.GaussianBeam):
+            field = field(self.coordinates(tap), dtype = self._grid(tap).complexDtype)
+
+        np.abs(field, out = out)
+        np.square(out, out = out)
+        out *= self.irradianceScale
+
+        return out
+
+    def lastStage(self):
+        '''Returns the index in TAPS of the last stage that must be computed.
+
+        '''
+        return max(self.TAPS.index(tap) for tap in self.taps)
+
+    def signatures(self):
+        '''Returns a hashable description of the inputs of every stage.
+
+        Two pipelines compute the same field in a plane when the signatures of
+        all the stages up to and including this plane are equal. This is how
+        sweep.runSweep finds the stages shared by the points of a sweep.
+
+        The focus only samples the source on collGrid, so its signature leaves
+        out the collimator's focal length, which enters with the Fourier
+        transform into the MLA plane. The bfp signature records the
+        propagator, since giving bfpGrid switches to the Fresnel integral.
+        irradianceScale is not part of any stage; every point scales the
+        irradiance of the shared stages itself.
+
+        '''
+        return (('focus',    self.source, _samplingKey(self.collGrid), self.dR),
+                ('mla',      self.collGrid.focalLength, _gridKey(self.mlaGrid), self.L1),
+                ('lenslets', _gridKey(self.outputGrid), self.windowPad, self.fullAperture),
+                ('bfp',      type(self._toBFP).__name__, _gridKey(self.bfpGrid), self.L2, self.bfpDiam),
+                ('sample',))
+
+    def _focus(self, field, rng):
+        '''Samples the source and propagates it to the focus of the telescope.
+
+        '''
+        return self._toFocus(self.source(self.collGrid, rng))
+
+    def _mla(self, field, rng):
+        '''Transforms the field by the collimating lens and propagates it to the MLA.
+
+        '''
+        if isinstance(field, fields.GaussianBeam):
+            return self._toMLA(field.fourierTransform(self.collGrid.focalLength))
+
+        afterColl  = fftshift(fft(ifftshift(field), overwrite_x = True))
+        afterColl *= self._collScaling
+
+        return self._toMLA(self._collToMLA(afterColl, out = self._mlaBuffer))
+
+    def _lensletsStage(self, field, rng):
+        '''Computes the field just beyond the second microlens array.
+
+        '''
+        if self.fullAperture:
+            return self._lenslets(self._fullAperture(field))
+
+        return simfft.fftSubgridDense(field, self._lenslets)
+
+    def _bfp(self, field, rng):
+        '''Propagates the field to the objective's back focal plane and truncates it.
+
+        '''
+        field = self._toBFP(field)
+        field[self._outsideBFP] = 0.0
+
+        return field
+
+    def _sample(self, field, rng):
+        '''Transforms the field by the objective.
+
+        '''
+        field  = fftshift(fft(ifftshift(field), overwrite_x = True))
+        field *= self._objScaling
+
+        return field
+
+class GaussianSource(object):
+    '''A coherent, defocused Gaussian beam.
+
+    The source returns a fields.GaussianBeam instead of a sampled field, so
+    the pipeline propagates it in closed form up to and including the
+    transforms by the lenslets. The stages after the microlens arrays, where
+    the field is no longer Gaussian, use FFTs.
+
+    '''
+    def __init__(self, amplitude, beamStd, wavelength, position):
+        '''
+        Parameters
+        ----------
+        amplitude  : float
+            The amplitude of the Gaussian beam.
+        beamStd    : float
+            The standard deviation of the beam's waist.
+        wavelength : float
+        position   : float
+            The axial position of the source plane relative to the waist.
+
+        '''
+        self.amplitude  = amplitude
+        self.beamStd    = beamStd
+        self.wavelength = wavelength
+        self.position   = position
+
+    def __call__(self, grid, rng = None):
+        '''Returns the beam in the source plane. grid and rng are not used.
+
+        '''
+        return fields.GaussianBeam(self.amplitude, self.beamStd, self.wavelength, self.position)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self._parameters() == other._parameters()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._parameters())
+
+    def _parameters(self):
+        return (self.amplitude, self.beamStd, self.wavelength, self.position)
+
+class DiffusedGaussianSource(object):
+    '''A defocused Gaussian beam passing through a random diffuser.
+
+    This is the source of the publication's simulations: the field of
+    GaussianBeamDefocused multiplied by one realization of diffuserMask. It
+    can be pickled, so it can be used with pipelines that run in worker
+    processes.
+
+    '''
+    def __init__(self, amplitude, beamStd, wavelength, position, sigma_f, sigma_r):
+        '''
+        Parameters
+        ----------
+        amplitude  : float
+            The amplitude of the Gaussian beam.
+        beamStd    : float
+            The standard deviation of the beam's waist.
+        wavelength : float
+        position   : float
+            The axial position of the diffuser relative to the waist.
+        sigma_f    : float
+            The correlation length of the diffuser.
+        sigma_r    : float
+            The strength of the random phase of the diffuser.
+
+        '''
+        self.amplitude  = amplitude
+        self.beamStd    = beamStd
+        self.wavelength = wavelength
+        self.position   = position
+        self.sigma_f    = sigma_f
+        self.sigma_r    = sigma_r
+
+    def __call__(self, grid, rng = None):
+        '''Returns one realization of the field sampled on grid.px.
+
+        The field has the precision of the grid.
+
+        '''
+        beam   = fields.GaussianBeamDefocused(self.amplitude, self.beamStd, self.wavelength, self.position)
+        field  = beam(grid.px, dtype = grid.complexDtype)
+        field *= fields.diffuserMask(self.sigma_f, self.sigma_r, grid, rng = rng)(grid.px)
+
+        return field
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self._parameters() == other._parameters()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._parameters())
+
+    def _parameters(self):
+        return (self.amplitude, self.beamStd, self.wavelength, self.position, self.sigma_f, self.sigma_r)
+
+def _samplingKey(grid):
+    '''Returns a hashable description of the sampling of a grid in real space.
+
+    '''
+    return (grid.gridSize,
+            grid.physicalSize,
+            grid.wavelength,
+            grid.dim,
+            grid.precision)
+
+def _gridKey(grid):
+    '''Returns a hashable description of the geometry of a grid.
+
+    '''
+    return (type(grid).__name__,
+            grid.gridSize,
+            grid.physicalSize,
+            grid.wavelength,
+            grid.focalLength,
+            grid.dim,
+            grid.precision,
+            getattr(grid, 'numSubgrids', None),
+            getattr(grid, 'subgridSize', None))
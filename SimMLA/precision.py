@@ -0,0 +1,81 @@
+# © All rights reserved. ECOLE POLYTECHNIQUE FEDERALE DE LAUSANNE, Switzerland,
+# Laboratory of Experimental Biophysics, 2016
+# See the LICENSE.docx file for more details.
+
+from contextlib import contextmanager
+import numpy as np
+
+class UnknownPrecisionException(Exception):
+    pass
+
+# The real and complex types of the fields of each precision
+PRECISIONS = {'double' : (np.dtype(np.float64), np.dtype(np.complex128)),
+              'single' : (np.dtype(np.float32), np.dtype(np.complex64))}
+
+_precision = 'double'
+
+def setPrecision(precision):
+    '''Sets the default precision of the grids and fields created afterwards.
+
+    Single precision halves the memory of the fields, propagation kernels and
+    phase screens and speeds up their transforms. Coordinates and the sums of
+    random realizations are always kept in double precision.
+
+    Parameters
+    ----------
+    precision : str
+        'double' (the default) or 'single'.
+
+    Returns
+    -------
+    previous : str
+        The previous precision.
+
+    '''
+    global _precision
+
+    checkPrecision(precision)
+    previous, _precision = _precision, precision
+
+    return previous
+
+def getPrecision():
+    '''Returns the default precision.
+
+    '''
+    return _precision
+
+@contextmanager
+def usePrecision(precision):
+    '''Sets the default precision for the duration of a with block.
+
+    Examples
+    --------
+    >>> with usePrecision('single'):
+    ...     grid = Grid(20001, 5000, 0.642, 4000, dim = 1)
+
+    '''
+    previous = setPrecision(precision)
+    try:
+        yield precision
+    finally:
+        setPrecision(previous)
+
+def checkPrecision(precision):
+    '''Raises an exception if precision is not a known precision.
+
+    '''
+    if precision not in PRECISIONS:
+        raise UnknownPrecisionException('Unknown precision {0}. Valid precisions are {1}.'.format(precision, tuple(PRECISIONS)))
+
+def realType(precision = None):
+    '''Returns the real dtype of a precision, by default the current one.
+
+    '''
+    return PRECISIONS[precision or _precision][0]
+
+def complexType(precision = None):
+    '''Returns the complex dtype of a precision, by default the current one.
+
+    '''
+    return PRECISIONS[precision or _precision][1]
@@ -0,0 +1,345 @@
+# © All rights reserved. ECOLE POLYTECHNIQUE FEDERALE DE LAUSANNE, Switzerland,
+# Laboratory of Experimental Biophysics, 2016
+# See the LICENSE.docx file for more details.
+
+import numpy           as np
+from SimMLA.fftbackend import fft, fft2, ifft, ifft2, nextFastLength
+from SimMLA.fftbackend import fftshift, ifftshift
+from SimMLA.fields     import GaussianBeam
+from SimMLA.grids      import Grid
+from SimMLA.instrumentation import instrument
+
+def bandLimitedPropagate(field, grid, propDistance, padFactor = 2):
+    '''Propagates a sampled field with the band-limited angular spectrum method.
+
+    See BandLimitedPropagator.
+
+    '''
+    return BandLimitedPropagator(grid, propDistance, padFactor = padFactor)(field)
+
+class BandLimitedPropagator(object):
+    '''Propagates sampled 1D or 2D fields with the band-limited angular spectrum method.
+
+    The field is zero padded by padFactor only for the duration of the
+    transforms, and the spatial frequencies whose propagation kernel is
+    undersampled on the padded grid are discarded (K. Matsushima and T.
+    Shimobaba, Opt. Express 17, 19662 (2009)). Unlike fftPropagate, the field
+    does not need to be surrounded by zeros on the grid itself, and the
+    result stays free of the aliasing of the kernel at long distances.
+
+    '''
+    def __init__(self, grid, propDistance, padFactor = 2):
+        '''Prepares the band-limited propagation kernel.
+
+        Parameters
+        ----------
+        grid         : Grid
+            The grid on which the sampled fields lie.
+        propDistance : float or sequence of float
+            The distance to propagate the fields. A sequence of distances is
+            chained into a single propagation.
+        padFactor    : float
+            The factor by which the fields are zero padded during the
+            transforms. Its size is rounded up to a fast FFT length. Use 1 for
+            no padding.
+
+        '''
+        self.grid         = grid
+        self.propDistance = float(np.sum(propDistance))
+        self.size         = nextFastLength(int(np.ceil(padFactor * grid.gridSize)), odd = False)
+
+        dx    = grid.physicalSize / (grid.gridSize - 1)
+        freqs = np.fft.fftfreq(self.size, dx)
+
+        # Frequencies above the limit alias the kernel's phase on the padded grid
+        fLimit = 1 / (grid.wavelength * np.sqrt((2 * self.propDistance / (self.size * dx))**2 + 1))
+
+        if grid.dim == 2:
+            fx, fy   = freqs[np.newaxis, :], freqs[:, np.newaxis]
+            passband = np.logical_and(np.abs(fx) <= fLimit, np.abs(fy) <= fLimit)
+            fSquared = fx**2 + fy**2
+        else:
+            passband = np.abs(freqs) <= fLimit
+            fSquared = freqs**2
+
+        kz = 2 * np.pi * np.sqrt(np.maximum(1 - fSquared * grid.wavelength**2, 0)) / grid.wavelength
+
+        self.kernel = np.where(passband, np.exp(1j * kz * self.propDistance), 0).astype(grid.complexDtype)
+
+    @instrument('propagation.BandLimitedPropagator')
+    def __call__(self, field):
+        '''Propagates a sampled field.
+
+        Parameters
+        ----------
+        field : array of complex or GaussianBeam
+            The sampled field to propagate. A 1D grid accepts a stack of
+            fields along the first axis.
+
+        Returns
+        -------
+        fieldProp : array of complex or GaussianBeam
+            The propagated field. GaussianBeams are propagated analytically.
+
+        '''
+        if isinstance(field, GaussianBeam):
+            return field.propagate(self.propDistance)
+
+        field  = np.asarray(field)
+        n      = self.grid.gridSize
+        padded = np.zeros(field.shape[:-self.grid.dim] + self.kernel.shape,
+                          dtype = np.result_type(field.dtype, self.grid.complexDtype))
+
+        # The kernel is shift invariant, so the field may sit anywhere in the padded array
+        if self.grid.dim == 2:
+            padded[..., :n, :n] = field
+            spectrum  = fft2(padded, overwrite_x = True)
+            spectrum *= self.kernel
+
+            return ifft2(spectrum, overwrite_x = True)[..., :n, :n]
+
+        padded[..., :n] = field
+        spectrum  = fft(padded, overwrite_x = True)
+        spectrum *= self.kernel
+
+        return ifft(spectrum, overwrite_x = True)[..., :n]
+
+def scaledPropagate(field, srcGrid, dstGrid, propDistance):
+    '''Propagates a sampled field between grids of different sampling and extent.
+
+    See ScaledPropagator.
+
+    '''
+    return ScaledPropagator(srcGrid, dstGrid, propDistance)(field)
+
+class ScaledPropagator(object):
+    '''Propagates sampled fields between two grids with the Fresnel integral.
+
+    The Fresnel diffraction integral is evaluated directly on the
+    coordinates of the destination grid with the chirp z-transform
+    (Bluestein's algorithm), so the source and destination grids may have
+    any sizes and spacings. No zero padding of the source grid is needed;
+    the cost is a few FFTs of length gridSize(src) + gridSize(dst) - 1.
+
+    The chirp exp(j * pi * x**2 / (wavelength * L)) of the source must be
+    sampled by the source grid, i.e. its spacing must be smaller than
+    wavelength * L / physicalSize. This holds for the long distances
+    between the microlens arrays and the objective, and
+    BandLimitedPropagator should be used for shorter ones.
+
+    2D grids are propagated separably along x and y.
+
+    '''
+    def __init__(self, srcGrid, dstGrid, propDistance):
+        '''Prepares the chirps of the transform.
+
+        Parameters
+        ----------
+        srcGrid      : Grid
+            The grid on which the sampled fields lie.
+        dstGrid      : Grid
+            The grid on which the propagated fields are returned. It must have
+            the same dimension and wavelength as srcGrid.
+        propDistance : float or sequence of float
+            The distance to propagate the fields. Must not be zero.
+
+        '''
+        if srcGrid.dim != dstGrid.dim:
+            raise ValueError('The source and destination grids must have the same dimension.')
+
+        self.srcGrid      = srcGrid
+        self.dstGrid      = dstGrid
+        self.propDistance = float(np.sum(propDistance))
+
+        if self.propDistance == 0:
+            raise ValueError('The Fresnel integral requires a nonzero propagation distance.')
+
+        self._x = _FresnelTransform(np.ravel(srcGrid.px), np.ravel(dstGrid.px), srcGrid.wavelength,
+                                    self.propDistance, dstGrid.complexDtype)
+        if srcGrid.dim == 2:
+            self._y = _FresnelTransform(np.ravel(srcGrid.py), np.ravel(dstGrid.py), srcGrid.wavelength,
+                                        self.propDistance, dstGrid.complexDtype)
+
+        # The 1D transforms omit the piston phase, which is only applied once
+        self._piston = np.exp(2j * np.pi * self.propDistance / srcGrid.wavelength)
+
+    @instrument('propagation.ScaledPropagator')
+    def __call__(self, field):
+        '''Propagates a sampled field.
+
+        Parameters
+        ----------
+        field : array of complex or GaussianBeam
+            The field sampled on srcGrid. A 1D grid accepts a stack of fields
+            along the first axis.
+
+        Returns
+        -------
+        fieldProp : array of complex or GaussianBeam
+            The field sampled on dstGrid. GaussianBeams are propagated
+            analytically.
+
+        '''
+        if isinstance(field, GaussianBeam):
+            return field.propagate(self.propDistance)
+
+        fieldProp = self._x(np.asarray(field), axis = -1)
+        if self.srcGrid.dim == 2:
+            fieldProp = self._y(fieldProp, axis = -2)
+
+        fieldProp *= self._piston
+
+        return fieldProp
+
+@instrument('propagation.twoStepFresnel')
+def twoStepFresnel(field, grid, propDistance, scale):
+    '''Propagates a sampled field in two Fresnel steps that rescale the grid.
+
+    The field is propagated to an intermediate plane at
+    propDistance / (1 - scale) and from there to the destination plane. Each
+    step is a single centered FFT, and the destination grid has the same
+    number of points as the source grid but a spacing scale times
+    larger (see J. D. Schmidt, Numerical Simulation of Optical Wave
+    Propagation, SPIE (2010)).
+
+    Parameters
+    ----------
+    field        : array of complex
+        The field sampled on grid. A 1D grid accepts a stack of fields along
+        the first axis.
+    grid         : Grid
+    propDistance : float
+    scale        : float
+        The ratio of the spacing of the destination grid to the one of the
+        source grid. Must be positive and not 1; a negative scale would
+        mirror the field.
+
+    Returns
+    -------
+    fieldProp : array of complex
+        The propagated field.
+    dstGrid   : Grid
+        The grid on which fieldProp lies.
+
+    '''
+    if scale == 1:
+        raise ValueError('twoStepFresnel cannot propagate without rescaling the grid.')
+    if scale <= 0:
+        raise ValueError('The scale of twoStepFresnel must be positive.')
+
+    n          = grid.gridSize
+    dx         = grid.physicalSize / (n - 1)
+    itmDist    = propDistance / (1 - scale)
+    itmSpacing = grid.wavelength * abs(itmDist) / (n * dx)
+    dstGrid    = Grid(n, scale * grid.physicalSize, grid.wavelength, grid.focalLength,
+                      dim = grid.dim, precision = grid.precision)
+
+    coords    = np.ravel(grid.x)
+    fieldProp = np.asarray(field)
+    for axis in range(-grid.dim, 0):
+        itm       = _fresnelStep(fieldProp, coords * dx, coords * itmSpacing, grid.wavelength, itmDist, axis)
+        fieldProp = _fresnelStep(itm, coords * itmSpacing, coords * scale * dx, grid.wavelength,
+                                 propDistance - itmDist, axis)
+
+    fieldProp *= np.exp(2j * np.pi * propDistance / grid.wavelength)
+
+    return fieldProp.astype(dstGrid.complexDtype, copy = False), dstGrid
+
+def _fresnelStep(field, srcX, dstX, wavelength, propDistance, axis):
+    '''Evaluates the 1D Fresnel integral on the reciprocal grid of srcX with one FFT.
+
+    dstX must have the spacing wavelength * abs(propDistance) / (n * dx). The
+    piston phase is omitted.
+
+    '''
+    dx    = srcX[1] - srcX[0]
+    shape = [1] * field.ndim
+    shape[axis] = srcX.size
+
+    inChirp  = np.exp(1j * np.pi * srcX**2 / (wavelength * propDistance)).reshape(shape)
+    outChirp = np.exp(1j * np.pi * dstX**2 / (wavelength * propDistance)).reshape(shape) \
+             * dx / np.sqrt(1j * wavelength * propDistance)
+
+    # The sign of the kernel exp(-2j * pi * x * x' / (wavelength * L)) follows the one of L
+    weighted = ifftshift(field * inChirp, axes = axis)
+    if propDistance > 0:
+        spectrum = fft(weighted, axis = axis, overwrite_x = True)
+    else:
+        spectrum = srcX.size * ifft(weighted, axis = axis, overwrite_x = True)
+
+    return fftshift(spectrum, axes = axis) * outChirp
+
+class _FresnelTransform(object):
+    '''The 1D Fresnel integral between evenly spaced coordinates, without the piston phase.
+
+    '''
+    def __init__(self, srcX, dstX, wavelength, propDistance, dtype):
+        dx, dxOut = srcX[1] - srcX[0], dstX[1] - dstX[0]
+        lz        = wavelength * propDistance
+
+        # x * x' = x0 * x' + n * dx * x0' + n * m * dx * dx' on the two grids
+        self.czt = ChirpZ(srcX.size, dstX.size, theta = -2 * np.pi * dx * dxOut / lz,
+                          phi = 2 * np.pi * dx * dstX[0] / lz, dtype = dtype)
+
+        self.inChirp  = np.exp(1j * np.pi * srcX**2 / lz).astype(dtype)
+        self.outChirp = (np.exp(1j * np.pi * dstX**2 / lz - 2j * np.pi * srcX[0] * dstX / lz)
+                         * dx / np.sqrt(1j * lz)).astype(dtype)
+
+    def __call__(self, field, axis = -1):
+        field     = np.moveaxis(field, axis, -1)
+        fieldProp = self.czt(field * self.inChirp)
+        fieldProp *= self.outChirp
+
+        return np.moveaxis(fieldProp, -1, axis)
+
+class ChirpZ(object):
+    '''The chirp z-transform along the last axis, computed with Bluestein's algorithm.
+
+    The transform of x is X[k] = sum(x[n] * exp(-1j * phi * n) * exp(1j * theta * n * k))
+    for k = 0, ..., m - 1, i.e. it samples the discrete-time Fourier transform
+    of x on any evenly spaced set of frequencies. It is computed as a
+    convolution with FFTs of a fast length of at least n + m - 1.
+
+    '''
+    def __init__(self, n, m, theta, phi = 0.0, dtype = np.complex128):
+        '''Precomputes the chirps.
+
+        Parameters
+        ----------
+        n     : int
+            The length of the input.
+        m     : int
+            The length of the output.
+        theta : float
+            The angular spacing of the output frequencies.
+        phi   : float
+            The angular frequency of the first output sample, with a minus sign.
+        dtype : numpy.dtype
+            The complex dtype of the chirps and of the result.
+
+        '''
+        self.n    = n
+        self.m    = m
+        self.size = nextFastLength(n + m - 1, odd = False)
+
+        # n * k = (n**2 + k**2 - (k - n)**2) / 2
+        ns, ks = np.arange(n, dtype = np.float64), np.arange(m, dtype = np.float64)
+        self.inChirp  = np.exp(-1j * phi * ns + 0.5j * theta * ns**2).astype(dtype)
+        self.outChirp = np.exp(0.5j * theta * ks**2).astype(dtype)
+
+        lags = np.zeros(self.size, dtype = np.complex128)
+        lags[:m]                 = np.exp(-0.5j * theta * ks**2)
+        lags[self.size - n + 1:] = np.exp(-0.5j * theta * ns[:0:-1]**2)
+        self.lagSpectrum = fft(lags.astype(dtype), overwrite_x = True)
+
+    def __call__(self, x):
+        padded = np.zeros(x.shape[:-1] + (self.size,), dtype = self.inChirp.dtype)
+        np.multiply(x, self.inChirp, out = padded[..., :self.n])
+
+        spectrum  = fft(padded, overwrite_x = True)
+        spectrum *= self.lagSpectrum
+
+        X  = ifft(spectrum, overwrite_x = True)[..., :self.m]
+        X *= self.outChirp
+
+        return X
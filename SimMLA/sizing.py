@@ -0,0 +1,336 @@
+# © All rights reserved. ECOLE POLYTECHNIQUE FEDERALE DE LAUSANNE, Switzerland,
+# Laboratory of Experimental Biophysics, 2016
+# See the LICENSE.docx file for more details.
+
+import warnings
+import numpy as np
+from SimMLA.fftbackend import nextFastLength
+from SimMLA.grids      import Grid, GridArray
+
+class SamplingWarning(UserWarning):
+    pass
+
+def angularBandwidth(beamStd, cohLength = None, numStd = 5):
+    '''Returns the largest spatial frequency of a Gaussian Schell-model beam.
+
+    The angular spectrum of a GSM beam is Gaussian with a standard deviation
+    of sqrt(1 / (2 * beamStd**2) + 1 / cohLength**2) / (2 * pi) in spatial
+    frequency. It does not change when the beam propagates, so the waist's
+    beamStd is used for defocused beams.
+
+    Parameters
+    ----------
+    beamStd   : float
+        The standard deviation of the field at the waist, as in
+        fields.GaussianBeamDefocused.
+    cohLength : float or None
+        The coherence length of the beam, e.g. behind a diffuser. None for a
+        coherent beam.
+    numStd    : float
+        The number of standard deviations of the angular spectrum's
+        irradiance that are kept.
+
+    '''
+    invCoh2 = 0 if cohLength is None else 1 / cohLength**2
+
+    return numStd * np.sqrt(1 / (2 * beamStd**2) + invCoh2) / (2 * np.pi)
+
+def nyquistSpacing(bandwidth, oversampling = 1):
+    '''Returns the largest grid spacing that samples a band-limited field.
+
+    '''
+    return 1 / (2 * bandwidth * oversampling)
+
+def propagationSpread(bandwidth, wavelength, propDistance):
+    '''Returns how far a band-limited field spreads on each side when it propagates.
+
+    The angular spectrum method wraps the spread field around the grid, so
+    the grid must be larger than the field by twice this distance.
+
+    '''
+    return wavelength * abs(propDistance) * bandwidth
+
+def sizeGrid(fieldWidth, bandwidth, wavelength, focalLength, propDistance = 0, oversampling = 1,
+             minPhysicalSize = 0, dim = 1, warnOnly = False):
+    '''Returns the smallest Grid that samples a field without aliasing.
+
+    The grid spacing satisfies the Nyquist criterion for the bandwidth, the
+    grid is large enough for the field to spread over propDistance without
+    wrapping around, and its size is rounded up to a fast odd FFT length.
+
+    Parameters
+    ----------
+    fieldWidth      : float
+        The full width of the field.
+    bandwidth       : float
+        The largest spatial frequency of the field (see angularBandwidth).
+    wavelength      : float
+    focalLength     : float
+        The focal length of the grid; see Grid.
+    propDistance    : float
+        The longest distance over which the field is propagated on the grid.
+    oversampling    : float
+        The factor by which the grid spacing is finer than the Nyquist limit.
+    minPhysicalSize : float
+        A lower bound on the physical size, e.g. to resolve the Fourier
+        transform of the grid.
+    dim             : int
+        The dimension of the grid.
+
+    Returns
+    -------
+    grid : Grid
+
+    '''
+    dx     = nyquistSpacing(bandwidth, oversampling)
+    extent = max(fieldWidth + 2 * propagationSpread(bandwidth, wavelength, propDistance), minPhysicalSize)
+
+    gridSize = nextFastLength(int(np.ceil(extent / dx)) + 1)
+
+    return Grid(gridSize, (gridSize - 1) * dx, wavelength, focalLength, dim = dim)
+
+def sizeGridArray(numLenslets, pitch, bandwidth, wavelength, focalLength, propDistance = 0,
+                  oversampling = 1, fieldWidth = None, dim = 1):
+    '''Returns the smallest GridArray that samples a field on a lenslet array.
+
+    The subgrid size is the smallest fast odd length whose spacing satisfies
+    the Nyquist criterion, and zeroPad is the smallest fast odd factor of at
+    least 3 that keeps the field from wrapping around over propDistance. The
+    lower bound of 3, the default of GridArray, keeps the field of the outer
+    lenslets from wrapping around onto the opposite edge of the array.
+
+    The transform length of the grid is zeroPad * numLenslets * subgridSize.
+    It is only fast if numLenslets has no prime factor larger than 7, e.g. 21
+    but not 23; a SamplingWarning is raised otherwise.
+
+    Parameters
+    ----------
+    numLenslets  : int
+        The number of lenslets along one dimension. Must be odd.
+    pitch        : float
+        The width of one lenslet.
+    bandwidth    : float
+        The largest spatial frequency of the field.
+    wavelength   : float
+    focalLength  : float
+        The focal length of the lenslets.
+    propDistance : float
+        The longest distance over which the field is propagated on the grid.
+    oversampling : float
+        The factor by which the grid spacing is finer than the Nyquist limit.
+    fieldWidth   : float or None
+        The full width of the field. Defaults to the width of the array.
+    dim          : int
+        The dimension of the grid.
+
+    Returns
+    -------
+    grid : GridArray
+
+    '''
+    physicalSize = numLenslets * pitch
+    if fieldWidth is None:
+        fieldWidth = physicalSize
+
+    # The spacing of a GridArray is pitch / subgridSize, up to the odd size
+    dx          = nyquistSpacing(bandwidth, oversampling)
+    subgridSize = nextFastLength(int(np.ceil(pitch / dx)))
+
+    extent  = max(fieldWidth, physicalSize) + 2 * propagationSpread(bandwidth, wavelength, propDistance)
+    zeroPad = nextFastLength(max(int(np.ceil(extent / physicalSize)), 3))
+
+    grid = GridArray(numLenslets, subgridSize, physicalSize, wavelength, focalLength,
+                     dim = dim, zeroPad = zeroPad)
+    _checkLength(grid, 'grid')
+
+    return grid
+
+def checkGrid(grid, bandwidth, fieldWidth = None, propDistance = 0, maxOversampling = 8, name = 'grid'):
+    '''Warns if a grid is under- or oversampled for a field.
+
+    The grid is also reported if its size is not a fast FFT length, which
+    happens for a GridArray whose number of lenslets has a prime factor
+    larger than 7.
+
+    Parameters
+    ----------
+    grid            : Grid or GridArray
+    bandwidth       : float
+        The largest spatial frequency of the field.
+    fieldWidth      : float or None
+        The full width of the field. The extent of the grid is not checked
+        if None.
+    propDistance    : float
+        The longest distance over which the field is propagated on the grid.
+    maxOversampling : float
+        The ratio of the Nyquist spacing to the grid spacing above which the
+        grid is reported as oversampled.
+    name            : str
+        The name of the grid in the warnings.
+
+    Returns
+    -------
+    oversampling : float
+        The ratio of the Nyquist spacing to the grid spacing. Values below 1
+        mean that the field is aliased.
+
+    '''
+    dx           = grid.physicalSize / (grid.gridSize - 1)
+    oversampling = nyquistSpacing(bandwidth) / dx
+
+    if oversampling < 1:
+        warnings.warn('The {0} is undersampled by a factor {1:.2f}: its spacing is {2:.3g} but the '
+                      'field requires {3:.3g}.'.format(name, 1 / oversampling, dx, nyquistSpacing(bandwidth)),
+                      SamplingWarning)
+    elif oversampling > maxOversampling:
+        warnings.warn('The {0} is oversampled by a factor {1:.1f}: a spacing of {2:.3g} instead of {3:.3g} '
+                      'would be enough.'.format(name, oversampling, nyquistSpacing(bandwidth), dx),
+                      SamplingWarning)
+
+    if fieldWidth is not None:
+        extent = fieldWidth + 2 * propagationSpread(bandwidth, grid.wavelength, propDistance)
+        if grid.physicalSize < extent:
+            warnings.warn('The {0} is too small: the field wraps around unless its size is at least '
+                          '{1:.3g} instead of {2:.3g}.'.format(name, extent, grid.physicalSize),
+                          SamplingWarning)
+
+    _checkLength(grid, name)
+
+    return oversampling
+
+def _checkLength(grid, name):
+    '''Warns if the size of a grid is not a fast FFT length.
+
+    '''
+    fastLength = nextFastLength(grid.gridSize, odd = False)
+    if grid.gridSize != fastLength:
+        warnings.warn('The size {1} of the {0} is not a fast FFT length; the next fast length is '
+                      '{2}.'.format(name, grid.gridSize, fastLength), SamplingWarning)
+
+def sizeIllumination(wavelength, beamStd, dR, cohLength, fc, numLenslets, pitch, lensletFocalLength,
+                     L1, L2, objFocalLength, numStd = 5, oversampling = 1):
+    '''Returns the smallest grids of the publication's illumination path.
+
+    The grids are those of pipeline.IlluminationPipeline. The field at the
+    diffuser is propagated by -dR to the telescope's focus on collGrid,
+    Fourier transformed by the collimating lens onto mlaGrid, propagated
+    over L1 and transformed by the lenslets, and finally propagated over L2
+    on outputGrid.
+
+    Parameters
+    ----------
+    wavelength         : float
+    beamStd            : float
+        The standard deviation of the beam's field at its waist, the focus of
+        the telescope.
+    dR                 : float
+        The distance of the diffuser from the focus.
+    cohLength          : float or None
+        The coherence length of the field behind the diffuser. None for a
+        coherent beam.
+    fc                 : float
+        The focal length of the collimating lens.
+    numLenslets        : int
+        The number of lenslets along one dimension.
+    pitch              : float
+        The width of one lenslet.
+    lensletFocalLength : float
+    L1                 : float
+        The distance between the collimating lens' focal plane and the first
+        microlens array.
+    L2                 : float
+        The distance between the second microlens array and the objective's
+        back focal plane.
+    objFocalLength     : float
+    numStd             : float
+        The number of standard deviations of the irradiance of the beam and
+        of its angular spectrum that are kept.
+    oversampling       : float
+        The factor by which the grid spacings are finer than the Nyquist
+        limit.
+
+    Returns
+    -------
+    collGrid, mlaGrid, outputGrid : Grid, GridArray, Grid
+
+    Examples
+    --------
+    >>> collGrid, mlaGrid, outputGrid = sizeIllumination(0.642, 6, -5000, 10, 50000,
+    ...                                                  21, 500, 13700,
+    ...                                                  700000, 200000, 3300)
+
+    '''
+    bandwidths, widths, propDistances = _illuminationBudget(wavelength, beamStd, dR, cohLength, fc,
+                                                            numLenslets, pitch, lensletFocalLength,
+                                                            L1, L2, numStd)
+
+    mlaGrid  = sizeGridArray(numLenslets, pitch, bandwidths['mla'], wavelength, lensletFocalLength,
+                             propDistance = propDistances['mla'], oversampling = oversampling,
+                             fieldWidth = widths['mla'])
+    mlaDx    = mlaGrid.physicalSize / (mlaGrid.gridSize - 1)
+
+    # The Fourier transform of collGrid must resolve the spacing of mlaGrid
+    collGrid = sizeGrid(widths['coll'], bandwidths['coll'], wavelength, fc,
+                        propDistance = propDistances['coll'], oversampling = oversampling,
+                        minPhysicalSize = wavelength * fc / mlaDx)
+
+    outputGrid = sizeGrid(widths['output'], bandwidths['output'], wavelength, objFocalLength,
+                          propDistance = propDistances['output'], oversampling = oversampling)
+
+    return collGrid, mlaGrid, outputGrid
+
+def checkIllumination(collGrid, mlaGrid, outputGrid, beamStd, dR, cohLength, L1, L2, numStd = 5,
+                      maxOversampling = 8):
+    '''Warns if the grids of an illumination path are under- or oversampled.
+
+    The parameters are those of sizeIllumination; the grids are those of
+    pipeline.IlluminationPipeline.
+
+    Returns
+    -------
+    oversampling : dict
+        The ratio of the Nyquist spacing to the spacing of each grid.
+
+    '''
+    bandwidths, widths, propDistances = _illuminationBudget(collGrid.wavelength, beamStd, dR, cohLength,
+                                                            collGrid.focalLength, mlaGrid.numSubgrids,
+                                                            mlaGrid.physicalSize / mlaGrid.gridSize * mlaGrid.subgridSize,
+                                                            mlaGrid.focalLength, L1, L2, numStd)
+
+    grids = {'coll' : collGrid, 'mla' : mlaGrid, 'output' : outputGrid}
+
+    return {name : checkGrid(grid, bandwidths[name], widths[name], propDistances[name],
+                             maxOversampling = maxOversampling, name = name + 'Grid')
+            for name, grid in grids.items()}
+
+def _illuminationBudget(wavelength, beamStd, dR, cohLength, fc, numLenslets, pitch, lensletFocalLength,
+                        L1, L2, numStd):
+    '''Returns the bandwidth, width and propagation distance of the field on each grid.
+
+    '''
+    # The irradiance of the beam has a standard deviation of beamStd / sqrt(2)
+    # at the waist and spreads by the diffraction of the diffuser's speckle
+    # at the focus.
+    waist   = np.sqrt(2) * beamStd
+    zR      = np.pi * waist**2 / wavelength
+    diffStd = beamStd / np.sqrt(2) * np.sqrt(1 + (dR / zR)**2)
+    if cohLength is None:
+        focusStd = beamStd / np.sqrt(2)
+    else:
+        focusStd = np.sqrt(beamStd**2 / 2 + (wavelength * dR / (2 * np.pi * cohLength))**2)
+
+    sourceBandwidth = angularBandwidth(beamStd, cohLength, numStd)
+    focusHalfWidth  = numStd * focusStd
+
+    # The lenslets' transforms must also span one pitch in their focal planes
+    bandwidths = {'coll'   : sourceBandwidth,
+                  'mla'    : max(focusHalfWidth / (wavelength * fc), pitch / (2 * wavelength * lensletFocalLength)),
+                  'output' : pitch / (2 * wavelength * lensletFocalLength)}
+
+    widths = {'coll'   : 2 * numStd * max(diffStd, focusStd),
+              'mla'    : 2 * wavelength * fc * sourceBandwidth,
+              'output' : numLenslets * pitch}
+
+    propDistances = {'coll' : dR, 'mla' : L1, 'output' : L2}
+
+    return bandwidths, widths, propDistances
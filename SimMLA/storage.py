@@ -0,0 +1,301 @@
+# © All rights reserved. ECOLE POLYTECHNIQUE FEDERALE DE LAUSANNE, Switzerland,
+# Laboratory of Experimental Biophysics, 2016
+# See the LICENSE.docx file for more details.
+
+import json
+import struct
+import zipfile
+import numpy as np
+
+class ImproperCoordinatesException(Exception):
+    pass
+
+def coordinateDescriptor(coords, rtol = 1e-9):
+    '''Describes evenly spaced coordinates by their size, start and spacing.
+
+    Parameters
+    ----------
+    coords : 1D array of float
+        Evenly spaced coordinates, e.g. Grid.px or Grid.pX.
+    rtol   : float
+        The largest deviation from even spacing, relative to the spacing.
+
+    Returns
+    -------
+    descriptor : dict
+        The size, start and spacing of the coordinates. See coordinatesFromDescriptor.
+
+    '''
+    coords = np.ravel(coords)
+    if coords.size < 2:
+        spacing = 0.0
+    else:
+        spacing = (coords[-1] - coords[0]) / (coords.size - 1)
+
+    # The coordinates of an empty plane have no start
+    descriptor = {'size'    : int(coords.size),
+                  'start'   : float(coords[0]) if coords.size else 0.0,
+                  'spacing' : float(spacing)}
+
+    if np.max(np.abs(coordinatesFromDescriptor(descriptor) - coords), initial = 0) > rtol * abs(spacing):
+        raise ImproperCoordinatesException('The coordinates are not evenly spaced.')
+
+    return descriptor
+
+def coordinatesFromDescriptor(descriptor):
+    '''Returns the coordinates described by coordinateDescriptor.
+
+    '''
+    return descriptor['start'] + descriptor['spacing'] * np.arange(descriptor['size'])
+
+def gridDescriptor(grid):
+    '''Returns the parameters that generate a Grid or GridArray.
+
+    '''
+    descriptor = {'type'         : type(grid).__name__,
+                  'gridSize'     : int(grid.gridSize),
+                  'physicalSize' : float(grid.physicalSize),
+                  'wavelength'   : float(grid.wavelength),
+                  'focalLength'  : float(grid.focalLength),
+                  'dim'          : int(grid.dim),
+                  'precision'    : grid.precision}
+
+    if hasattr(grid, 'numSubgrids'):
+        descriptor['numSubgrids'] = int(grid.numSubgrids)
+        descriptor['subgridSize'] = int(grid.subgridSize)
+
+    return descriptor
+
+def saveSweep(fileName, points, avgIrrad, taps, coordinates, grids = None, metadata = None,
+              compress = True, chunkSize = 2**16):
+    '''Saves the averaged irradiance of a sweep to one container file.
+
+    The container is a zip file with the irradiance planes as .npy members
+    and a JSON member with the points of the sweep, the coordinates of every
+    plane as (size, start, spacing) descriptors, the parameters of the grids
+    and any user metadata.
+
+    Compressed planes are split along their first axis into chunks of
+    chunkSize rows, each deflated in its own member, so that SweepStore
+    only decompresses the chunks of the rows that are read. Uncompressed
+    planes are stored in a single member and are memory-mapped by
+    SweepStore instead.
+
+    Parameters
+    ----------
+    fileName    : str
+    points      : list of dict
+        The parameters of every point of the sweep (see sweep.runSweep).
+    avgIrrad    : list of tuples of arrays
+        The irradiance in each tapped plane for every point.
+    taps        : sequence of str
+        The names of the planes, in the order of the tuples in avgIrrad.
+    coordinates : sequence of 1D arrays, or list of sequences of 1D arrays
+        The coordinates of each plane, either one array per tap shared by
+        all the points or one sequence of arrays per point. They must be
+        evenly spaced; only their descriptors are stored.
+    grids       : dict of Grid or None
+        The grids of the simulation, stored by name as their parameters.
+    metadata    : dict or None
+        Any additional JSON-serializable information.
+    compress    : bool
+        Deflate the planes. Compressed planes cannot be memory-mapped, but
+        their chunks can be read individually.
+    chunkSize   : int
+        The number of rows (samples of 1D planes) per chunk of a compressed
+        plane.
+
+    Examples
+    --------
+    >>> points, avgIrrad = runSweep(factory, {'L2' : [100, 150, 200]}, 1000)
+    >>> pipeline = factory(L2 = 100)
+    >>> saveSweep('vary_L2.zip', points, avgIrrad, pipeline.taps,
+    ...           [pipeline.coordinates(tap) for tap in pipeline.taps],
+    ...           grids = {'collGrid' : collGrid, 'mlaGrid' : mlaGrid})
+
+    '''
+    taps = tuple(taps)
+    if len(avgIrrad) != len(points):
+        raise ValueError('avgIrrad must contain one tuple of planes per point.')
+
+    # Coordinates shared by all the points are given as one array per tap
+    if all(isinstance(coords, np.ndarray) for coords in coordinates):
+        coordinates = [coordinates] * len(points)
+
+    shared = {}
+    descriptors = []
+    for pointCoords in coordinates:
+        pointDescriptors = []
+        for coords in pointCoords:
+            # Identical coordinate arrays are only checked once
+            key = id(coords)
+            if key not in shared:
+                shared[key] = coordinateDescriptor(coords)
+            pointDescriptors.append(shared[key])
+        descriptors.append(pointDescriptors)
+
+    header = {'version'     : 2,
+              'chunkSize'   : int(chunkSize) if compress else None,
+              'rows'        : [[len(plane) for plane in planes] for planes in avgIrrad],
+              'taps'        : list(taps),
+              'points'      : points,
+              'coordinates' : descriptors,
+              'grids'       : {name : gridDescriptor(grid) for name, grid in (grids or {}).items()},
+              'metadata'    : metadata or {}}
+
+    compression = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+    with zipfile.ZipFile(fileName, 'w', compression = compression, allowZip64 = True) as container:
+        container.writestr('sweep.json', json.dumps(header, indent = 2, default = _jsonDefault))
+
+        for point, planes in enumerate(avgIrrad):
+            if len(planes) != len(taps):
+                raise ValueError('Point {0} does not have one plane per tap.'.format(point))
+
+            for tap, plane in zip(taps, planes):
+                plane = np.ascontiguousarray(plane)
+                if compress:
+                    chunks = [(_chunkName(point, tap, index), plane[start:start + chunkSize])
+                              for index, start in enumerate(range(0, max(len(plane), 1), chunkSize))]
+                else:
+                    chunks = [(_planeName(point, tap), plane)]
+
+                for name, chunk in chunks:
+                    with container.open(name, 'w', force_zip64 = True) as member:
+                        np.lib.format.write_array(member, chunk, allow_pickle = False)
+
+class SweepStore(object):
+    '''Reads a container written by saveSweep.
+
+    Only the JSON header is read when the store is opened. Every plane is read
+    on request. Uncompressed planes are memory-mapped, and only the chunks of
+    the requested rows of compressed planes are decompressed, so that part
+    of one plane of a large sweep can be used without loading the others.
+
+    Examples
+    --------
+    >>> with SweepStore('vary_L2.zip') as store:
+    ...     x     = store.coordinates(0, 'sample')
+    ...     irrad = store.plane(0, 'sample')
+
+    '''
+    def __init__(self, fileName):
+        self.fileName   = fileName
+        self._container = zipfile.ZipFile(fileName, 'r')
+
+        header = json.loads(self._container.read('sweep.json').decode('utf-8'))
+
+        self.chunkSize = header.get('chunkSize')
+        self._rows     = header.get('rows')
+
+        self.taps     = tuple(header['taps'])
+        self.points   = header['points']
+        self.grids    = header['grids']
+        self.metadata = header['metadata']
+        self._coords  = header['coordinates']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.points)
+
+    def close(self):
+        self._container.close()
+
+    def coordinates(self, point, tap):
+        '''Returns the coordinates of a plane.
+
+        '''
+        return coordinatesFromDescriptor(self._coords[point][self.taps.index(tap)])
+
+    def plane(self, point, tap, mmap = True, rows = None):
+        '''Returns the irradiance in one plane of one point of the sweep.
+
+        Parameters
+        ----------
+        point : int
+            The index of the point in self.points.
+        tap   : str
+        mmap  : bool
+            Memory-map the plane, read-only, if it is stored uncompressed.
+            It is read into memory otherwise.
+        rows  : slice or None
+            Only return these rows (samples of 1D planes). Only the chunks
+            that contain them are decompressed.
+
+        Returns
+        -------
+        plane : array of float
+
+        '''
+        if self.chunkSize is not None:
+            return self._readChunks(point, tap, rows)
+
+        plane = self._readPlane(point, tap, mmap)
+
+        return plane if rows is None else plane[rows]
+
+    def _readChunks(self, point, tap, rows):
+        '''Reads the chunks of a compressed plane that contain rows.
+
+        '''
+        size    = self._rows[point][self.taps.index(tap)]
+        indices = np.arange(size)[slice(None) if rows is None else rows]
+
+        # The first chunk gives the shape and dtype of an empty result
+        first = indices.min() // self.chunkSize if indices.size else 0
+        last  = indices.max() // self.chunkSize if indices.size else 0
+
+        chunks = []
+        for index in range(first, last + 1):
+            with self._container.open(_chunkName(point, tap, index)) as member:
+                chunks.append(np.lib.format.read_array(member, allow_pickle = False))
+
+        return np.concatenate(chunks)[indices - first * self.chunkSize]
+
+    def _readPlane(self, point, tap, mmap):
+        '''Reads or memory-maps a plane that is stored in a single member.
+
+        '''
+        info = self._container.getinfo(_planeName(point, tap))
+
+        if (not mmap) or (info.compress_type != zipfile.ZIP_STORED):
+            with self._container.open(info) as member:
+                return np.lib.format.read_array(member, allow_pickle = False)
+
+        with open(self.fileName, 'rb') as file:
+            # The member's data follows its local header, whose extra field
+            # may differ from the one in the central directory
+            file.seek(info.header_offset)
+            localHeader = file.read(30)
+            nameLength, extraLength = struct.unpack('<HH', localHeader[26:30])
+            file.seek(info.header_offset + 30 + nameLength + extraLength)
+
+            version = np.lib.format.read_magic(file)
+            if version == (1, 0):
+                shape, fortranOrder, dtype = np.lib.format.read_array_header_1_0(file)
+            else:
+                shape, fortranOrder, dtype = np.lib.format.read_array_header_2_0(file)
+            offset = file.tell()
+
+        return np.memmap(self.fileName, dtype = dtype, mode = 'r', offset = offset, shape = shape,
+                         order = 'F' if fortranOrder else 'C')
+
+def _planeName(point, tap):
+    return 'planes/point{0:05d}_{1}.npy'.format(point, tap)
+
+def _chunkName(point, tap, index):
+    return 'planes/point{0:05d}_{1}/chunk{2:05d}.npy'.format(point, tap, index)
+
+def _jsonDefault(obj):
+    '''Converts numpy scalars and arrays in sweep points and metadata.
+
+    '''
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError('{0} is not JSON serializable.'.format(type(obj).__name__))
@@ -0,0 +1,269 @@
+# © All rights reserved. ECOLE POLYTECHNIQUE FEDERALE DE LAUSANNE, Switzerland,
+# Laboratory of Experimental Biophysics, 2016
+# See the LICENSE.docx file for more details.
+
+import json
+import os
+import numpy              as np
+from concurrent.futures   import ProcessPoolExecutor, as_completed
+from itertools            import product
+
+def sweepPoints(parameters):
+    '''Returns the points of the Cartesian product of swept parameters.
+
+    Parameters
+    ----------
+    parameters : dict of sequences
+        The values taken by every swept parameter.
+
+    Returns
+    -------
+    points : list of dict
+        One dict of keyword arguments per point. The last parameter varies
+        the fastest.
+
+    '''
+    names = list(parameters.keys())
+
+    return [dict(zip(names, values)) for values in product(*(parameters[name] for name in names))]
+
+def sharedStages(pipelines):
+    '''Returns the number of leading stages that are identical for all pipelines.
+
+    '''
+    signatures = [pipeline.signatures() for pipeline in pipelines]
+
+    numShared = 0
+    for stageSignatures in zip(*signatures):
+        if any(signature != stageSignatures[0] for signature in stageSignatures[1:]):
+            break
+        numShared += 1
+
+    return numShared
+
+def runSweep(factory, parameters, numRealizations, numWorkers = 1, seed = None,
+             chunkSize = None, checkpointDir = None):
+    '''Averages the irradiance of an IlluminationPipeline over a parameter sweep.
+
+    One pipeline is built per point of the sweep. The leading stages whose
+    signatures (see IlluminationPipeline.signatures) are equal for every
+    point are computed once per realization and their field is shared by the
+    remaining stages of all the points. In a sweep over L2, for example, the
+    source, the telescope and both microlens arrays are computed only once
+    per realization instead of once per point.
+
+    All the points therefore see the same realizations of the source, which
+    are drawn from a numpy.random.SeedSequence exactly like in
+    ensemble.runEnsemble. The result only depends on the seed and the chunk
+    size.
+
+    Parameters
+    ----------
+    factory         : function
+        factory(**point) returns the IlluminationPipeline of one point of the
+        sweep. All the pipelines must tap the same planes.
+    parameters      : dict of sequences
+        The values of the swept parameters. The sweep is their Cartesian
+        product (see sweepPoints).
+    numRealizations : int
+        The number of realizations to average at every point.
+    numWorkers      : int
+        The number of worker processes. The pipelines are sent once to every
+        worker. Realizations are computed in the calling process if this is 1.
+    seed            : int, numpy.random.SeedSequence or None
+        The seed of the random streams. Fresh entropy is used if None.
+    chunkSize       : int or None
+        The number of realizations summed by a worker before its sums are
+        returned. Defaults to a quarter of an equal share per worker.
+    checkpointDir   : str or None
+        A directory where the sums of every finished chunk are saved. A sweep
+        that is interrupted resumes from the saved chunks when it is run
+        again with the same directory, number of realizations and chunk size.
+        The seed is stored as well, so a sweep with fresh entropy (seed is
+        None) also resumes with the same random streams. Resuming with a
+        different seed raises a ValueError.
+
+    Returns
+    -------
+    points   : list of dict
+        The parameters of every point of the sweep.
+    avgIrrad : list of tuples of 1D arrays of float
+        The average irradiance in each tapped plane for every point.
+
+    Examples
+    --------
+    >>> def factory(L2):
+    ...     return IlluminationPipeline(source, collGrid, mlaGrid, outputGrid,
+    ...                                 dR, L1, L2, bfpDiam)
+    >>> points, avgIrrad = runSweep(factory, {'L2' : [100, 150, 200]}, 1000,
+    ...                             numWorkers = 64, seed = 42,
+    ...                             checkpointDir = 'vary_L2')
+
+    '''
+    if (not isinstance(numRealizations, int)) or (numRealizations <= 0):
+        raise ValueError('numRealizations must be a positive integer.')
+    if (not isinstance(numWorkers, int)) or (numWorkers <= 0):
+        raise ValueError('numWorkers must be a positive integer.')
+
+    points    = sweepPoints(parameters)
+    pipelines = [factory(**point) for point in points]
+    if any(pipeline.taps != pipelines[0].taps for pipeline in pipelines[1:]):
+        raise ValueError('All the pipelines of a sweep must tap the same planes.')
+
+    numShared = min(sharedStages(pipelines), pipelines[0].lastStage() + 1)
+
+    if chunkSize is None:
+        chunkSize = int(np.ceil(numRealizations / (4 * numWorkers)))
+
+    freshEntropy = seed is None
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+
+    chunkSums = {}
+    if checkpointDir is not None:
+        seed = _openCheckpoints(checkpointDir, seed, freshEntropy, points, numRealizations, chunkSize)
+        chunkSums.update(_loadCheckpoints(checkpointDir, len(points), len(pipelines[0].taps)))
+
+    seeds   = seed.spawn(numRealizations)
+    chunks  = [seeds[start:start + chunkSize] for start in range(0, numRealizations, chunkSize)]
+    pending = [index for index in range(len(chunks)) if index not in chunkSums]
+
+    if numWorkers == 1:
+        for index in pending:
+            chunkSums[index] = _sumSweep(pipelines, numShared, chunks[index])
+            _saveCheckpoint(checkpointDir, index, chunkSums[index])
+    elif pending:
+        with ProcessPoolExecutor(max_workers = numWorkers,
+                                 initializer = _initWorker,
+                                 initargs    = (pipelines, numShared)) as pool:
+            futures = {pool.submit(_sumSweepWorker, chunks[index]) : index for index in pending}
+            for future in as_completed(futures):
+                index            = futures[future]
+                chunkSums[index] = future.result()
+                _saveCheckpoint(checkpointDir, index, chunkSums[index])
+
+    # Reduce the chunks in order so the result does not depend on the schedule
+    sums = chunkSums[0]
+    for index in range(1, len(chunks)):
+        for pointSums, chunkPointSums in zip(sums, chunkSums[index]):
+            for currSum, chunkSum in zip(pointSums, chunkPointSums):
+                currSum += chunkSum
+
+    avgIrrad = [tuple(currSum / numRealizations for currSum in pointSums) for pointSums in sums]
+
+    return points, avgIrrad
+
+def _sumSweep(pipelines, numShared, seeds):
+    '''Computes the running sums of the irradiance over a chunk of realizations.
+
+    The sums are indexed by point, then by tap.
+
+    '''
+    taps    = pipelines[0].taps
+    sums    = [[np.zeros(pipeline.coordinates(tap).size) for tap in taps] for pipeline in pipelines]
+
+    for currSeed in seeds:
+        rng = np.random.default_rng(currSeed)
+
+        # Stages shared by every point
+        field = None
+        for tap, field in pipelines[0].stages(rng = rng, stop = numShared):
+            if tap in taps:
+                # The points may differ by their irradianceScale
+                for pipeline, pointSums in zip(pipelines, sums):
+                    pointSums[taps.index(tap)] += pipeline.irradiance(tap, field)
+
+        # Stages specific to each point
+        for pipeline, pointSums in zip(pipelines, sums):
+            if numShared == 0:
+                # Nothing is shared, so every point replays the same stream
+                rng = np.random.default_rng(currSeed)
+
+            for tap, pointField in pipeline.stages(field, rng, start = numShared):
+                if tap in taps:
+                    pointSums[taps.index(tap)] += pipeline.irradiance(tap, pointField)
+
+    return sums
+
+_workerState = {}
+
+def _initWorker(pipelines, numShared):
+    '''Stores the pipelines of a sweep in a worker process.
+
+    '''
+    _workerState['pipelines'] = pipelines
+    _workerState['numShared'] = numShared
+
+def _sumSweepWorker(seeds):
+    '''Sums a chunk of realizations with the pipelines of the worker.
+
+    '''
+    return _sumSweep(_workerState['pipelines'], _workerState['numShared'], seeds)
+
+def _openCheckpoints(checkpointDir, seed, freshEntropy, points, numRealizations, chunkSize):
+    '''Creates or validates the description of a checkpointed sweep.
+
+    Returns the seed of the sweep. When the sweep is resumed, the seed is read
+    back from the directory if freshEntropy is True, i.e. if no seed was
+    given; otherwise it must equal the saved one.
+
+    '''
+    if not os.path.isdir(checkpointDir):
+        os.makedirs(checkpointDir)
+
+    description = {'entropy'         : str(seed.entropy),
+                   'spawnKey'        : list(seed.spawn_key),
+                   'points'          : repr(points),
+                   'numRealizations' : numRealizations,
+                   'chunkSize'       : chunkSize}
+
+    fileName = os.path.join(checkpointDir, 'sweep.json')
+    if not os.path.exists(fileName):
+        with open(fileName, 'w') as file:
+            json.dump(description, file, indent = 2)
+        return seed
+
+    with open(fileName, 'r') as file:
+        saved = json.load(file)
+
+    keys = ('points', 'numRealizations', 'chunkSize') if freshEntropy else \
+           ('entropy', 'spawnKey', 'points', 'numRealizations', 'chunkSize')
+    for key in keys:
+        if saved[key] != description[key]:
+            name = 'seed' if key in ('entropy', 'spawnKey') else key
+            raise ValueError('The sweep in {0} has a different {1}.'.format(checkpointDir, name))
+
+    return np.random.SeedSequence(int(saved['entropy']), spawn_key = tuple(saved['spawnKey']))
+
+def _loadCheckpoints(checkpointDir, numPoints, numTaps):
+    '''Loads the sums of the chunks that were already computed.
+
+    '''
+    chunkSums = {}
+    for fileName in os.listdir(checkpointDir):
+        if not (fileName.startswith('chunk_') and fileName.endswith('.npz')):
+            continue
+
+        index = int(fileName[len('chunk_'):-len('.npz')])
+        with np.load(os.path.join(checkpointDir, fileName)) as data:
+            chunkSums[index] = [[data['point{0}_tap{1}'.format(point, tap)] for tap in range(numTaps)]
+                                for point in range(numPoints)]
+
+    return chunkSums
+
+def _saveCheckpoint(checkpointDir, index, sums):
+    '''Saves the sums of one chunk, atomically.
+
+    '''
+    if checkpointDir is None:
+        return
+
+    arrays = {'point{0}_tap{1}'.format(point, tap) : tapSum
+              for point, pointSums in enumerate(sums)
+              for tap, tapSum in enumerate(pointSums)}
+
+    fileName = os.path.join(checkpointDir, 'chunk_{0:06d}.npz'.format(index))
+    tmpName  = fileName + '.tmp'
+    with open(tmpName, 'wb') as file:
+        np.savez(file, **arrays)
+    os.replace(tmpName, fileName)
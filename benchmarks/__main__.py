@@ -0,0 +1,151 @@
+# © All rights reserved. ECOLE POLYTECHNIQUE FEDERALE DE LAUSANNE, Switzerland,
+# Laboratory of Experimental Biophysics, 2016
+# See the LICENSE.docx file for more details.
+
+'''Runs the benchmarks of SimMLA's hot paths.
+
+The benchmarks follow the conventions of airspeed velocity (asv): every
+class in a bench_*.py module has a list of params (the sizes), a setup
+method, time_* methods and an optional teardown method. The check_* methods
+compare the results to the results of the original code in the reference
+directory (see benchmarks.references); they are run once per size and a
+failing check makes the runner exit with status 1.
+
+Usage
+-----
+python -m benchmarks                              # the small size
+python -m benchmarks --size publication -k FFTSubgrid
+python -m benchmarks --size small publication --json results.json
+
+'''
+
+import argparse
+import importlib
+import inspect
+import json
+import pkgutil
+import re
+import sys
+import time
+import tracemalloc
+import benchmarks
+
+def discover(pattern = None):
+    '''Returns the benchmark classes of the bench_* modules, optionally filtered by name.
+
+    '''
+    classes = []
+    for module in pkgutil.iter_modules(benchmarks.__path__):
+        if not module.name.startswith('bench_'):
+            continue
+
+        members = inspect.getmembers(importlib.import_module('benchmarks.' + module.name), inspect.isclass)
+        for name, cls in members:
+            if cls.__module__ != 'benchmarks.' + module.name or not hasattr(cls, 'params'):
+                continue
+            if pattern and not re.search(pattern, '{0}.{1}'.format(module.name, name)):
+                continue
+            classes.append(cls)
+
+    return classes
+
+def timeCall(function, repeat):
+    '''Returns the best and mean wall time of repeated calls, after a warm-up call.
+
+    '''
+    function()
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    return min(times), sum(times) / len(times)
+
+def peakMemory(function):
+    '''Returns the peak memory allocated by one call in bytes, as traced by tracemalloc.
+
+    '''
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return peak
+
+def run(classes, sizes, repeat, checks = True, out = sys.stdout):
+    '''Runs the benchmarks and prints one row per method and size.
+
+    Returns
+    -------
+    results : list of dict
+        The name, size, timings in seconds, peak memory in bytes or check
+        outcome of every benchmark.
+
+    '''
+    results = []
+    row     = '{0:<52} {1:<12} {2:>12} {3:>12} {4:>12}'
+    print(row.format('benchmark', 'size', 'best (ms)', 'mean (ms)', 'peak (MiB)'), file = out)
+
+    for cls in classes:
+        for size in sizes:
+            if size not in cls.params:
+                continue
+
+            instance = cls()
+            try:
+                instance.setup(size)
+            except NotImplementedError:
+                continue
+
+            for name, method in inspect.getmembers(instance, inspect.ismethod):
+                label = '{0}.{1}'.format(cls.__name__, name)
+
+                if name.startswith('time_'):
+                    best, mean = timeCall(lambda: method(size), repeat)
+                    peak       = peakMemory(lambda: method(size))
+                    results.append({'benchmark' : label, 'size' : size, 'best' : best, 'mean' : mean,
+                                    'peakMemory' : peak})
+                    print(row.format(label, size, '{0:.2f}'.format(1e3 * best), '{0:.2f}'.format(1e3 * mean),
+                                     '{0:.1f}'.format(peak / 2**20)), file = out)
+
+                elif name.startswith('check_') and checks:
+                    try:
+                        method(size)
+                        outcome = 'ok'
+                    except AssertionError as error:
+                        outcome = 'FAILED {0}'.format(error)
+                    results.append({'benchmark' : label, 'size' : size, 'check' : outcome})
+                    print(row.format(label, size, outcome, '', ''), file = out)
+
+            # Like asv, teardown releases what setup created, e.g. temporary files
+            if hasattr(instance, 'teardown'):
+                instance.teardown(size)
+
+    return results
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog = 'python -m benchmarks', description = __doc__.split('\n\n')[0])
+    parser.add_argument('--size', nargs = '+', default = ['small'], choices = ['small', 'publication'],
+                        help = 'The sizes of the benchmarks.')
+    parser.add_argument('-k', dest = 'pattern', default = None,
+                        help = 'Only run the classes whose module.Class name matches this regular expression.')
+    parser.add_argument('--repeat', type = int, default = 5, help = 'The number of timed calls.')
+    parser.add_argument('--no-checks', dest = 'checks', action = 'store_false',
+                        help = 'Skip the numerical checks.')
+    parser.add_argument('--json', default = None, help = 'Save the results to a JSON file.')
+    args = parser.parse_args(argv)
+
+    results = run(discover(args.pattern), args.size, args.repeat, checks = args.checks)
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent = 2)
+
+    return 1 if any(result.get('check', 'ok') != 'ok' for result in results) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
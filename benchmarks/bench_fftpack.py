@@ -0,0 +1,142 @@
+# © All rights reserved. ECOLE POLYTECHNIQUE FEDERALE DE LAUSANNE, Switzerland,
+# Laboratory of Experimental Biophysics, 2016
+# See the LICENSE.docx file for more details.
+
+import numpy          as np
+import SimMLA.fftpack as simfft
+import SimMLA.fields  as fields
+from benchmarks       import common
+
+class FFTSubgrid(object):
+    '''The 1D transforms by the lenslets.
+
+    '''
+    params      = ['small', 'publication']
+    param_names = ['size']
+
+    def setup(self, size):
+        self.grid      = common.mlaGrid(size)
+        self.target    = common.outputGrid(size)
+        self.resampler = simfft.SubgridResampler(self.grid, self.target.px)
+        self.mla       = simfft.FullApertureMLA(self.grid)
+
+        # A slowly diverging beam that fills the microlens arrays
+        beamStd    = self.grid.physicalSize / 15
+        self.field = fields.GaussianBeamDefocused(common.fieldAmp, beamStd, common.wavelength, 50000)(self.grid.px)
+
+    def time_fftSubgrid(self, size):
+        simfft.fftSubgrid(self.field, self.grid)
+
+    def time_fftSubgridBatched(self, size):
+        simfft.fftSubgrid(self.field, self.grid, batched = True)
+
+    def time_fftSubgridDense(self, size):
+        simfft.fftSubgridDense(self.field, self.resampler)
+
+    def time_fullAperture(self, size):
+        self.mla(self.field)
+
+    def check_matchesBaseline(self, size):
+        '''The dense transforms equal the sum of the interpolants of the original fftSubgrid.
+
+        '''
+        actual = common.subsample(simfft.fftSubgridDense(self.field, self.resampler))
+
+        error = common.relativeError(actual, common.reference(size, 'fftSubgrid'))
+        assert error < 1e-9, error
+
+class FFT2Subgrid(object):
+    '''The 2D transforms by the lenslets.
+
+    '''
+    params      = ['small', 'publication']
+    param_names = ['size']
+
+    def setup(self, size):
+        self.grid   = common.mlaGrid(size, dim = 2)
+        self.grid1D = common.mlaGrid(size, dim = 1, subgridSize = self.grid.subgridSize)
+
+        # Transforming the full grid for every lenslet is only practical for small 2D grids
+        self.resampler = simfft.SubgridResampler2D(self.grid, self.grid1D.px, windowPad = 3)
+
+        beamStd      = self.grid1D.physicalSize / 15
+        self.field1D = fields.GaussianBeamDefocused(common.fieldAmp, beamStd, common.wavelength, 50000)(self.grid1D.px)
+        self.field   = np.outer(self.field1D, self.field1D)
+
+    def time_fft2SubgridDense(self, size):
+        simfft.fft2SubgridDense(self.field, self.resampler)
+
+class FFT2SubgridSplines(object):
+    '''The spline interpolants of fft2Subgrid and the dense transforms of the full grid.
+
+    They transform the full grid once per lenslet, which takes too long at
+    the publication's size.
+
+    '''
+    params      = ['small']
+    param_names = ['size']
+
+    setup = FFT2Subgrid.setup
+
+    def time_fft2Subgrid(self, size):
+        simfft.fft2Subgrid(self.field, self.grid)
+
+    def check_matchesBaseline(self, size):
+        '''The transform of a separable field is the product of the original 1D transforms.
+
+        The windows of FFT2Subgrid sample the focal planes more coarsely than
+        the original code, so the full grid is transformed for every lenslet.
+
+        '''
+        resampler = simfft.SubgridResampler2D(self.grid, self.grid1D.px)
+        factor    = common.reference(size, 'fftSubgrid2D')
+
+        error = common.relativeError(common.subsample(simfft.fft2SubgridDense(self.field, resampler)),
+                                     np.outer(factor, factor))
+        assert error < 1e-9, error
+
+class Propagate(object):
+    '''The angular spectrum propagation to the microlens arrays.
+
+    '''
+    params      = ['small', 'publication']
+    param_names = ['size']
+
+    def setup(self, size):
+        self.grid  = common.mlaGrid(size)
+        self.beam  = fields.GaussianBeam(common.fieldAmp, self.grid.physicalSize / 45, common.wavelength)
+        self.field = self.beam(self.grid.px)
+
+        simfft.fftPropagate(self.field, self.grid, common.L1)
+
+    def time_fftPropagate(self, size):
+        simfft.fftPropagate(self.field, self.grid, common.L1)
+
+    def time_fftPropagateUncached(self, size):
+        simfft.kernelCache.clear()
+        simfft.fftPropagate(self.field, self.grid, common.L1)
+
+    def check_matchesBaseline(self, size):
+        '''The propagated field equals the one of the original fftPropagate.
+
+        '''
+        actual = common.subsample(simfft.fftPropagate(self.field, self.grid, common.L1))
+
+        error = common.relativeError(actual, common.reference(size, 'fftPropagate'))
+        assert error < 1e-9, error
+
+    def check_propagateMatchesPosition(self, size):
+        '''A beam propagated from one plane to another equals the beam created in the second plane.
+
+        '''
+        beamStd = self.beam.radius / 2
+        for position in (-2 * common.L1, 0, common.L1):
+            for dim in (1, 2):
+                propagated = fields.GaussianBeam(common.fieldAmp, beamStd, common.wavelength, position,
+                                                 dim = dim).propagate(common.L1)
+                expected   = fields.GaussianBeam(common.fieldAmp, beamStd, common.wavelength,
+                                                 position + common.L1, dim = dim)
+
+                error = abs(propagated.constant - expected.constant) / abs(expected.constant)
+                assert error < 1e-9, error
+                assert abs(propagated.q - expected.q) < 1e-9 * abs(expected.q)
@@ -0,0 +1,243 @@
+# © All rights reserved. ECOLE POLYTECHNIQUE FEDERALE DE LAUSANNE, Switzerland,
+# Laboratory of Experimental Biophysics, 2016
+# See the LICENSE.docx file for more details.
+
+import numpy          as np
+import SimMLA.fields  as fields
+import SimMLA.fftpack as simfft
+import SimMLA.grids   as grids
+from benchmarks       import common
+
+class PhaseScreens(object):
+    '''The random phase screens of the diffuser.
+
+    '''
+    params      = ['small', 'publication']
+    param_names = ['size']
+
+    numScreens = 10
+
+    def setup(self, size):
+        self.grid = common.collGrid(size)
+
+    def time_diffuserMask(self, size):
+        mask = fields.diffuserMask(common.sigma_f, common.sigma_r, self.grid, rng = np.random.default_rng(0))
+        for _ in range(self.numScreens):
+            mask(self.grid.px)
+
+    def time_phaseScreens(self, size):
+        fields.phaseScreens(self.numScreens, common.sigma_f, common.sigma_r, self.grid,
+                            rng = np.random.default_rng(0))
+
+    def time_diffuserMasks(self, size):
+        fields.diffuserMasks(self.numScreens, common.sigma_f, common.sigma_r, self.grid,
+                             rng = np.random.default_rng(0))
+
+    def check_matchesBaseline(self, size):
+        '''A batch of one mask and the mask of diffuserMask equal the original mask for the same random numbers.
+
+        '''
+        expected = common.reference(size, 'diffuserMask')
+        mask     = fields.diffuserMask(common.sigma_f, common.sigma_r, self.grid, rng = np.random.RandomState(1))
+        masks    = fields.diffuserMasks(1, common.sigma_f, common.sigma_r, self.grid, rng = np.random.RandomState(1))
+
+        for actual in (mask(self.grid.px), masks[0]):
+            error = common.relativeError(common.subsample(actual), expected)
+            assert error < 1e-9, error
+
+class GSMRealization(object):
+    '''The sampled field of one realization of the diffused beam.
+
+    '''
+    params      = ['small', 'publication']
+    param_names = ['size']
+
+    def setup(self, size):
+        self.grid = common.collGrid(size)
+        self.beam = fields.GaussianBeamDefocused(common.fieldAmp, common.beamStd, common.wavelength, common.dR)
+
+    def time_realization(self, size):
+        mask = fields.diffuserMask(common.sigma_f, common.sigma_r, self.grid, rng = np.random.default_rng(0))
+        self.beam(self.grid.px) * mask(self.grid.px)
+
+    def check_matchesBaseline(self, size):
+        '''The diffused beam equals the original one for the same random numbers.
+
+        '''
+        mask  = fields.diffuserMask(common.sigma_f, common.sigma_r, self.grid, rng = np.random.RandomState(0))
+        field = self.beam(self.grid.px) * mask(self.grid.px)
+
+        error = common.relativeError(common.subsample(field), common.reference(size, 'diffusedBeam'))
+        assert error < 1e-9, error
+
+    def check_power(self, size):
+        '''The diffused beam has a power of 100 mW, as in the notebooks.
+
+        '''
+        mask  = fields.diffuserMask(common.sigma_f, common.sigma_r, self.grid, rng = np.random.default_rng(0))
+        field = self.beam(self.grid.px) * mask(self.grid.px)
+        dx    = self.grid.px[1] - self.grid.px[0]
+
+        power = np.sum(np.abs(field)**2) * dx
+        assert abs(power / common.Z0 * 1000 / common.power - 1) < 1e-3
+
+class GSMModeSum(object):
+    '''The average irradiance of a GSM beam from its coherent modes.
+
+    GSMBeamRealization only resolves the coherence of its screens on grids
+    in m, so this benchmark uses the grid of the GSM Verification notebook
+    with a wider beam.
+
+    '''
+    params      = ['small', 'publication']
+    param_names = ['size']
+
+    beamStd         = 5e-3
+    cohLength       = 8e-3
+    propDistance    = 200
+    numRealizations = 200
+
+    def setup(self, size):
+        self.grid   = grids.Grid(1001, 0.2, 650e-9, 250e-3, dim = 1)
+        self.system = lambda field: simfft.fftPropagate(field, self.grid, self.propDistance)
+
+    def time_modeIrradiance(self, size):
+        modes = fields.GSMModes.fromRealization(1, self.beamStd, self.cohLength, self.grid)
+        modes.irradiance(self.system, self.grid.px)
+
+    def check_matchesRealizations(self, size):
+        '''The propagated irradiance of the modes is the average over realizations of the beam.
+
+        '''
+        modes = fields.GSMModes.fromRealization(1, self.beamStd, self.cohLength, self.grid)
+        beam  = fields.GSMBeamRealization(1, self.beamStd, self.cohLength, self.grid,
+                                          rng = np.random.default_rng(0))
+
+        irradModes = modes.irradiance(self.system, self.grid.px)
+        irradAvg   = sum(np.abs(self.system(beam(self.grid.px)))**2
+                         for _ in range(self.numRealizations)) / self.numRealizations
+
+        rmsWidth = lambda irrad: np.sqrt(np.sum(irrad * self.grid.px**2) / np.sum(irrad))
+        assert abs(rmsWidth(irradModes) / rmsWidth(irradAvg) - 1) < 0.03
+        assert common.relativeError(irradModes, irradAvg) < 0.1
+
+class RotatingDiffuser(object):
+    '''Successive masks of a rotating diffuser as sliding windows of one track.
+
+    The diffuser turns by sigma_f between realizations, so adjacent masks are
+    partially correlated and the track spans many correlation lengths.
+
+    '''
+    params      = ['small', 'publication']
+    param_names = ['size']
+
+    numRealizations = 2000
+    numScreens      = 20
+    radius          = 2e4
+    rotationSpeed   = 10
+
+    def setup(self, size):
+        self.grid         = common.collGrid(size)
+        self.exposureTime = common.sigma_f / (2 * np.pi * self.radius * self.rotationSpeed)
+        self.diffuser     = self.synthesize()
+
+    def synthesize(self):
+        return fields.RotatingDiffuser(common.sigma_f, common.sigma_r, self.grid, self.radius, self.rotationSpeed,
+                                       self.exposureTime, self.numRealizations, rng = np.random.default_rng(0))
+
+    def phaseWindows(self):
+        '''The phase of every mask. The track is shorter than the circumference, so it does not wrap.
+
+        '''
+        step = self.diffuser.stepSize
+        for index in range(self.numRealizations):
+            yield self.diffuser.phase[index * step:index * step + self.grid.gridSize]
+
+    def time_synthesize(self, size):
+        self.synthesize()
+
+    def check_matchesPhaseScreens(self, size):
+        '''The masks have the variance and the coherence of independent phase screens.
+
+        '''
+        screens   = fields.phaseScreens(self.numScreens, common.sigma_f, common.sigma_r, self.grid,
+                                        rng = np.random.default_rng(1))
+        cohLength = fields.screenCoherenceLength(common.sigma_f, common.sigma_r, self.grid)
+        lag       = int(np.round(cohLength / (self.grid.px[1] - self.grid.px[0])))
+
+        # The degree of coherence of the masks at a lag of about cohLength
+        coherence = lambda phase: np.abs(np.mean(np.exp(1j * (phase[lag:] - phase[:-lag]))))
+
+        windows = list(self.phaseWindows())
+        assert self.diffuser.period is None
+        assert abs(np.mean([np.var(phase) for phase in windows]) / np.var(screens) - 1) < 0.1
+
+        expected = np.exp(-(lag * (self.grid.px[1] - self.grid.px[0]))**2 / (2 * cohLength**2))
+        for actual in (np.mean([coherence(phase) for phase in windows]),
+                       np.mean([coherence(phase) for phase in screens])):
+            assert abs(actual - expected) < 0.05, (actual, expected)
+
+    def check_adjacentWindows(self, size):
+        '''Adjacent masks are shifted copies whose phase has the correlation of the screens at that shift.
+
+        '''
+        step = self.diffuser.stepSize
+        for index in (0, self.numRealizations // 2, self.numRealizations - 2):
+            assert np.array_equal(self.diffuser[index + 1][:-step], self.diffuser[index][step:])
+
+        # The screens have the Gaussian autocorrelation exp(-dx**2 / (2 * sigma_f**2))
+        windows     = list(self.phaseWindows())
+        correlation = sum(np.sum(first * second) for first, second in zip(windows[:-1], windows[1:])) \
+                    / sum(np.sum(phase**2) for phase in windows[:-1])
+        expected    = np.exp(-self.diffuser.step**2 / (2 * common.sigma_f**2))
+        assert abs(correlation - expected) < 0.1, (correlation, expected)
+
+class EnsembleAccumulator(object):
+    '''The running mean and variance of the irradiance of diffused beams.
+
+    '''
+    params      = ['small', 'publication']
+    param_names = ['size']
+
+    # Uneven batches of realizations, as accumulated by different workers
+    batchSizes = [1, 7, 0, 12, 5]
+
+    def setup(self, size):
+        grid  = common.collGrid(size)
+        beam  = fields.GaussianBeamDefocused(common.fieldAmp, common.beamStd, common.wavelength, common.dR)
+        masks = fields.diffuserMasks(sum(self.batchSizes), common.sigma_f, common.sigma_r, grid,
+                                     rng = np.random.default_rng(0))
+
+        # The speckle at the focus of the telescope, in single and in double precision
+        irrad       = np.array([np.abs(simfft.fftPropagate(beam(grid.px) * mask, grid, -common.dR))**2
+                                for mask in masks])
+        self.planes = (irrad.astype(np.float32), irrad)
+
+    def accumulate(self, start, stop):
+        acc = fields.EnsembleAccumulator()
+        for index in range(start, stop):
+            acc.update(tuple(plane[index] for plane in self.planes))
+
+        return acc
+
+    def time_update(self, size):
+        self.accumulate(0, len(self.planes[0]))
+
+    def check_matchesNumpy(self, size):
+        '''One accumulator and merged partial accumulators give the mean and variance of the stacked realizations.
+
+        '''
+        bounds   = np.cumsum([0] + self.batchSizes)
+        partials = [self.accumulate(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+        merged = fields.EnsembleAccumulator()
+        for partial in partials:
+            merged.merge(partial)
+
+        for acc in (self.accumulate(0, bounds[-1]), merged):
+            assert acc.count == bounds[-1]
+            for mean, variance, plane in zip(acc.mean, acc.variance(), self.planes):
+                assert mean.dtype == variance.dtype == np.float64
+                assert np.allclose(mean, np.mean(plane, axis = 0, dtype = np.float64), rtol = 1e-12, atol = 0)
+                assert np.allclose(variance, np.var(plane, axis = 0, ddof = 1, dtype = np.float64),
+                                   rtol = 1e-9, atol = 1e-12 * np.max(variance))
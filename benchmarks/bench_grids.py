@@ -0,0 +1,65 @@
+# © All rights reserved. ECOLE POLYTECHNIQUE FEDERALE DE LAUSANNE, Switzerland,
+# Laboratory of Experimental Biophysics, 2016
+# See the LICENSE.docx file for more details.
+
+import numpy         as np
+import SimMLA.fields as fields
+from benchmarks      import common
+
+class GridCoordinates(object):
+    '''The coordinate properties of Grid, computed on first access and then cached.
+
+    '''
+    params      = ['small', 'publication']
+    param_names = ['size']
+
+    def setup(self, size):
+        self.grid = common.mlaGrid(size)
+        self.accessAll(self.grid)
+
+    def accessAll(self, grid):
+        return grid.px, grid.pX, grid.pfX
+
+    def time_firstAccess(self, size):
+        self.accessAll(common.mlaGrid(size))
+
+    def time_cachedAccess(self, size):
+        self.accessAll(self.grid)
+
+    def check_coordinates(self, size):
+        '''The cached coordinates equal the ones of the original meshgrid-based Grid.
+
+        '''
+        for name in ('px', 'pX', 'pfX'):
+            actual = common.subsample(np.ravel(getattr(self.grid, name)))
+            assert np.allclose(actual, common.reference(size, name), rtol = 1e-14, atol = 0), name
+
+class Rect(object):
+    '''Sampling a field on one subgrid.
+
+    '''
+    params      = ['small', 'publication']
+    param_names = ['size']
+
+    def setup(self, size):
+        self.grid   = common.mlaGrid(size)
+        self.grid2D = common.mlaGrid(size, dim = 2)
+
+        beamStd      = self.grid.physicalSize / 15
+        self.field   = fields.GaussianBeamWaistProfile(common.fieldAmp, beamStd)(self.grid.px)
+        self.field2D = fields.GaussianBeamWaistProfile2D(common.fieldAmp, beamStd)(self.grid2D.px, self.grid2D.py)
+
+    def time_rect(self, size):
+        self.grid.rect(self.field, 0)
+
+    def time_rect2(self, size):
+        self.grid2D.rect2(self.field2D, 0, 0)
+
+    def check_subgridsTileTheAperture(self, size):
+        '''The subgrids cover the aperture of the arrays exactly like the original rect.
+
+        '''
+        total = sum(self.grid.rect(self.field, ind) for ind in range(self.grid.numSubgrids))
+
+        # The original profile differs from the current one by rounding
+        assert np.allclose(common.subsample(total), common.reference(size, 'rect'), rtol = 1e-14, atol = 0)
@@ -0,0 +1,71 @@
+# © All rights reserved. ECOLE POLYTECHNIQUE FEDERALE DE LAUSANNE, Switzerland,
+# Laboratory of Experimental Biophysics, 2016
+# See the LICENSE.docx file for more details.
+
+import os
+import shutil
+import tempfile
+import numpy          as np
+import SimMLA.storage as storage
+from benchmarks       import common
+
+class SweepStorage(object):
+    '''Reading rows of the planes of a sweep saved with and without compression.
+
+    '''
+    params      = ['small', 'publication']
+    param_names = ['size']
+
+    taps = ('focus', 'sample')
+
+    def setup(self, size):
+        grid           = common.outputGrid(size)
+        self.chunkSize = grid.gridSize // 7
+        self.rows      = slice(grid.gridSize // 3, grid.gridSize // 3 + self.chunkSize)
+
+        # The focus planes are shorter than one chunk and empty for the last point
+        rng           = np.random.default_rng(0)
+        focusSizes    = [self.chunkSize // 2, self.chunkSize // 2, 0]
+        self.points   = [{'L2' : L2} for L2 in (0.5 * common.L2, common.L2, 1.5 * common.L2)]
+        self.avgIrrad = [(rng.random(focusSize), rng.random(grid.gridSize)) for focusSize in focusSizes]
+        coordinates   = [(np.ravel(grid.px)[:focusSize], np.ravel(grid.px)) for focusSize in focusSizes]
+
+        self.directory = tempfile.mkdtemp()
+        self.stores    = {}
+        for compress in (True, False):
+            fileName = os.path.join(self.directory, 'compress{0}.zip'.format(compress))
+            storage.saveSweep(fileName, self.points, self.avgIrrad, self.taps, coordinates,
+                              compress = compress, chunkSize = self.chunkSize)
+            self.stores[compress] = storage.SweepStore(fileName)
+
+    def teardown(self, size):
+        for store in self.stores.values():
+            store.close()
+        shutil.rmtree(self.directory)
+
+    def time_readRowsCompressed(self, size):
+        self.stores[True].plane(1, 'sample', rows = self.rows)
+
+    def time_readRowsMapped(self, size):
+        np.array(self.stores[False].plane(1, 'sample', rows = self.rows))
+
+    def check_roundTrip(self, size):
+        '''Every plane and every slice of rows reads back the array that was written.
+
+        '''
+        selections = [None, self.rows, slice(self.chunkSize - 1, self.chunkSize + 1), slice(0, 0),
+                      slice(None, None, 3)]
+
+        for compress, store in self.stores.items():
+            assert store.points == self.points
+            for point, planes in enumerate(self.avgIrrad):
+                for tap, expected in zip(self.taps, planes):
+                    for rows, mmap in ((rows, mmap) for rows in selections for mmap in (True, False)):
+                        actual = store.plane(point, tap, mmap = mmap, rows = rows)
+                        label  = (compress, point, tap, rows, mmap)
+
+                        assert np.array_equal(actual, expected if rows is None else expected[rows]), label
+                        if rows is None:
+                            assert isinstance(actual, np.memmap) == (mmap and not compress), label
+
+                    assert store.coordinates(point, tap).size == expected.size, (compress, point, tap)
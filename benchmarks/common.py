@@ -0,0 +1,93 @@
+# © All rights reserved. ECOLE POLYTECHNIQUE FEDERALE DE LAUSANNE, Switzerland,
+# Laboratory of Experimental Biophysics, 2016
+# See the LICENSE.docx file for more details.
+
+import os
+import numpy as np
+from SimMLA.grids import Grid, GridArray
+
+# The parameters of the publication's simulations (publication_data/Vary_L2)
+wavelength   = 0.642
+lensletSize  = 500
+focalLength  = 13700
+fc           = 50000
+dR           = -5000
+L1           = 700000
+L2           = 200000
+fObj         = 3300
+beamStd      = 6
+sigma_f      = 10
+sigma_r      = 1.75
+Z0           = 376.73
+power        = 100
+fieldAmp     = np.sqrt(power / 1000 * Z0 / beamStd / np.sqrt(np.pi))
+
+# The number of lenslets and samples per lenslet of each benchmark size. A 2D
+# grid at the publication's 1D sampling does not fit in memory, so the 2D
+# benchmarks use their own subgrid sizes.
+SIZES = {'small'       : {'numLenslets' : 5,  'subgridSize' : 501,   'subgridSize2D' : 31,
+                          'collSize'    : 4001},
+         'publication' : {'numLenslets' : 21, 'subgridSize' : 20001, 'subgridSize2D' : 51,
+                          'collSize'    : 20001}}
+
+# The reference results of the baseline code, written by benchmarks.references
+REFERENCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'reference')
+
+# The largest number of samples per axis that is stored for a reference
+MAX_REFERENCE_SAMPLES = 4096
+
+_references = {}
+
+def reference(size, name):
+    '''Returns a reference result of the baseline code for a benchmark size.
+
+    The results are subsampled as in subsample.
+
+    '''
+    if size not in _references:
+        with np.load(os.path.join(REFERENCE_DIR, size + '.npz')) as data:
+            _references[size] = dict(data)
+
+    return _references[size][name]
+
+def subsample(array):
+    '''Returns evenly strided samples of an array with at most MAX_REFERENCE_SAMPLES per axis.
+
+    '''
+    strides = tuple(slice(None, None, -(-n // MAX_REFERENCE_SAMPLES)) for n in np.shape(array))
+
+    return np.asarray(array)[strides]
+
+def mlaGrid(size, dim = 1, subgridSize = None):
+    '''Returns the GridArray of the microlens arrays for a benchmark size.
+
+    The subgrid size defaults to the one of the size's 1D or 2D grids.
+
+    '''
+    params = SIZES[size]
+    if subgridSize is None:
+        subgridSize = params['subgridSize'] if dim == 1 else params['subgridSize2D']
+
+    return GridArray(params['numLenslets'], subgridSize, params['numLenslets'] * lensletSize,
+                     wavelength, focalLength, dim = dim, zeroPad = 3)
+
+def collGrid(size):
+    '''Returns the grid at the diffuser for a benchmark size.
+
+    '''
+    return Grid(SIZES[size]['collSize'], 5000, wavelength, fc, dim = 1)
+
+def outputGrid(size):
+    '''Returns the grid behind the microlens arrays, as in the publication's notebooks.
+
+    '''
+    params = SIZES[size]
+    n      = params['numLenslets']
+
+    return Grid(5 * params['subgridSize'] * n, 5 * n * lensletSize, wavelength, fObj, dim = 1)
+
+def relativeError(actual, expected):
+    '''Returns the largest deviation relative to the largest magnitude of expected.
+
+    '''
+    return np.max(np.abs(actual - expected)) / np.max(np.abs(expected))
@@ -0,0 +1,99 @@
+# © All rights reserved. ECOLE POLYTECHNIQUE FEDERALE DE LAUSANNE, Switzerland,
+# Laboratory of Experimental Biophysics, 2016
+# See the LICENSE.docx file for more details.
+
+'''Writes the reference results of the benchmarks' check_* methods.
+
+The references are computed by the original SimMLA code, the one used for
+the publication's notebooks, at the benchmark sizes, so that the checks do
+not compare the optimized code with itself. Extract that code and pass the
+directory that contains its SimMLA package:
+
+Usage
+-----
+git archive <baseline commit> SimMLA | tar -x -C /tmp/baseline
+python -m benchmarks.references /tmp/baseline
+
+'''
+
+import argparse
+import os
+import sys
+import numpy as np
+
+def computeReferences(size):
+    '''Returns the reference results of a benchmark size, subsampled by common.subsample.
+
+    '''
+    # Imported here so that SimMLA is the one of the baseline directory
+    import SimMLA.fftpack as simfft
+    import SimMLA.fields  as fields
+    from benchmarks       import common
+
+    refs = {}
+
+    # FFTSubgrid and Rect
+    grid    = common.mlaGrid(size)
+    target  = common.outputGrid(size)
+    beamStd = grid.physicalSize / 15
+    beam    = fields.GaussianBeamDefocused(common.fieldAmp, beamStd, common.wavelength, 50000)
+
+    refs['fftSubgrid'] = _sumInterpolants(simfft.fftSubgrid(beam, grid), target.px)
+
+    waist        = fields.GaussianBeamWaistProfile(common.fieldAmp, beamStd)
+    refs['rect'] = sum(grid.rect(waist, ind) for ind in range(grid.numSubgrids))
+
+    # FFT2Subgrid transforms a separable field; its 1D factor
+    grid1D = common.mlaGrid(size, dim = 1, subgridSize = common.SIZES[size]['subgridSize2D'])
+    beam1D = fields.GaussianBeamDefocused(common.fieldAmp, grid1D.physicalSize / 15, common.wavelength, 50000)
+
+    refs['fftSubgrid2D'] = _sumInterpolants(simfft.fftSubgrid(beam1D, grid1D), grid1D.px)
+
+    # Propagate
+    field                = fields.GaussianBeamWaistProfile(common.fieldAmp, grid.physicalSize / 45)(grid.px)
+    refs['fftPropagate'] = simfft.fftPropagate(field, grid, common.L1)
+
+    # GridCoordinates
+    refs['px'], refs['pX'], refs['pfX'] = grid.px, grid.pX, grid.pfX
+
+    # PhaseScreens and GSMRealization draw from numpy's global random state
+    collGrid = common.collGrid(size)
+
+    np.random.seed(1)
+    refs['diffuserMask'] = fields.diffuserMask(common.sigma_f, common.sigma_r, collGrid)(collGrid.px)
+
+    np.random.seed(0)
+    mask                 = fields.diffuserMask(common.sigma_f, common.sigma_r, collGrid)(collGrid.px)
+    beam                 = fields.GaussianBeamDefocused(common.fieldAmp, common.beamStd, common.wavelength, common.dR)
+    refs['diffusedBeam'] = beam(collGrid.px) * mask
+
+    return {name : common.subsample(ref) for name, ref in refs.items()}
+
+def _sumInterpolants(interpolants, x):
+    '''Sums the magnitude and phase interpolants of fftSubgrid like the notebooks.
+
+    '''
+    field = np.zeros(x.size, dtype = np.complex128)
+    for currMag, currPhase in zip(*interpolants):
+        field += currMag(x) * np.exp(1j * currPhase(x))
+
+    return field
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog = 'python -m benchmarks.references', description = __doc__.split('\n\n')[0])
+    parser.add_argument('baseline', help = 'The directory that contains the SimMLA package of the baseline code.')
+    parser.add_argument('--size', nargs = '+', default = ['small', 'publication'], choices = ['small', 'publication'],
+                        help = 'The sizes of the references.')
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, os.path.abspath(args.baseline))
+    from benchmarks import common
+
+    os.makedirs(common.REFERENCE_DIR, exist_ok = True)
+    for size in args.size:
+        np.savez_compressed(os.path.join(common.REFERENCE_DIR, size + '.npz'), **computeReferences(size))
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
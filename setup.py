@@ -18,6 +18,7 @@ config = {
     'author_email'     : 'kyle.douglass@epfl.ch',
     'version'          : '0.0.1',
     'install_requires' : requirements,
+    'python_requires'  : '>=3.9',
     'packages'         : ['SimMLA'],
     'scripts'          : [],
     'name'             : 'SimMLA',